@@ -0,0 +1,331 @@
+"""
+    Benchmarks for sWeather
+
+Times the parts of sWeather that run on every refresh or key press,
+on the headless Sense Hat (sense_headless.py) so no hardware is needed:
+
+  * outdoor_hud_*      drawing the outdoor HUD and sending it to the hat
+  * display_readings   the indoor HUD, from the sensor sampler's buffer
+  * sensor_*           taking a sensor sample, and the window statistics
+  * menu_move_cursor   a joystick press on the main menu, until the
+                       frame has been written
+  * readout_*          building the readout text, and drawing it
+                       into a scroller strip
+  * framebuffer_*      a frame committed by sense_fb.py's memory-mapped
+                       writer (to a plain file standing in for the
+                       device), all rows and one changed row
+  * fetch_all          downloading all the forecasts, from the stand-in
+                       server in owm_standin.py with added latency
+
+The rendering benchmarks draw made up forecast tables, and the fetch
+benchmark serves made up OWM answers, so the results only depend on
+the code and the machine. Run it and save the results:
+
+    python3 bench_sweather.py --output bench_results.json
+
+and compare another version's against them (exits with status 1 if
+anything got slower than the tolerance):
+
+    python3 bench_sweather.py --compare bench_results.json
+
+"""
+
+import argparse
+import json
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import sense_headless
+import sWeather as sw
+
+#The city the benchmarks request
+BENCH_CITY = 4975802
+#Weather codes the made up forecasts cycle through
+BENCH_CODES = (800, 500, 801, 211, 600, 741)
+
+#--------------------------- STUB DATA ---------------------------#
+
+def stub_table(count, step, start=None):
+    """Returns a made up forecast table with count rows, step
+       seconds apart"""
+    start = int(time.time()) if start is None else start
+    rows = np.zeros(count, dtype=sw.FORECAST_DTYPE)
+    rows["time"] = start + step * np.arange(count)
+    rows["code"] = np.resize(BENCH_CODES, count)
+    rows["temp"] = 20 + 3 * np.arange(count) % 80
+    rows["humidity"] = 40 + np.arange(count) % 40
+    rows["pressure"] = 990 + 5 * np.arange(count) % 50
+    rows["wind"] = 3.0
+    rows["status"] = [sw.status_index(status) for status in
+                      np.resize(["clear sky", "light rain", "few clouds",
+                                 "thunderstorm"], count)]
+    return sw.ForecastTable(rows, time.time())
+
+def stub_tables():
+    """The daily forecast, current conditions and 3hr forecast"""
+    return stub_table(8, 86400), stub_table(1, 0), stub_table(40, 10800)
+
+def owm_weather(code, when):
+    """A made up OWM answer for one time, the parts pyowm reads"""
+    return {"dt": when,
+            "main": {"temp": 290.0, "temp_min": 288.0, "temp_max": 292.0,
+                     "pressure": 1013, "humidity": 60},
+            "weather": [{"id": code, "main": "Clear",
+                         "description": "clear sky", "icon": "01d"}],
+            "clouds": {"all": 0}, "wind": {"speed": 3.1, "deg": 200}}
+
+def write_stub_fixtures(folder, city_id=BENCH_CITY):
+    """Writes made up answers for every endpoint sWeather uses, in
+       the format owm_standin.py records them in"""
+    import owm_standin
+    now = int(time.time())
+    city = {"id": city_id, "name": "Bench", "country": "US",
+            "coord": {"lon": -69.7, "lat": 44.3}}
+    observation = dict(owm_weather(800, now), id=city_id, name="Bench",
+                       coord=city["coord"], cod=200,
+                       sys={"country": "US", "sunrise": now, "sunset": now})
+    three_hours = {"cod": "200", "cnt": 40, "city": city,
+                   "list": [owm_weather(BENCH_CODES[i % 6], now + 10800 * i)
+                            for i in range(40)]}
+    days = []
+    for i in range(8):
+        day = owm_weather(BENCH_CODES[i % 6], now + 86400 * i)
+        day.update(temp={"day": 290.0, "min": 285.0, "max": 295.0,
+                         "night": 284.0, "eve": 288.0, "morn": 286.0},
+                   pressure=1015, humidity=55, speed=3, deg=200)
+        del day["main"]
+        days.append(day)
+    daily = {"cod": "200", "cnt": 8, "city": city, "list": days}
+    for path, body in ((owm_standin.API_PATH + "weather", observation),
+                       (owm_standin.API_PATH + "forecast", three_hours),
+                       (owm_standin.API_PATH + "forecast/daily", daily)):
+        with open("%s/%s" % (folder, owm_standin.fixture_name(path, city_id)),
+                  "w") as f:
+            json.dump({"recorded": now, "status": 200, "body": body}, f)
+
+#--------------------------- MEASURING ---------------------------#
+
+def timed(function, repeat):
+    """Calls function repeat times, returns the seconds each took"""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+def summary(times, **extra):
+    """Milliseconds statistics for a list of seconds"""
+    ms = sorted(t * 1000 for t in times)
+    result = {"runs": len(ms),
+              "min_ms": ms[0],
+              "median_ms": statistics.median(ms),
+              "mean_ms": statistics.mean(ms),
+              "p95_ms": ms[int(0.95 * (len(ms) - 1))]}
+    result.update(extra)
+    return result
+
+#--------------------------- BENCHMARKS ---------------------------#
+
+def bench_outdoor_hud(hat, repeat):
+    tables = stub_tables()
+    renderer = sw.get_renderer(hat)
+    results = {}
+
+    def full():
+        renderer.forget() #As if the screen showed something else
+        sw.show_frame(hat, sw.render_outdoor_hud(*tables), "outdoor hud")
+
+    def unchanged():
+        sw.show_frame(hat, sw.render_outdoor_hud(*tables), "outdoor hud")
+
+    for name, refresh in (("outdoor_hud_full", full),
+                          ("outdoor_hud_unchanged", unchanged)):
+        hat.reset_calls()
+        times = timed(refresh, repeat)
+        results[name] = summary(times,
+                                writes_per_refresh=len(hat.calls) / repeat)
+    results["outdoor_hud_render_only"] = summary(
+        timed(lambda: sw.render_outdoor_hud(*tables), repeat))
+    return results
+
+def bench_display_readings(hat, repeat):
+    rand = random.Random(1)
+    hat.script_sensor("temperature", [rand.uniform(-10, 40)
+                                      for i in range(repeat)])
+    hat.script_sensor("humidity", [rand.uniform(0, 100)
+                                   for i in range(repeat)])
+    hat.script_sensor("pressure", [rand.uniform(950, 1050)
+                                   for i in range(repeat)])
+    #From the sampler's buffer
+    sampler = sw.SensorSampler(hat)
+    results = {"sensor_sample": summary(timed(sampler.sample, repeat))}
+    sw.sensor_sampler = sampler
+    hat.reset_calls()
+    times = timed(lambda: sw.display_readings(hat), repeat)
+    results["display_readings"] = summary(
+        times, writes_per_refresh=len(hat.calls) / repeat)
+    results["sensor_stats"] = summary(timed(sampler.stats, repeat))
+    sw.sensor_sampler = None
+    return results
+
+def bench_menu(hat, repeat):
+    sw.hat = hat
+    sw.curr_x = 0
+    latencies = []
+    for i in range(repeat):
+        hat.reset_calls()
+        event = sense_headless.InputEvent(time.time(), "right", "pressed")
+        start = time.perf_counter()
+        sw.move_cursor(event)
+        #Until the frame was written
+        latencies.append(hat.calls[-1][0] - start)
+    return {"menu_move_cursor": summary(latencies)}
+
+def bench_readouts(hat, repeat):
+    daily, current, forecast_3h = stub_tables()
+    scroller = sw.get_scroller(hat)
+    text = sw.readout_8d_text(daily)
+
+    def strip():
+        scroller.strips.clear() #Drawn from the font each time
+        scroller.strip(text, sw.nwhite)
+
+    return {"readout_3h_text": summary(timed(
+                lambda: sw.readout_3h_text(current, forecast_3h), repeat)),
+            "readout_8d_text": summary(timed(
+                lambda: sw.readout_8d_text(daily), repeat)),
+            "readout_strip": summary(timed(strip, repeat),
+                                     columns=scroller.strip(text,
+                                                            sw.nwhite).shape[1])}
+
+def bench_framebuffer(hat, repeat):
+    import sense_fb
+    folder = tempfile.mkdtemp(prefix="sweather-bench-")
+    device = folder + "/fb"
+    with open(device, "wb") as f:
+        f.write(bytes(sense_fb.SENSE_FB_SIZE))
+    fb_hat = sense_fb.FramebufferHat(hat, device)
+    try:
+        pixels = sw.render_outdoor_hud(*stub_tables()).pixels
+        rows = np.array([4])
+        return {"framebuffer_full": summary(timed(
+                    lambda: fb_hat.set_rows(pixels, None), repeat)),
+                "framebuffer_row": summary(timed(
+                    lambda: fb_hat.set_rows(pixels, rows), repeat))}
+    finally:
+        fb_hat.framebuffer.close()
+        shutil.rmtree(folder, ignore_errors=True)
+
+def bench_fetch(repeat, latency):
+    try:
+        import owm_client
+        import owm_standin
+    except ImportError as problem:
+        return {"fetch_all": {"skipped": str(problem)}}
+    folder = tempfile.mkdtemp(prefix="sweather-bench-")
+    standin = None
+    try:
+        write_stub_fixtures(folder)
+        standin = owm_standin.StandIn(folder, port=0, latency=latency)
+        owm_client.owm_http.base_url = standin.start()
+        #Every round is sent, whatever the budget of the api key
+        sw.request_scheduler.budget = sw.RequestBudget(1e9, 1e9)
+        times = []
+        for i in range(repeat + 1):
+            sw.forecast_cache.invalidate()
+            start = time.perf_counter()
+            data = sw.fetch_all(BENCH_CITY)
+            times.append(time.perf_counter() - start)
+            if(None in data.values()):
+                return {"fetch_all": {"skipped": "the stand-in didn't answer"}}
+        requests = [timing[1] for timing in sw.request_timings()]
+        #The first one also opens the connections
+        return {"fetch_all": summary(times[1:], latency_ms=latency * 1000,
+                                     first_ms=times[0] * 1000),
+                "fetch_request": summary(requests, latency_ms=latency * 1000)}
+    finally:
+        if(standin is not None):
+            standin.stop()
+        shutil.rmtree(folder, ignore_errors=True)
+
+#------------------------------ MAIN ------------------------------#
+
+def run(repeat=200, fetch_repeat=10, latency=0.1):
+    """Runs every benchmark, returns the results"""
+    #Nothing the benchmarks fetch is saved
+    sw.forecast_cache.snapshot_file = None
+    hat = sense_headless.HeadlessHat()
+    results = {}
+    results.update(bench_outdoor_hud(hat, repeat))
+    results.update(bench_display_readings(hat, repeat))
+    results.update(bench_menu(hat, repeat))
+    results.update(bench_readouts(hat, repeat))
+    results.update(bench_framebuffer(hat, repeat))
+    results.update(bench_fetch(fetch_repeat, latency))
+    return {"version": sw.VERSION,
+            "time": time.time(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "results": results}
+
+def compare(old, new, tolerance):
+    """Prints how the medians changed, returns the names of the
+       benchmarks that got slower than tolerance allows"""
+    slower = []
+    for name, result in sorted(new["results"].items()):
+        before = old["results"].get(name, {})
+        if("median_ms" not in result or "median_ms" not in before):
+            continue
+        ratio = result["median_ms"] / max(before["median_ms"], 1e-9)
+        flag = ""
+        if(ratio > tolerance):
+            slower.append(name)
+            flag = "  SLOWER"
+        print("%-24s %10.3f -> %10.3f ms  x%.2f%s" % (name, before["median_ms"],
+                                                    result["median_ms"],
+                                                    ratio, flag))
+    return slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark sWeather")
+    parser.add_argument("--repeat", type=int, default=200,
+                        help="runs of each rendering benchmark")
+    parser.add_argument("--fetch-repeat", type=int, default=10,
+                        help="runs of the fetch benchmark")
+    parser.add_argument("--latency", type=float, default=0.1,
+                        help="seconds the stand-in server adds to each request")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="slowest allowed median, as a multiple of the "
+                             "compared one")
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat, args.fetch_repeat, args.latency)
+    for name, result in sorted(results["results"].items()):
+        if("skipped" in result):
+            print("%-24s skipped: %s" % (name, result["skipped"]))
+        else:
+            print("%-24s median %9.3f ms  p95 %9.3f ms" % (
+                name, result["median_ms"], result["p95_ms"]))
+    if(args.output):
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if(args.compare):
+        with open(args.compare) as f:
+            slower = compare(json.load(f), results, args.tolerance)
+        if(slower):
+            print("Slower than before: " + ", ".join(slower))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
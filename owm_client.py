@@ -0,0 +1,127 @@
+"""
+    The OpenWeatherMap client for sWeather
+
+pyowm and requests take a while to import on a pi, and nothing needs
+them until the first forecast is requested, so sWeather only imports
+this module then (see get_owm in sWeather.py).
+
+"""
+
+# Docs for pyowm...
+# [http://pyowm.readthedocs.io/en/latest/pyowm.html]
+from pyowm import OWM
+from pyowm.commons.http_client import HttpClient
+from pyowm.exceptions import api_call_error, parse_response_error
+import requests
+import collections
+import os
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+#-------------------------- OWM CLIENT --------------------------#
+
+# A new OWM client used to be made for every refresh, and pyowm sends
+#  each request with a plain requests.get, so every request paid for
+#  setting up a new TCP (and TLS) connection, which is a good part of
+#  what a request costs on a pi. Now there is one client for the whole
+#  program, and its HTTP layer sends every request through a single
+#  requests.Session that keeps its connections open and reuses them
+#  for all the endpoints. The session keeps up to one connection per
+#  thread that sends requests through it (see get_owm), any more are
+#  closed after each request instead of being reused.
+
+#Send requests (and the api key) over https instead of http, which
+# pyowm (and sWeather) always used
+OWM_USE_SSL = False
+#How long to wait for a single request, in seconds
+REQUEST_TIMEOUT = 5
+#Connections kept open, unless get_owm is told how many threads
+# send requests
+POOL_SIZE = 4
+#Where to send the requests instead of openweathermap.org, e.g. the
+# stand-in server in owm_standin.py: SWEATHER_OWM_URL=http://127.0.0.1:8765
+OWM_BASE_URL = os.environ.get("SWEATHER_OWM_URL")
+
+class PooledHttpClient(HttpClient):
+    """pyowm's HttpClient, but requests go through one keep-alive
+       session, and each one is timed"""
+
+    def __init__(self, timeout=REQUEST_TIMEOUT, base_url=OWM_BASE_URL,
+                 pool_size=POOL_SIZE):
+        HttpClient.__init__(self, timeout=timeout)
+        #Scheme and host that replace openweathermap.org's, if any
+        self.base_url = base_url
+        self.session = requests.Session()
+        self.pool_size = None
+        self.resize_pool(pool_size)
+        #The latest requests as (url path, seconds taken, status code),
+        # the status code is None if there was no answer
+        self.timings = collections.deque(maxlen=50)
+        #Also called with each of those, if set
+        self.on_request = None
+
+    def resize_pool(self, pool_size):
+        """Keeps up to pool_size connections open, enough for all
+           the requests that can be sent at once"""
+        if(pool_size == self.pool_size):
+            return
+        self.pool_size = pool_size
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                                pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_json(self, uri, params=None, headers=None):
+        """Sends a GET request, returns (status code, parsed json).
+           Raises the same pyowm errors as HttpClient.get_json"""
+        if(self.base_url):
+            base = urlsplit(self.base_url)
+            uri = urlunsplit(urlsplit(uri)._replace(scheme=base.scheme,
+                                                    netloc=base.netloc))
+        start = time.time()
+        status = None
+        try:
+            resp = self.session.get(uri, params=params, headers=headers,
+                                    timeout=self.timeout,
+                                    verify=self.verify_ssl_certs)
+            status = resp.status_code
+        #Translated like HttpClient.get_json does
+        except requests.exceptions.SSLError as e:
+            raise api_call_error.APIInvalidSSLCertificateError(str(e))
+        except requests.exceptions.ConnectionError as e:
+            raise api_call_error.APIInvalidSSLCertificateError(str(e))
+        except requests.exceptions.Timeout:
+            raise api_call_error.APICallTimeoutError('API call timeouted')
+        finally:
+            timing = (urlsplit(uri).path, time.time() - start, status)
+            self.timings.append(timing)
+            if(self.on_request is not None):
+                self.on_request(*timing)
+        HttpClient.check_status_code(resp.status_code, resp.text)
+        try:
+            return resp.status_code, resp.json()
+        except ValueError:
+            raise parse_response_error.ParseResponseError('Impossible to parse'
+                                                          'API response data')
+
+#The HTTP layer under the OWM client
+owm_http = PooledHttpClient()
+owm_client = None
+owm_client_lock = threading.Lock()
+
+def get_owm(api_key, pool_size=None):
+    """Returns the OWM client that every request is sent with.
+       pool_size is how many threads may send requests at once"""
+    global owm_client
+    with owm_client_lock:
+        if(pool_size is not None):
+            owm_http.resize_pool(pool_size)
+        if(owm_client is None):
+            owm_client = OWM(api_key, use_ssl=OWM_USE_SSL)
+            owm_client._wapi = owm_http
+    return owm_client
+
+def request_timings():
+    """Returns the latest requests as (url path, seconds, status code)"""
+    return list(owm_http.timings)
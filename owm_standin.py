@@ -0,0 +1,284 @@
+"""
+    An OpenWeatherMap stand-in for sWeather
+
+Records real OpenWeatherMap answers to fixture files, and serves them
+from a local HTTP server, so that fetching, caching and refreshing can
+be timed the same way every run, on a machine with no network and
+without spending the api key's request allowance.
+
+Record the answers for a city (needs a real api key and a network):
+
+    python3 owm_standin.py record --key <api key> --city 4975802
+
+Serve them, here with 200ms of extra latency per request, one request
+in 10 failing, and at most 60 requests a minute:
+
+    python3 owm_standin.py serve --latency 0.2 --error-rate 0.1 --rate-limit 60
+
+and point sWeather at the server:
+
+    SWEATHER_OWM_URL=http://127.0.0.1:8765 python3 sWeather.py
+
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+#Where the fixtures are kept by default
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "owm_fixtures")
+#Every OWM url path starts with this
+API_PATH = "/data/2.5/"
+#The port the stand-in listens on by default
+STANDIN_PORT = 8765
+#Forecast times are moved forward in steps of this many seconds when
+# served, so 3 hour forecasts stay on the 3 hour marks
+TIME_STEP = 3 * 3600
+
+def fixture_name(path, city_id):
+    """Returns the fixture file name for an OWM url path and city id,
+       e.g. forecast_daily_4975802.json for /data/2.5/forecast/daily"""
+    endpoint = path[len(API_PATH):].strip("/").replace("/", "_")
+    return "%s_%s.json" % (endpoint, city_id)
+
+#----------------------------- RECORD -----------------------------#
+
+def record(api_key, city_id, folder=FIXTURES_DIR):
+    """Requests the current conditions, the daily forecast and the
+       3hr forecast for a city the way sWeather does, and saves each
+       answer to a fixture file in folder. Returns the file paths"""
+    import owm_client
+    from pyowm import OWM
+
+    class RecordingHttpClient(owm_client.PooledHttpClient):
+        """Saves the answer to every request it sends"""
+
+        def __init__(self):
+            owm_client.PooledHttpClient.__init__(self)
+            self.saved = []
+
+        def get_json(self, uri, params=None, headers=None):
+            status, data = owm_client.PooledHttpClient.get_json(
+                self, uri, params, headers)
+            path = os.path.join(folder, fixture_name(urlsplit(uri).path,
+                                                     params["id"]))
+            with open(path, "w") as f:
+                json.dump({"recorded": time.time(), "status": status,
+                           "body": data}, f)
+            self.saved.append(path)
+            return status, data
+
+    os.makedirs(folder, exist_ok=True)
+    owm = OWM(api_key, use_ssl=owm_client.OWM_USE_SSL)
+    owm._wapi = http = RecordingHttpClient()
+    owm.weather_at_id(city_id)
+    owm.daily_forecast_at_id(city_id, limit=8)
+    owm.three_hours_forecast_at_id(city_id)
+    return http.saved
+
+#----------------------------- SERVE -----------------------------#
+
+def shift_times(data, offset):
+    """Adds offset to every "dt" time in an OWM answer"""
+    if(isinstance(data, dict)):
+        return {key: (value + offset if key == "dt" else
+                      shift_times(value, offset))
+                for key, value in data.items()}
+    if(isinstance(data, list)):
+        return [shift_times(value, offset) for value in data]
+    return data
+
+class StandIn(object):
+    """Serves the fixtures in a folder like OpenWeatherMap would,
+       with extra latency, failures and rate limiting"""
+
+    def __init__(self, folder=FIXTURES_DIR, port=STANDIN_PORT, latency=0.0,
+                 jitter=0.0, error_rate=0.0, error_status=500,
+                 rate_limit=None, fresh_times=True, seed=None):
+        self.folder = folder
+        self.latency = latency           #Seconds added to every answer
+        self.jitter = jitter             #Up to this many more, at random
+        self.error_rate = error_rate     #Share of requests that fail
+        self.error_status = error_status #...with this HTTP status
+        self.rate_limit = rate_limit     #Requests a minute, None for any
+        self.fresh_times = fresh_times   #Move the times up to now
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        #Token bucket for the rate limit
+        self.tokens = rate_limit
+        self.refilled = time.time()
+        #Requests answered, by HTTP status
+        self.counts = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", port),
+                                          self.handler_class())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        """The base url to give sWeather (SWEATHER_OWM_URL)"""
+        return "http://%s:%d" % self.server.server_address
+
+    def start(self):
+        """Serves on a background thread, returns the base url"""
+        server = threading.Thread(target=self.server.serve_forever)
+        server.daemon = True
+        server.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        """Returns the number of requests answered, by HTTP status"""
+        with self.lock:
+            return dict(self.counts)
+
+    def _take_token(self):
+        """False if the request is over the rate limit"""
+        if(self.rate_limit is None):
+            return True
+        now = time.time()
+        self.tokens = min(self.rate_limit, self.tokens +
+                          (now - self.refilled) * self.rate_limit / 60.0)
+        self.refilled = now
+        if(self.tokens < 1):
+            return False
+        self.tokens -= 1
+        return True
+
+    def answer(self, path, query):
+        """Returns (HTTP status, json body) for a request"""
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            limited = not self._take_token()
+            failed = self.random.random() < self.error_rate
+        time.sleep(delay)
+        if(limited):
+            return 429, {"cod": 429, "message": "Your account is temporary "
+                         "blocked due to exceeding of requests limitation "
+                         "of your subscription type."}
+        if(failed):
+            return self.error_status, {"cod": self.error_status,
+                                       "message": "Internal error"}
+        if(not path.startswith(API_PATH)):
+            return 404, {"cod": "404", "message": "Internal error"}
+        city_ids = query.get("id", [""])[0]
+        if(path == API_PATH + "group"):
+            #Put together from the recorded current conditions
+            fixtures = [self.fixture(API_PATH + "weather", city_id)
+                        for city_id in city_ids.split(",")]
+            fixtures = [fixture for fixture in fixtures if fixture]
+            if(not fixtures):
+                return 404, {"cod": "404", "message": "city not found"}
+            fixture = {"recorded": min(f["recorded"] for f in fixtures),
+                       "status": 200,
+                       "body": {"cnt": len(fixtures),
+                                "list": [f["body"] for f in fixtures]}}
+        else:
+            fixture = self.fixture(path, city_ids)
+            if(fixture is None):
+                return 404, {"cod": "404", "message": "city not found"}
+        body = fixture["body"]
+        if(self.fresh_times):
+            steps = int((time.time() - fixture["recorded"]) // TIME_STEP)
+            body = shift_times(body, steps * TIME_STEP)
+        return fixture["status"], body
+
+    def fixture(self, path, city_id):
+        """The recorded answer for a city, None if there is none"""
+        try:
+            with open(os.path.join(self.folder,
+                                   fixture_name(path, city_id))) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def handler_class(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            #Keep-alive, so pooled connections are reused like they
+            # are with the real service
+            protocol_version = "HTTP/1.1"
+            #The headers and body are sent separately, without this the
+            # body waits for the client's delayed ack (about 40ms)
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                status, body = standin.answer(url.path, parse_qs(url.query))
+                with standin.lock:
+                    standin.counts[status] = standin.counts.get(status, 0) + 1
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type",
+                                 "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass #Quiet, the counts are in stats()
+
+        return Handler
+
+#------------------------------ MAIN ------------------------------#
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Record OpenWeatherMap answers, or serve them locally")
+    parser.add_argument("--fixtures", default=FIXTURES_DIR,
+                        help="folder the fixture files are kept in")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    recorder = commands.add_parser("record",
+                                   help="save real answers as fixtures")
+    recorder.add_argument("--key", required=True, help="OWM api key")
+    recorder.add_argument("--city", type=int, required=True, help="OWM city id")
+
+    server = commands.add_parser("serve", help="serve the fixtures")
+    server.add_argument("--port", type=int, default=STANDIN_PORT)
+    server.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every answer")
+    server.add_argument("--jitter", type=float, default=0.0,
+                        help="up to this many more seconds, at random")
+    server.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of requests that fail, 0 to 1")
+    server.add_argument("--error-status", type=int, default=500,
+                        help="HTTP status of the failed requests")
+    server.add_argument("--rate-limit", type=int, default=None,
+                        help="requests a minute before answering 429")
+    server.add_argument("--recorded-times", action="store_true",
+                        help="serve the times as recorded, not moved to now")
+    server.add_argument("--seed", type=int, default=None,
+                        help="seed for the latency and failures")
+    args = parser.parse_args(argv)
+
+    if(args.command == "record"):
+        for path in record(args.key, args.city, args.fixtures):
+            print("Saved " + path)
+        return
+
+    standin = StandIn(args.fixtures, args.port, args.latency, args.jitter,
+                      args.error_rate, args.error_status, args.rate_limit,
+                      not args.recorded_times, args.seed)
+    print("Serving %s on %s (SWEATHER_OWM_URL=%s)" % (args.fixtures,
+                                                      standin.url,
+                                                      standin.url))
+    try:
+        standin.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        standin.server.server_close()
+        print(standin.stats())
+
+if __name__ == "__main__":
+    main()
@@ -47,35 +47,40 @@ VERSION = "1.0.0"
 #----------------------------------------------------------------#
 #--------------------------[ IMPORTS ]---------------------------#
 #----------------------------------------------------------------#
-# Docs for pyowm...
-# [http://pyowm.readthedocs.io/en/latest/pyowm.html]
-from pyowm import OWM
-from pyowm import timeutils
-import datetime, time
-from pytz import timezone
 import time
+#Taken before anything else is imported, see startup_mark
+START_TIME = time.time()
+# pyowm, pytz and the Sense Hat libraries are slow to import on a pi,
+#  so they are imported where they are first used instead of here:
+#  pyowm in owm_client.py, pytz in utc_to_eastern, and only the one
+#  Sense Hat library that is used in open_hat
+import sys
+import datetime
+import asyncio
+import functools
+import inspect
+import threading
+import os, mmap
+from concurrent.futures import ThreadPoolExecutor, Future, wait as wait_futures
+import collections
+import configparser
+import json
+import random
+import argparse
+import importlib
+import bisect
 import numpy as np
-from time import sleep
-from sense_emu import SenseHat as SenseHatEmu #Emus are funny-looking birds
-from sense_hat import SenseHat
 
 #----------------------------------------------------------------#
 #------------------[ CONSTANTS & GLOBALS ]-----------------------#
 #----------------------------------------------------------------#
-#Sense Hat
-hat = SenseHat()#change to SenseHatEmu() to run this on emulator
+#Sense Hat, opened in main (run with --emulator to use the Sense Hat
+# emulator instead, or --backend headless for no hardware at all)
+hat = None
 
 #Current x position for cursor in main menu view
 curr_x = 8 
 
-#Current sub program running is based on the state
-# 0 is startup
-# 1 is outdoor HUD
-# 2 is indoor HUD
-# 3 is 3 Hour forecast
-# 4 is 8 day forecast
-program_state = 0
-
 # Per the pyowm github page:
 
 # As the OpenWeatherMap API needs a valid API key to allow
@@ -146,6 +151,10 @@ humi_hi = red
 pres_low = humi_low
 pres_ok = humi_ok
 pres_hi = humi_hi
+#Weather codes that aren't in W_CODES (below) are left unlit
+unknown_code = black
+#As are readings that are missing (NaN)
+no_reading = black
 
 #--------------- MAIN MENU GRAPHICS ---------------------#
 
@@ -284,117 +293,601 @@ W_CODES = {
 #--------------------------[ FUNCTIONS ]-------------------------#
 #----------------------------------------------------------------#
 
+#---------------------------- METRICS ----------------------------#
+
+# To tell what is making the HUD slow (the network, pyowm, drawing,
+#  the sensors...) the program can time each stage and count what it
+#  does, and export it for Prometheus: as a textfile for the node
+#  exporter's textfile collector (--metrics-textfile), and over HTTP
+#  on localhost (--metrics-port), at /metrics and /metrics.json.
+#  It is off unless one of those is given, and then every timer and
+#  counter returns after checking metrics.enabled.
+
+#Upper bounds of the latency histogram buckets, in seconds
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+#How often the textfile is written, in seconds
+METRICS_INTERVAL = 60
+
+class StageTimer(object):
+    """Times a with block into a latency histogram"""
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+class NoTimer(object):
+    """Stands in for a StageTimer while metrics are off"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_TIMER = NoTimer()
+
+class Metrics(object):
+    """Latency histograms per stage, and counters"""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        #Stage: [count per bucket (the last is +Inf), sum of seconds]
+        self.histograms = {}
+        #(name, ((label, value), ...)): count
+        self.counters = {}
+
+    def timer(self, stage):
+        """with metrics.timer("stage"): times the block"""
+        if(not self.enabled):
+            return NO_TIMER
+        return StageTimer(self, stage)
+
+    def observe(self, stage, seconds):
+        """Adds a latency to the histogram of a stage"""
+        if(not self.enabled):
+            return
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if(histogram is None):
+                histogram = [[0] * (len(METRICS_BUCKETS) + 1), 0.0]
+                self.histograms[stage] = histogram
+            histogram[0][bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+
+    def count(self, name, amount=1, **labels):
+        """Adds amount to a counter"""
+        if(not self.enabled):
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def record_request(self, path, seconds, status):
+        """Called by the OWM client after every request"""
+        self.observe("http_request", seconds)
+        self.count("requests", endpoint=path)
+        if(status is None or status >= 400):
+            self.count("request_failures", endpoint=path, status=str(status))
+
+    def as_dict(self):
+        """Returns the metrics as plain JSON-able data"""
+        with self.lock:
+            stages = {}
+            for stage, (buckets, total) in self.histograms.items():
+                bounds = [str(bound) for bound in METRICS_BUCKETS] + ["+Inf"]
+                stages[stage] = {"count": sum(buckets), "sum": total,
+                                 "buckets": dict(zip(bounds, buckets))}
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in self.counters.items()]
+        return {"stages": stages, "counters": counters}
+
+    def prometheus_text(self):
+        """Returns the metrics in the Prometheus text format"""
+        def label_text(labels):
+            return ",".join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                            for key, value in labels)
+        lines = ["# TYPE sweather_stage_seconds histogram"]
+        with self.lock:
+            for stage, (buckets, total) in sorted(self.histograms.items()):
+                running = 0
+                bounds = [repr(bound) for bound in METRICS_BUCKETS] + ["+Inf"]
+                for bound, count in zip(bounds, buckets):
+                    running += count
+                    lines.append('sweather_stage_seconds_bucket{stage="%s",le="%s"} %d'
+                                 % (stage, bound, running))
+                lines.append('sweather_stage_seconds_sum{stage="%s"} %.9f' % (stage, total))
+                lines.append('sweather_stage_seconds_count{stage="%s"} %d' % (stage, running))
+            names = sorted(set(name for name, labels in self.counters))
+            for name in names:
+                lines.append("# TYPE sweather_%s_total counter" % name)
+                for (other, labels), value in sorted(self.counters.items()):
+                    if(other == name):
+                        lines.append("sweather_%s_total{%s} %d"
+                                     % (name, label_text(labels), value))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Writes the Prometheus text to path, all at once so the
+           node exporter never reads half a file"""
+        with open(path + ".tmp", "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(path + ".tmp", path)
+
+    def export_textfile(self, path, interval=METRICS_INTERVAL):
+        """Turns the metrics on and writes them to path every
+           interval seconds, on a background thread"""
+        self.enabled = True
+        def run():
+            while(True):
+                time.sleep(interval)
+                try:
+                    self.write_textfile(path)
+                except OSError as problem:
+                    print("Couldn't write the metrics to " + path +
+                          " (" + repr(problem) + ")")
+        writer = threading.Thread(target=run)
+        writer.daemon = True
+        writer.start()
+
+    def serve(self, port):
+        """Turns the metrics on and serves them on localhost:port,
+           at /metrics (Prometheus text) and /metrics.json"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        self.enabled = True
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if(self.path == "/metrics"):
+                    body = metrics.prometheus_text().encode("utf-8")
+                    kind = "text/plain; version=0.0.4"
+                elif(self.path == "/metrics.json"):
+                    body = json.dumps(metrics.as_dict()).encode("utf-8")
+                    kind = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", kind)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        server.daemon_threads = True
+        serving = threading.Thread(target=server.serve_forever)
+        serving.daemon = True
+        serving.start()
+        return server
+
+metrics = Metrics()
     
+#--------------------- WEATHER CODE COLORS ----------------------#
+
+# W_CODES is compiled into a palette with one row per possible code
+#  (they are all 3 digits), so the colors for a whole forecast come
+#  from a single numpy indexing operation instead of a dict lookup per
+#  pixel, and a code that isn't in W_CODES gets unknown_code instead
+#  of raising a KeyError.
+
+def compile_code_palette(codes, fallback):
+    """Returns a (1000, 3) array of the colors in codes (a dict like
+       W_CODES), indexed by code, fallback for every other code"""
+    palette = np.empty((1000, 3), dtype=np.uint8)
+    palette[:] = fallback
+    for code, (color, description) in codes.items():
+        palette[code] = color
+    return palette
+
+#Row 0 is never a weather code, so it holds the fallback color
+W_CODE_PALETTE = compile_code_palette(W_CODES, unknown_code)
+
+def weather_code_colors(codes):
+    """Returns the colors of a sequence of N weather codes as an
+       (N, 3) array, unknown codes are unknown_code"""
+    codes = np.asarray(codes, dtype=np.intp)
+    known = (codes > 0) & (codes < len(W_CODE_PALETTE))
+    return W_CODE_PALETTE[np.where(known, codes, 0)]
+
+#------------------------- COLOR BANDS --------------------------#
+
+# The temperature, humidity and pressure colors come from band tables:
+#  sorted band edges, and a palette with one more color than there are
+#  edges. A whole array of readings is colored with one np.searchsorted
+#  call. The edges and units can be changed in CONFIG_FILE (see
+#  BAND_DEFAULTS for the settings) without touching the code, e.g.
+#
+#  [temperature]
+#  unit = C
+#  edges = >0.5, 4.5, 10, 15.5, 26.5
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "sWeather.cfg")
+
+def read_config(path=CONFIG_FILE):
+    """Returns the config file at path, parsed (empty if there is no
+       such file). It is read once, into CONFIG"""
+    config = configparser.ConfigParser()
+    config.read(path) #Skipped if there is no such file
+    return config
+
+CONFIG = read_config()
+
+#Band: (unit, edges, colors from the lowest band up). Each edge is the
+# lowest reading in the band above it, or if it starts with ">", the
+# band above it starts just above the edge
+BAND_DEFAULTS = {
+    "temperature": ("F", ">33, 40, 50, 60, 80",
+                    [freezing, very_cold, cold, almost_ok, ok, hot]),
+    "humidity": ("%", "55, >65", [humi_low, humi_ok, humi_hi]),
+    "pressure": ("hPa", "979, >1027", [pres_low, pres_ok, pres_hi]),
+    }
+
+#Converts readings (degrees F, relative %, millibars) to each unit
+BAND_UNITS = {
+    "temperature": {"F": lambda f: f,
+                    "C": lambda f: (f - 32) * 5 / 9},
+    "humidity": {"%": lambda h: h},
+    "pressure": {"hPa": lambda p: p,
+                 "mbar": lambda p: p,
+                 "inHg": lambda p: p * 0.02953},
+    }
+
+class ColorBands(object):
+    """Colors readings by the band they fall in"""
+
+    def __init__(self, edges, colors, convert=None, fallback=no_reading):
+        """edges as in BAND_DEFAULTS (a string or a list), convert
+           turns readings into the unit the edges are in"""
+        if(isinstance(edges, str)):
+            edges = [edge.strip() for edge in edges.split(",")]
+        bounds = []
+        for edge in edges:
+            edge = str(edge)
+            if(edge.startswith(">")):
+                bounds.append(np.nextafter(float(edge[1:]), np.inf))
+            else:
+                bounds.append(float(edge))
+        self.edges = np.array(bounds)
+        if(len(colors) != len(self.edges) + 1 or
+           np.any(np.diff(self.edges) <= 0)):
+            raise ValueError("Bands need increasing edges and one more "
+                             "color than edges: " + str(edges))
+        #The fallback color goes last, for readings that are NaN
+        self.palette = np.array(list(colors) + [fallback], dtype=np.uint8)
+        self.convert = convert
+
+    def colors(self, readings):
+        """Returns the colors of an array of N readings, shape (N, 3)"""
+        readings = np.asarray(readings, dtype=float)
+        if(self.convert is not None):
+            readings = self.convert(readings)
+        index = np.searchsorted(self.edges, readings, side="right")
+        index[np.isnan(readings)] = len(self.palette) - 1
+        return self.palette[index]
+
+def load_color_bands(config=CONFIG):
+    """Builds the ColorBands in BAND_DEFAULTS, with any unit and
+       edges settings from config. A band whose settings don't work
+       keeps its defaults"""
+    bands = {}
+    for name, (unit, edges, colors) in BAND_DEFAULTS.items():
+        if(config.has_section(name)):
+            try:
+                unit_set = config.get(name, "unit", fallback=unit)
+                if(unit_set not in BAND_UNITS[name]):
+                    raise ValueError("unknown unit: " + unit_set)
+                bands[name] = ColorBands(
+                    config.get(name, "edges", fallback=edges), colors,
+                    BAND_UNITS[name][unit_set])
+                continue
+            except (ValueError, configparser.Error) as problem:
+                print("Had some trouble reading the " + name + " bands in " +
+                      CONFIG_FILE + " at time: " + str(time.time()) +
+                      " (" + repr(problem) + "), using the defaults")
+        bands[name] = ColorBands(edges, colors, BAND_UNITS[name][unit])
+    return bands
+
+COLOR_BANDS = load_color_bands()
+
+def temperature_colors(temps):
+    """Colors for an array of temperatures in degrees F"""
+    return COLOR_BANDS["temperature"].colors(temps)
+
+def humidity_colors(humis):
+    """Colors for an array of relative humidities in %"""
+    return COLOR_BANDS["humidity"].colors(humis)
+
+def pressure_colors(pressures):
+    """Colors for an array of air pressures in millibars"""
+    return COLOR_BANDS["pressure"].colors(pressures)
+
+#----------------------- FRAME COMPOSITOR -----------------------#
+
+# Every hat.set_pixel call rewrites the led matrix framebuffer, so a
+#  view drawn pixel by pixel is slow and you can watch it being drawn.
+#  Views are composed in memory as an 8x8x3 array (rows, columns, RGB)
+#  instead, and sent to the hat with a single set_pixels call.
+
+class Frame(object):
+    """An in-memory led matrix that can be drawn on like the hat and
+       then shown all at once with show_frame"""
+
+    def __init__(self, pixels=None, color=black):
+        self.pixels = np.zeros((8, 8, 3), dtype=np.uint8)
+        if pixels is None:
+            self.pixels[:, :] = color
+        else:
+            self.set_pixels(pixels)
+
+    def set_pixel(self, x, y, color):
+        """Sets the pixel at column x, row y (top left = 0,0)"""
+        self.pixels[y, x] = color
+
+    def set_pixels(self, pixels):
+        """Replaces the whole frame with 64 [R,G,B] pixels
+           (a list like screen_main, or an 8x8x3 array)"""
+        self.pixels[:, :] = np.asarray(pixels, dtype=np.uint8).reshape(8, 8, 3)
+
+    def fill_row(self, y, color, start=0, stop=8):
+        """Fills row y from column start up to (not including) stop"""
+        self.pixels[y, start:stop] = color
+
+    def clear(self, color=black):
+        """Fills the whole frame with one color"""
+        self.pixels[:, :] = color
+
+    def draw_sprite(self, mask, color):
+        """Sets every pixel that is lit in an 8x8 boolean mask to color"""
+        self.pixels[mask] = color
+
+    def copy(self):
+        """Returns a new Frame with the same pixels"""
+        return Frame(self.pixels)
+
+    def to_list(self):
+        """Returns the frame as the list of 64 [R,G,B] pixels
+           that hat.set_pixels expects"""
+        return self.pixels.reshape(64, 3).tolist()
+
+# Most refreshes draw exactly what is already on the screen, so the
+#  renderer keeps a copy of the last frame it sent and compares each
+#  new frame against it, row by row. Unchanged frames are not written
+#  at all. The stock hat can only take whole frames, so any change is
+#  one set_pixels call; a hat that also has set_rows(pixels, rows)
+#  is handed the frame's pixels as they are, and only the rows that
+#  changed (all of them for the first frame) are written.
+#
+# How many frames each view wrote and skipped, and how many pixels it
+#  wrote, are kept in the renderer's counters, and exported with the
+#  other metrics (see METRICS) as sweather_frames_written_total,
+#  sweather_frames_skipped_total and sweather_pixels_written_total,
+#  labelled with the view.
+#
+# Once the event loop is going, frames are handed to the renderer's
+#  task instead of being written by whoever drew them, and a frame
+#  that is replaced before the task gets to it is never written.
+
+class FrameRenderer(object):
+    """Shows frames on one hat, skipping the device write for anything
+       that is already on the screen"""
+
+    def __init__(self, hat):
+        self.hat = hat
+        #Pixels of the last frame sent (None if unknown)
+        self.last = None
+        #Per view: frames_written, frames_skipped, pixels_written
+        self.counters = {}
+        #The renderer task and the (frame, view) waiting for it, see start
+        self.task = None
+        self.pending = None
+        self.pending_event = None
+
+    def show(self, frame, view="other"):
+        """Writes the rows of frame that differ from the screen,
+           returns the number of pixels written"""
+        counts = self.counters.setdefault(view, {"frames_written": 0,
+                                                 "frames_skipped": 0,
+                                                 "pixels_written": 0})
+        pixels = frame.pixels
+        if(self.last is None):
+            dirty_rows = np.arange(8)
+        else:
+            dirty_rows = np.flatnonzero((pixels != self.last).any(axis=(1, 2)))
+
+        if(len(dirty_rows) == 0):
+            counts["frames_skipped"] += 1
+            metrics.count("frames_skipped", view=view)
+            return 0
+
+        with metrics.timer("pixel_write"):
+            set_rows = getattr(self.hat, "set_rows", None)
+            if(set_rows is not None):
+                set_rows(pixels, dirty_rows)
+                written = len(dirty_rows) * 8
+            else:
+                self.hat.set_pixels(frame.to_list())
+                written = 64
+        self.last = pixels.copy()
+        counts["frames_written"] += 1
+        counts["pixels_written"] += written
+        metrics.count("frames_written", view=view)
+        metrics.count("pixels_written", written, view=view)
+        return written
+
+    def forget(self):
+        """Call after drawing on the hat without the renderer (clear,
+           show_message...), so the next frame is written in full"""
+        self.last = None
+
+    def start(self):
+        """Starts the renderer task on the running event loop, frames
+           are then written by it (see present)"""
+        self.pending_event = asyncio.Event()
+        self.task = asyncio.ensure_future(self._run())
+
+    def present(self, frame, view="other"):
+        """Hands a copy of frame to the renderer task, replacing any
+           frame still waiting to be written"""
+        if(self.pending is not None):
+            metrics.count("frames_replaced", view=self.pending[1])
+        self.pending = (frame.copy(), view)
+        self.pending_event.set()
+
+    async def _run(self):
+        """Renderer task"""
+        while(True):
+            await self.pending_event.wait()
+            self.pending_event.clear()
+            frame, view = self.pending
+            self.pending = None
+            try:
+                self.show(frame, view)
+            except Exception as problem:
+                #The next frame still gets drawn, in full as whatever
+                # is on the screen now is unknown
+                print("Had some trouble drawing " + view + " at time: " +
+                      str(time.time()) + " (" + repr(problem) + ")")
+                metrics.count("frame_failures", view=view)
+                self.forget()
+
+#One renderer per hat, shared by every view drawn on that hat
+renderers = {}
+
+def get_renderer(hat):
+    """Returns the FrameRenderer for hat"""
+    if hat not in renderers:
+        renderers[hat] = FrameRenderer(hat)
+    return renderers[hat]
+
+def show_frame(hat, frame, view="other"):
+    """Shows a whole frame on the led matrix, in at most one
+       device write, and none if it is already showing. Once the
+       renderer task is running the write is left to it"""
+    renderer = get_renderer(hat)
+    if(renderer.task is not None):
+        return renderer.present(frame, view)
+    return renderer.show(frame, view)
+
+#The main screen view, copied for each main menu redraw
+main_frame = Frame(screen_main)
+
 #-----------------------MINI MENU IMAGES-----------------------#
 
-# It was a creative choice to set individual pixels; that and for
-#  explicit clarity so that others can understand what I did.
-
-def show_outdoor_hud_image(hat):
-    """Shows the mini image for the outdoor HUD display
-        when navigating the main menu"""
-    letter_color = color_indices[curr_x]
-    #The letter "O" located in the top left corner
-    hat.set_pixel(0,1,letter_color)
-    hat.set_pixel(1,1,letter_color)
-    hat.set_pixel(2,1,letter_color)
-    hat.set_pixel(0,2,letter_color)
-    hat.set_pixel(2,2,letter_color)
-    hat.set_pixel(0,3,letter_color)
-    hat.set_pixel(2,3,letter_color)
-    hat.set_pixel(0,4,letter_color)
-    hat.set_pixel(1,4,letter_color)
-    hat.set_pixel(2,4,letter_color)
-    #The letter "H" located in the bottom right corner
-    hat.set_pixel(4,4,letter_color)
-    hat.set_pixel(6,4,letter_color)
-    hat.set_pixel(4,5,letter_color)
-    hat.set_pixel(6,5,letter_color)
-    hat.set_pixel(4,6,letter_color)
-    hat.set_pixel(5,6,letter_color)
-    hat.set_pixel(6,6,letter_color)
-    hat.set_pixel(4,7,letter_color)
-    hat.set_pixel(6,7,letter_color)
-
-
-def show_indoor_hud_image(hat):
-    """Shows the mini image for the indoor HUD display
-        when navigating the main menu"""
-    letter_color = color_indices[curr_x]    
-    #The letter "I" located in the top left corner
-    hat.set_pixel(0,1,letter_color)
-    hat.set_pixel(1,1,letter_color)
-    hat.set_pixel(2,1,letter_color)  
-    hat.set_pixel(1,2,letter_color)
-    hat.set_pixel(1,3,letter_color)
-    hat.set_pixel(0,4,letter_color)
-    hat.set_pixel(1,4,letter_color)
-    hat.set_pixel(2,4,letter_color)
-    #The letter "H" located in the bottom right corner
-    hat.set_pixel(4,4,letter_color)
-    hat.set_pixel(6,4,letter_color)
-    hat.set_pixel(4,5,letter_color)
-    hat.set_pixel(6,5,letter_color)
-    hat.set_pixel(4,6,letter_color)
-    hat.set_pixel(5,6,letter_color)
-    hat.set_pixel(6,6,letter_color)
-    hat.set_pixel(4,7,letter_color)
-    hat.set_pixel(6,7,letter_color)
-
-def show_3h_readout_image(hat):
-    """Shows the mini image for the 3-hour forecast readout
-       when navigating the main menu"""
-    letter_color = color_indices[curr_x]
-    #The number "3" in the top left corner of the screen
-    hat.set_pixel(0,1,letter_color)
-    hat.set_pixel(1,1,letter_color)
-    hat.set_pixel(2,1,letter_color)
-    hat.set_pixel(2,2,letter_color)
-    hat.set_pixel(0,3,letter_color)
-    hat.set_pixel(1,3,letter_color)
-    hat.set_pixel(2,3,letter_color)
-    hat.set_pixel(2,4,letter_color)
-    hat.set_pixel(0,5,letter_color)
-    hat.set_pixel(1,5,letter_color)
-    hat.set_pixel(2,5,letter_color)
-    #The letter "H" located in the bottom right corner
-    hat.set_pixel(4,4,letter_color)
-    hat.set_pixel(6,4,letter_color)
-    hat.set_pixel(4,5,letter_color)
-    hat.set_pixel(6,5,letter_color)
-    hat.set_pixel(4,6,letter_color)
-    hat.set_pixel(5,6,letter_color)
-    hat.set_pixel(6,6,letter_color)
-    hat.set_pixel(4,7,letter_color)
-    hat.set_pixel(6,7,letter_color)
-
-def show_8d_readout_image(hat):
-    """Shows the mini image for the 8-day forecast readout
-       when navigating the main menu"""
-    letter_color = color_indices[curr_x]
-    #The number "3" in the top left corner of the screen
-    hat.set_pixel(0,1,letter_color)
-    hat.set_pixel(1,1,letter_color)
-    hat.set_pixel(2,1,letter_color)
-    hat.set_pixel(0,2,letter_color)
-    hat.set_pixel(2,2,letter_color)
-    hat.set_pixel(0,3,letter_color)
-    hat.set_pixel(1,3,letter_color)
-    hat.set_pixel(2,3,letter_color)
-    hat.set_pixel(0,4,letter_color)
-    hat.set_pixel(2,4,letter_color)
-    hat.set_pixel(0,5,letter_color)
-    hat.set_pixel(1,5,letter_color)
-    hat.set_pixel(2,5,letter_color)
-    #The letter "H" located in the bottom right corner
-    hat.set_pixel(4,4,letter_color)
-    hat.set_pixel(5,4,letter_color)
-    hat.set_pixel(4,5,letter_color)
-    hat.set_pixel(6,5,letter_color)
-    hat.set_pixel(4,6,letter_color)
-    hat.set_pixel(5,7,letter_color)
-    hat.set_pixel(6,6,letter_color)
-    hat.set_pixel(4,7,letter_color)
+# It was a creative choice to draw these pixel by pixel; that and for
+#  explicit clarity so that others can understand what I did. Each
+#  image is drawn as text below ("#" is a lit pixel, "." is off) and
+#  compiled once, at startup, into an 8x8 mask. display_option tints
+#  the mask with the menu color and lays it over the main screen.
+
+def compile_sprite(rows):
+    """Turns 8 strings of 8 characters ("#" lit, "." off)
+       into an 8x8 boolean mask"""
+    mask = np.array([[c == "#" for c in row] for row in rows], dtype=bool)
+    if(mask.shape != (8, 8)):
+        raise ValueError("Sprites must be 8 rows of 8 pixels")
+    return mask
+
+def check_sprite(sprite):
+    """Returns a Mode's sprite as an 8x8 boolean mask, compiling it
+       if it is 8 strings (None stays None). Raises ValueError for
+       anything else, which couldn't be drawn on the menu"""
+    if(sprite is None):
+        return None
+    if(isinstance(sprite, (list, tuple))):
+        return compile_sprite(sprite)
+    if(not isinstance(sprite, np.ndarray) or sprite.shape != (8, 8) or
+       sprite.dtype != bool):
+        raise ValueError("Sprites must be 8 rows of 8 pixels, or an 8x8 "
+                         "boolean mask, not " + repr(sprite))
+    return sprite
+
+#The mini image for each main menu position, row 0 is left
+# clear for the menu bar
+MENU_SPRITES = {
+    #Outdoor HUD: the letter "O" located in the top left
+    # corner, and "H" located in the bottom right corner
+    0: compile_sprite([
+        "........",
+        "###.....",
+        "#.#.....",
+        "#.#.....",
+        "###.#.#.",
+        "....#.#.",
+        "....###.",
+        "....#.#.",
+        ]),
+    #Indoor HUD: "I" and "H"
+    1: compile_sprite([
+        "........",
+        "###.....",
+        ".#......",
+        ".#......",
+        "###.#.#.",
+        "....#.#.",
+        "....###.",
+        "....#.#.",
+        ]),
+    #3-hour forecast readout: "3" and "H"
+    2: compile_sprite([
+        "........",
+        "###.....",
+        "..#.....",
+        "###.....",
+        "..#.#.#.",
+        "###.#.#.",
+        "....###.",
+        "....#.#.",
+        ]),
+    #8-day forecast readout: "8" and "D"
+    3: compile_sprite([
+        "........",
+        "###.....",
+        "#.#.....",
+        "###.....",
+        "#.#.##..",
+        "###.#.#.",
+        "....#.#.",
+        "....##..",
+        ]),
+    #City HUD: "C" and "H"
+    4: compile_sprite([
+        "........",
+        "###.....",
+        "#.......",
+        "#.......",
+        "###.#.#.",
+        "....#.#.",
+        "....###.",
+        "....#.#.",
+        ]),
+    #Trends: "T" and "R"
+    5: compile_sprite([
+        "........",
+        "###.....",
+        ".#......",
+        ".#......",
+        ".#..##..",
+        "....#.#.",
+        "....##..",
+        "....#.#.",
+        ]),
+    }
 
 #------------ MISC FUNCTIONS ---------------#
 
@@ -403,7 +896,8 @@ def get_observation(city_id, owm):
     global latest_obs_time
 
     #Get latest observation
-    obs = owm.weather_at_id(city_id)
+    with metrics.timer("owm_observation"):
+        obs = owm.weather_at_id(city_id)
 
     #Get the weather object
     w = obs.get_weather()
@@ -417,18 +911,12 @@ def get_observation(city_id, owm):
 
 def utc_to_eastern(utc_datetime):
     """Change a UTC timezone to US/Eastern Time"""
+    from pytz import timezone
     return utc_datetime.astimezone(timezone('US/Eastern'))               
 
-def show_main_screen(hat):
-    """Shows the main screen view"""
-    global screen_main
-    hat.clear()
-    hat.set_pixels(screen_main)
-
 def return_to_main_menu(hat, curr_x):
     """Takes appropriate steps to return to the main menu view"""
     display_option(curr_x,hat,color_indices)
-    hat.set_pixel(curr_x,0,grey)#Reset the cursor pixel
     
 def clamp(value, min_value=0, max_value=7):
     """Restrain and bound values"""
@@ -438,49 +926,34 @@ def clamp(value, min_value=0, max_value=7):
         value = 0
     return min(max_value, max(min_value, value))
               
-def check_stick_events(hat, curr_x):
+def check_stick_events(events):
     """For reacting to stick events during main menu
-       view navigation"""
-    global program_state
-    for event in hat.stick.get_events():
+       view navigation. Returns the menu slot of the
+       mode to run (see mode_registry), or None"""
+    for event in events:
         #print(event)#FOR DEBUGGING STICK EVENTS
         if(event.action == "pressed"):
             if(event.direction == "left" or event.direction == "right"):
                 move_cursor(event)
             elif(event.direction == "middle"):
-                if(curr_x == 0):#If the first program loop is selected
-                    program_state = 1 #Running outdoor hud
-                elif(curr_x == 1):#If the second program loop is slected
-                    program_state = 2 #Running indoor hud
-                elif(curr_x == 2):#If the 3rd program loop is slected
-                    program_state = 3 #Running 3 hour readout
-                elif(curr_x == 3):#If the 4th program loop is slected
-                    program_state = 4 #Running 8 day readout
-
-def check_stick_events_2(hat):
-    """Check stick events specifically for sub programs
-       and returning to the main menu"""
-    for event in hat.stick.get_events():
-        #print(event)#FOR DEBUGGING STICK EVENTS
-        if(event.action == "pressed"):
-            if(event.direction == "up"):
-                return True
-    return False
+                if(curr_x in mode_registry):#If a program loop is selected
+                    return curr_x
+    return None
                 
 def move_cursor(event):
     """Moves the grey cursor pixel across the top of
        the led matrix to aid in program loop selection"""
     global curr_x, hat, color_indices
     if event.action in ('pressed'):
+        # The old cursor pixel doesn't need to be reset, since
+        #  display_option redraws the whole menu bar
         if(curr_x != 8):
-            hat.set_pixel(curr_x,0,color_indices[curr_x])
             curr_x = clamp(curr_x + {
                 'left': -1,
                 'right': 1,
                 }.get(event.direction, 0))
-        else:
-            #Should only happen on startup of this screen
-            hat.set_pixel(0,0,grey)#Place cursor at top left pixel
+        #Else should only happen on startup of this screen, the cursor
+        # is placed at the top left pixel below
             
     #Wrap around to other side when navigating main menu
     if curr_x == -1:
@@ -494,220 +967,1645 @@ def display_option(curr_x,hat,color_indices):
     """Display the current main menu selection's
        associated mini image as defined by the functions
        herein"""
-    show_main_screen(hat)
-    #Show the appropriate image for the menu selection
-    if(curr_x == 0):
-        show_outdoor_hud_image(hat)
-    elif(curr_x == 1):
-        show_indoor_hud_image(hat)
-    elif(curr_x == 2):
-        show_3h_readout_image(hat)
-    elif(curr_x == 3):
-        show_8d_readout_image(hat)
+    #Start from the main screen view
+    frame = main_frame.copy()
+    #Draw the appropriate image for the menu selection, in the
+    # color of its menu bar pixel
+    sprite = mode_registry.sprite(curr_x)
+    if(sprite is not None):
+        frame.draw_sprite(sprite, color_indices[curr_x])
+    #The grey cursor pixel on the menu bar
+    frame.set_pixel(curr_x,0,grey)
+    show_frame(hat, frame, "main menu")
+
+#-------------------------- OWM CLIENT --------------------------#
+
+# The client itself is in owm_client.py, which is only imported when
+#  the first request is sent (pyowm and requests are slow to import),
+#  so the welcome animation can start straight away.
+
+def get_owm():
+    """Returns the OWM client that every request is sent with"""
+    import owm_client
+    if(metrics.enabled):
+        owm_client.owm_http.on_request = metrics.record_request
+    #A connection for each thread that sends requests
+    return owm_client.get_owm(API_KEY, len(FETCHERS) + REFRESH_WORKERS)
+
+def request_timings():
+    """Returns the latest requests as (url path, seconds, status code)"""
+    import owm_client
+    return owm_client.request_timings()
+
+#------------------------ FORECAST STORE ------------------------#
+
+# pyowm hands back a weather object per forecast time, and the views
+#  used to call its getters again for every pixel on every refresh.
+#  Now each download is read once into a ForecastTable: a numpy
+#  structured array with one row per forecast time (a single row for
+#  the current conditions) and one column per value, which every view
+#  and readout reads from. The detailed status texts are kept once,
+#  in STATUS_TEXTS, and the rows only hold their index.
+
+FORECAST_DTYPE = np.dtype([("time", "<i8"),     #Unix time, UTC
+                           ("code", "<i2"),     #Weather condition code
+                           ("temp", "<f4"),     #Degrees F
+                           ("humidity", "<f4"), #Relative %
+                           ("pressure", "<f4"), #Millibars
+                           ("wind", "<f4"),     #Wind speed, meters/sec
+                           ("status", "<u2")])  #Index in STATUS_TEXTS
+
+#Every detailed status text seen so far, and the index of each
+STATUS_TEXTS = []
+status_indices = {}
+status_lock = threading.Lock()
+
+def status_index(text):
+    """Returns the index of a detailed status text in STATUS_TEXTS"""
+    with status_lock:
+        if(text not in status_indices):
+            status_indices[text] = len(STATUS_TEXTS)
+            STATUS_TEXTS.append(text)
+        return status_indices[text]
+
+class ForecastTable(object):
+    """The weather data from one download, in columns"""
+    __slots__ = ("rows", "fetched")
+
+    def __init__(self, rows, fetched):
+        self.rows = rows       #A FORECAST_DTYPE array
+        self.fetched = fetched #Unix time it was downloaded
+
+    @classmethod
+    def from_weathers(cls, weathers, fetched):
+        """Reads a sequence of pyowm weather objects"""
+        weathers = list(weathers)
+        rows = np.zeros(len(weathers), dtype=FORECAST_DTYPE)
+        with metrics.timer("forecast_table"):
+            for i, weather in enumerate(weathers):
+                temps = weather.get_temperature('fahrenheit')
+                rows[i] = (weather.get_reference_time(),
+                           weather.get_weather_code(),
+                           #Daily forecasts have no "temp", only "day", "night"...
+                           temps.get("temp", temps.get("day")),
+                           weather.get_humidity(),
+                           weather.get_pressure()["press"],
+                           weather.get_wind().get("speed", np.nan),
+                           status_index(weather.get_detailed_status()))
+        return cls(rows, fetched)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def row(self, i):
+        """Row i as a one row table, sharing this table's memory"""
+        return ForecastTable(self.rows[i:i + 1], self.fetched)
+
+    def __getitem__(self, column):
+        """A whole column, e.g. table["temp"]"""
+        return self.rows[column]
+
+    def dates(self):
+        """The forecast times as UTC datetimes"""
+        return [datetime.datetime.fromtimestamp(t, datetime.timezone.utc)
+                for t in self.rows["time"].tolist()]
+
+    def statuses(self):
+        """The detailed status texts"""
+        return [STATUS_TEXTS[i] for i in self.rows["status"].tolist()]
+
+    def staleness(self):
+        """How long ago this was downloaded, in seconds"""
+        return time.time() - self.fetched
+
+#---------------------- REQUEST SCHEDULER -----------------------#
+
+# The free OWM plan is throttled per api key, and several of these can
+#  share a key. Every request the cache sends goes through here first:
+#  it has to take a token from its key's budget, a request for the same
+#  city and endpoint that is already being sent is waited on instead
+#  of sent again, and after a failure that city and endpoint is left
+#  alone for a while, twice as long after each failure in a row (with
+#  some randomness so units sharing a key don't all retry together).
+#  A request that isn't sent raises RequestDeferred, and the cache
+#  answers it with the data it already has, however old.
+
+#Requests each unit may send per minute (the free plan allows 60 a
+# minute per key, this leaves room for a second unit on the same key)
+REQUESTS_PER_MINUTE = 30
+#How many requests can be sent at once after a quiet spell
+REQUEST_BURST = 6
+#Seconds to leave an endpoint alone after its first failure,
+# doubled for each failure after that, up to BACKOFF_MAX
+BACKOFF_BASE = 10
+BACKOFF_MAX = 900
+
+class RequestDeferred(Exception):
+    """A request that was not sent, because of the request budget or
+       because its endpoint is backing off after failures"""
+    pass
+
+class RequestBudget(object):
+    """Token bucket, refilled at per_minute tokens a minute"""
+
+    def __init__(self, per_minute=REQUESTS_PER_MINUTE, burst=REQUEST_BURST):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, patience=0):
+        """Takes a token, waiting up to patience seconds for one.
+           Returns False if there is none"""
+        give_up = time.time() + patience
+        while(True):
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.refilled) * self.rate)
+                self.refilled = now
+                if(self.tokens >= 1):
+                    self.tokens -= 1
+                    return True
+                #Until the next token
+                wait = (1 - self.tokens) / self.rate
+            if(now + wait > give_up):
+                return False
+            time.sleep(wait)
+
+#One budget per api key
+request_budgets = {}
+
+def get_request_budget(api_key):
+    """Returns the RequestBudget for api_key"""
+    if api_key not in request_budgets:
+        request_budgets[api_key] = RequestBudget()
+    return request_budgets[api_key]
+
+class RequestScheduler(object):
+    """Decides whether a request is sent"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        #How long requests sent from the current thread may wait for
+        # the budget, see patiently
+        self.local = threading.local()
+        #(city id, endpoint): Future of the request being sent
+        self.inflight = {}
+        #(city id, endpoint): [failures in a row, time to retry at]
+        self.backoff = {}
+        self.lock = threading.Lock()
+
+    def request(self, city_id, endpoint, fetch):
+        """Returns fetch(), or the result of the same request if it is
+           already being sent. Raises RequestDeferred if it can't be
+           sent now, and whatever fetch() raised if it failed"""
+        key = (city_id, endpoint)
+        with self.lock:
+            running = self.inflight.get(key)
+            sending = running is None
+            if(sending):
+                failures, retry_at = self.backoff.get(key, (0, 0))
+                if(time.time() < retry_at):
+                    metrics.count("requests_deferred", endpoint=endpoint,
+                                  reason="backoff")
+                    raise RequestDeferred("%s backing off for %.0f s after "
+                                          "%d failures" % (endpoint,
+                                          retry_at - time.time(), failures))
+                running = Future()
+                self.inflight[key] = running
+        if(not sending):
+            metrics.count("requests_coalesced", endpoint=endpoint)
+            return running.result()
+
+        #Not holding the lock, a background request can wait minutes
+        # for a token and the others mustn't wait with it
+        if(not self.budget.take(getattr(self.local, "patience", 0))):
+            with self.lock:
+                del self.inflight[key]
+            metrics.count("requests_deferred", endpoint=endpoint,
+                          reason="budget")
+            problem = RequestDeferred("over the request budget")
+            running.set_exception(problem)
+            raise problem
+
+        try:
+            data = fetch()
+        except Exception as problem:
+            with self.lock:
+                failures = self.backoff.get(key, (0, 0))[0] + 1
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (failures - 1))
+                #Between half and all of the delay
+                delay = delay / 2 + random.uniform(0, delay / 2)
+                self.backoff[key] = (failures, time.time() + delay)
+                del self.inflight[key]
+            metrics.count("backoffs", endpoint=endpoint)
+            running.set_exception(problem)
+            raise
+        with self.lock:
+            self.backoff.pop(key, None)
+            del self.inflight[key]
+        running.set_result(data)
+        return data
+
+    def backing_off(self):
+        """Returns {(city id, endpoint): seconds until its retry}"""
+        now = time.time()
+        with self.lock:
+            return dict((key, retry_at - now) for key, (failures, retry_at)
+                        in self.backoff.items() if retry_at > now)
+
+#------------------------ FORECAST CACHE ------------------------#
+
+# The outdoor HUD and both readouts need the same data, and used to
+#  download it again every time they were entered. Everything they
+#  get from OWM is kept here, by (city id, endpoint), until it is
+#  older than that endpoint's TTL, so switching between modes shows
+#  the data straight away without using up requests from the api key.
+
+#How long each kind of data is kept before it is requested again
+CACHE_TTL = {"observation": 600, #Current conditions, 10 min
+             "3h": 1800,         #3 hour forecast, 30 min
+             "daily": 3600}      #Daily forecast, 1 hour
+
+class ForecastCache(object):
+    """Data requested from OWM, by city id and endpoint"""
+
+    def __init__(self, ttl=CACHE_TTL, snapshot_file=None, requests=None):
+        self.ttl = dict(ttl)
+        #The RequestScheduler every fetch goes through, if any
+        self.requests = requests
+        #Where to save the latest data, see save_snapshot
+        self.snapshot_file = snapshot_file
+        #(city id, endpoint): (time fetched, data)
+        self.entries = {}
+        #Whether entries has changed since it was last saved
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+        #Requests for different endpoints run on separate threads
+        self.lock = threading.Lock()
+
+    def get(self, city_id, endpoint, fetch):
+        """Returns the cached data if it is newer than the endpoint's
+           TTL, otherwise calls fetch() and caches what it returns"""
+        key = (city_id, endpoint)
+        with self.lock:
+            entry = self.entries.get(key)
+            if(entry is not None and time.time() - entry[0] < self.ttl[endpoint]):
+                self.hits += 1
+                metrics.count("cache_hits", endpoint=endpoint)
+                return entry[1]
+            self.misses += 1
+        metrics.count("cache_misses", endpoint=endpoint)
+        #Not holding the lock while waiting on the network
+        try:
+            if(self.requests is None):
+                data = fetch()
+            else:
+                data = self.requests.request(city_id, endpoint, fetch)
+        except RequestDeferred:
+            if(entry is None):
+                raise
+            return entry[1] #Old, but better than nothing
+        with self.lock:
+            self.entries[key] = (time.time(), data)
+            self.changed = True
+        return data
+
+    def store(self, endpoint, by_city):
+        """Caches {city id: data} for endpoint, fetched just now"""
+        fetched = time.time()
+        with self.lock:
+            for city_id, data in by_city.items():
+                self.entries[(city_id, endpoint)] = (fetched, data)
+            self.changed = True
+
+    def peek(self, city_id, endpoint):
+        """Returns (data, is_stale) without fetching anything, data
+           is None if nothing is cached"""
+        with self.lock:
+            entry = self.entries.get((city_id, endpoint))
+        if(entry is None):
+            return None, True
+        return entry[1], time.time() - entry[0] >= self.ttl[endpoint]
+
+    def invalidate(self, city_id=None, endpoint=None):
+        """Drops cached data so it is requested again next time,
+           for one city and/or endpoint, or everything"""
+        with self.lock:
+            for key in list(self.entries):
+                if((city_id is None or key[0] == city_id) and
+                   (endpoint is None or key[1] == endpoint)):
+                    del self.entries[key]
+
+    def stats(self):
+        """Returns the hit and miss counts"""
+        return {"hits": self.hits, "misses": self.misses}
+
+    def save_snapshot(self, path=None):
+        """Writes every cached table to path (snapshot_file if None),
+           see SNAPSHOT_DTYPE. Does nothing if nothing has changed
+           since the last time. The file is written without holding
+           the lock, so readers don't wait on the SD card"""
+        path = self.snapshot_file if path is None else path
+        with self.lock:
+            if(path is None or not self.changed):
+                return
+            entries = list(self.entries.items())
+            self.changed = False
+        parts = []
+        for (city_id, endpoint), (fetched, table) in entries:
+            part = np.zeros(len(table), dtype=SNAPSHOT_DTYPE)
+            part["city"] = city_id
+            part["endpoint"] = SNAPSHOT_ENDPOINTS.index(endpoint)
+            part["fetched"] = fetched
+            for column in FORECAST_COLUMNS:
+                part[column] = table[column]
+            part["status"] = [text.encode("utf-8")[:32]
+                              for text in table.statuses()]
+            parts.append(part)
+        write_snapshot(path, np.concatenate(parts) if parts else
+                       np.zeros(0, dtype=SNAPSHOT_DTYPE))
+
+    def load_snapshot(self, path):
+        """Fills the cache from a snapshot file, keeping the time each
+           entry was fetched so old data shows up as stale. Returns
+           False if there is no usable snapshot"""
+        snapshot = read_snapshot(path)
+        if(snapshot is None):
+            return False
+        loaded = {}
+        keys = sorted(set(zip(snapshot["city"].tolist(),
+                              snapshot["endpoint"].tolist())))
+        for city_id, endpoint in keys:
+            part = snapshot[(snapshot["city"] == city_id) &
+                            (snapshot["endpoint"] == endpoint)]
+            rows = np.zeros(len(part), dtype=FORECAST_DTYPE)
+            for column in FORECAST_COLUMNS:
+                rows[column] = part[column]
+            rows["status"] = [status_index(text.decode("utf-8", "replace"))
+                              for text in part["status"].tolist()]
+            fetched = float(part["fetched"][0])
+            loaded[(city_id, SNAPSHOT_ENDPOINTS[endpoint])] = \
+                (fetched, ForecastTable(rows, fetched))
+        with self.lock:
+            self.entries.update(loaded)
+        return True
+
+#----------------------- FORECAST SNAPSHOT -----------------------#
+
+# After a reboot (or a crash) the HUD had nothing to show until three
+#  fresh requests came back, which takes a while on flaky wifi. The
+#  cache is saved to a small binary file after every refresh, and
+#  loaded back at startup so the last known data shows in an instant.
+#  The file is an 8 byte header followed by one fixed size row per
+#  forecast table row, with the status as text since STATUS_TEXTS
+#  is only kept while the program runs.
+
+SNAPSHOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "sWeather.snapshot")
+SNAPSHOT_MAGIC = b"sWsnap02"
+#Endpoint names by the index stored in the file
+SNAPSHOT_ENDPOINTS = ("observation", "3h", "daily")
+#The forecast table columns that are stored as they are
+FORECAST_COLUMNS = [name for name in FORECAST_DTYPE.names if name != "status"]
+SNAPSHOT_DTYPE = np.dtype([("city", "<i4"),
+                           ("endpoint", "u1"),
+                           ("fetched", "<f8")] +
+                          [(name, FORECAST_DTYPE[name].str)
+                           for name in FORECAST_COLUMNS] +
+                          [("status", "S32")])
+
+def write_snapshot(path, table):
+    """Atomically replaces the snapshot file at path with table, so
+       a crash or power cut never leaves half a file behind"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(table.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_snapshot(path):
+    """Memory-maps the snapshot file at path and returns a copy of its
+       rows, or None if it is missing or not a snapshot"""
+    try:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if(mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC or
+                   (len(mm) - len(SNAPSHOT_MAGIC)) % SNAPSHOT_DTYPE.itemsize):
+                    return None
+                return np.frombuffer(mm, dtype=SNAPSHOT_DTYPE,
+                                     offset=len(SNAPSHOT_MAGIC)).copy()
+    except (OSError, ValueError):
+        #Missing, unreadable or empty file
+        return None
+
+#Shared by every mode, and saved to the snapshot file
+request_scheduler = RequestScheduler(get_request_budget(API_KEY))
+forecast_cache = ForecastCache(snapshot_file=SNAPSHOT_FILE,
+                               requests=request_scheduler)
+
+def get_current_weather(city_id):
+    """Current conditions as a one row forecast table"""
+    def fetch():
+        with metrics.timer("fetch_observation"):
+            w = get_observation(city_id, get_owm())
+            return ForecastTable.from_weathers([w], time.time())
+    return forecast_cache.get(city_id, "observation", fetch)
+
+def get_daily_forecast(city_id):
+    """Daily forecast for 8 days (includes today), as a forecast table"""
+    def fetch():
+        with metrics.timer("fetch_daily"):
+            fc = get_owm().daily_forecast_at_id(city_id, limit=8)
+            return ForecastTable.from_weathers(fc.get_forecast(), time.time())
+    return forecast_cache.get(city_id, "daily", fetch)
+
+def get_3h_forecast(city_id):
+    """3hr forecast for the next 5 days, as a forecast table"""
+    def fetch():
+        with metrics.timer("fetch_3h"):
+            fc = get_owm().three_hours_forecast_at_id(city_id)
+            return ForecastTable.from_weathers(fc.get_forecast(), time.time())
+    return forecast_cache.get(city_id, "3h", fetch)
+
+#------------------------- FETCH STAGE --------------------------#
+
+# A refresh used to make its three requests one after another, so it
+#  took as long as all three added together. They are sent in parallel
+#  now, and a refresh takes as long as the slowest one. A request that
+#  fails, or hasn't finished by the deadline, doesn't fail the others:
+#  its view uses the last cached data instead (a late answer still
+#  goes into the cache when it arrives). pyowm itself gives up on a
+#  single request that gets no answer within a few seconds.
+
+#The longest a refresh waits for all of its requests, in seconds
+FETCH_DEADLINE = 15
+
+#What each endpoint is requested with
+FETCHERS = {"observation": get_current_weather,
+            "daily": get_daily_forecast,
+            "3h": get_3h_forecast}
+
+fetch_pool = ThreadPoolExecutor(max_workers=len(FETCHERS))
+
+def fetch_all(city_id, endpoints=("daily", "observation", "3h"),
+              deadline=FETCH_DEADLINE):
+    """Requests the endpoints for city_id in parallel, waiting at most
+       deadline seconds. Returns {endpoint: data}, where data is the
+       last cached data (or None) for any endpoint that failed"""
+    futures = dict((endpoint, fetch_pool.submit(FETCHERS[endpoint], city_id))
+                   for endpoint in endpoints)
+    wait_futures(futures.values(), timeout=deadline)
+    results = {}
+    for endpoint, future in futures.items():
+        if(future.done() and future.exception() is None):
+            results[endpoint] = future.result()
+        else:
+            if(future.done()):
+                problem = repr(future.exception())
+            else:
+                problem = "no answer after %g s" % deadline
+            print("Had some trouble getting " + endpoint + " at time: " +
+                  str(time.time()) + " (" + problem + ")")
+            metrics.count("fetch_failures", endpoint=endpoint)
+            results[endpoint] = forecast_cache.peek(city_id, endpoint)[0]
+    return results
+
+#--------------------------- CITIES ----------------------------#
+
+# More cities can be followed by listing their ids in sWeather.cfg:
+#
+#   [cities]
+#   ids = 2643743, 5128581
+#
+#  The current conditions for all of them come from OWM's group
+#  endpoint, up to GROUP_SIZE cities per request, instead of a request
+#  each. Their forecasts are requested in parallel on refresh_pool,
+#  with each request waiting its turn for the api key's budget rather
+#  than being deferred. The conditions from one group request share
+#  one table, so each city adds a few dozen bytes per endpoint.
+
+#The most cities OWM takes in one group request
+GROUP_SIZE = 20
+#How long a background request may wait for the request budget
+REFRESH_PATIENCE = 300
+#The longest a refresh of every city waits for all of its requests,
+# time for one that waited out its patience to still be answered
+REFRESH_DEADLINE = REFRESH_PATIENCE + FETCH_DEADLINE
+
+def load_cities(config=CONFIG):
+    """Returns SomeCity, then the city ids listed under [cities] in
+       config, printing the ones that aren't numbers"""
+    cities = [SomeCity]
+    for city_id in config.get("cities", "ids", fallback="").split(","):
+        if(not city_id.strip()):
+            continue
+        try:
+            city_id = int(city_id)
+        except ValueError:
+            print("Not following city " + city_id.strip() +
+                  " (city ids are numbers)")
+            continue
+        if(city_id not in cities):
+            cities.append(city_id)
+    return cities
+
+CITIES = load_cities()
+
+#Threads the forecasts of all the cities are requested from
+REFRESH_WORKERS = 4
+
+refresh_pool = ThreadPoolExecutor(max_workers=REFRESH_WORKERS)
+
+def patiently(function, *args):
+    """Calls function(*args), letting its requests wait up to
+       REFRESH_PATIENCE for the request budget"""
+    request_scheduler.local.patience = REFRESH_PATIENCE
+    try:
+        return function(*args)
+    finally:
+        request_scheduler.local.patience = 0
+
+def get_current_weathers(city_ids):
+    """Current conditions for many cities, as {city id: one row
+       forecast table}. The ones not cached within the TTL are
+       requested together"""
+    results = {}
+    missing = []
+    for city_id in city_ids:
+        data, is_stale = forecast_cache.peek(city_id, "observation")
+        if(is_stale):
+            missing.append(city_id)
+        else:
+            results[city_id] = data
+    for start in range(0, len(missing), GROUP_SIZE):
+        group = missing[start:start + GROUP_SIZE]
+        def fetch():
+            with metrics.timer("fetch_group"):
+                observations = get_owm().weather_at_ids(group)
+                table = ForecastTable.from_weathers(
+                    [obs.get_weather() for obs in observations], time.time())
+                return dict((obs.get_location().get_ID(), table.row(i))
+                            for i, obs in enumerate(observations))
+        try:
+            by_city = request_scheduler.request(tuple(group), "group", fetch)
+        except RequestDeferred:
+            by_city = {}
+        if(by_city):
+            forecast_cache.store("observation", by_city)
+        results.update(by_city)
+        for city_id in group:
+            if(city_id not in results):
+                #Old, but better than nothing
+                results[city_id] = forecast_cache.peek(city_id, "observation")[0]
+    return results
+
+def fetch_cities(city_ids, endpoints=("daily", "3h"),
+                 deadline=REFRESH_DEADLINE):
+    """Requests the current conditions for all of city_ids, and the
+       endpoints for each, in parallel, waiting at most deadline
+       seconds. Returns True if all of them came in by then (a late
+       answer still goes into the cache when it arrives)"""
+    futures = {("group", "observation"):
+               refresh_pool.submit(patiently, get_current_weathers, city_ids)}
+    for city_id in city_ids:
+        for endpoint in endpoints:
+            futures[(city_id, endpoint)] = refresh_pool.submit(
+                patiently, FETCHERS[endpoint], city_id)
+    wait_futures(futures.values(), timeout=deadline)
+    complete = True
+    for (city_id, endpoint), future in futures.items():
+        if(not future.done()):
+            problem = "no answer after %g s" % deadline
+        elif(future.exception() is not None):
+            problem = repr(future.exception())
+        elif(endpoint == "observation" and None in future.result().values()):
+            problem = "no data for some cities"
+        else:
+            problem = None
+        if(problem is not None):
+            print("Had some trouble getting " + endpoint + " for " +
+                  str(city_id) + " at time: " + str(time.time()) +
+                  " (" + problem + ")")
+            metrics.count("fetch_failures", endpoint=endpoint)
+            complete = False
+    return complete
+
+#------------------ JOYSTICK & SCHEDULING ------------------#
+
+# The loops used to spin on hat.stick.get_events() as fast as they
+#  could, which kept one core of the pi at 100% all day (and heated
+#  up the humidity sensor the indoor HUD reads its temperature from).
+#  Now a thread waits on the joystick and hands its events to the
+#  event loop, and the modes await the scheduler until either an
+#  event comes in or their next timer is due, so the program is idle
+#  in between.
+#
+# Everything runs on one asyncio event loop: the modes are coroutines
+#  that await the scheduler, and the refresher, the sensor sampler and
+#  the renderer are tasks of their own. Anything that blocks (the
+#  network, I2C sensor reads, the intro's show_message) is run on a
+#  thread with in_thread, so the loop is never stuck waiting on it.
+#  Pressing up cancels the mode that is running wherever it is, even
+#  in the middle of a download, and goes back to the main menu.
+
+#How often to print how busy the CPU has been, in seconds
+CPU_REPORT_INTERVAL = 3600
+
+async def in_thread(function, *args):
+    """Calls function(*args) on a thread of the loop's default
+       executor, and returns (or raises) what it does. Cancelling
+       stops the wait, not the call"""
+    return await asyncio.get_running_loop().run_in_executor(None, function,
+                                                            *args)
+
+class Scheduler(object):
+    """Waits on joystick events with a timeout equal to the next
+       refresh deadline, runs the modes, and measures how much CPU
+       the program uses. Made on the event loop it is used from"""
+
+    def __init__(self, hat):
+        self.hat = hat
+        self.loop = asyncio.get_running_loop()
+        #Joystick events and notices (see notify) not yet waited for
+        self.queued = collections.deque()
+        self.queued_event = asyncio.Event()
+        #Timer name: [interval in seconds, next deadline]
+        self.timers = {}
+        #The task of the mode that is running, if any
+        self.mode = None
+        self.cpu_start = time.process_time()
+        self.wall_start = time.time()
+        self.next_report = self.wall_start + CPU_REPORT_INTERVAL
+        reader = threading.Thread(target=self._read_stick, args=(hat.stick,))
+        reader.daemon = True
+        reader.start()
+
+    def _read_stick(self, stick):
+        """Joystick thread, blocks until the stick has an event (the
+           Sense Hat library has no way to wait for one without
+           blocking) and hands it to the loop"""
+        while(True):
+            event = stick.wait_for_event()
+            try:
+                self.loop.call_soon_threadsafe(self._stick_event, event)
+            except RuntimeError:
+                return #The loop has been closed
+
+    def _stick_event(self, event):
+        #Up leaves a mode straight away, whatever it is waiting on
+        if(self.mode is not None and event.action == "pressed" and
+           event.direction == "up"):
+            self.mode.cancel()
+            return
+        self._queue(event)
+
+    def _queue(self, item):
+        self.queued.append(item)
+        self.queued_event.set()
+
+    def every(self, name, interval, now=True):
+        """Starts a timer that is due every interval seconds,
+           and straight away if now is True"""
+        first = time.time()
+        if(not now):
+            first += interval
+        self.timers[name] = [interval, first]
+        #wait() may be sleeping until a later deadline
+        self.queued_event.set()
+
+    def cancel(self, name):
+        """Stops a timer"""
+        self.timers.pop(name, None)
+
+    def notify(self, name):
+        """Wakes up wait(), from any thread, name is returned with
+           the due timers"""
+        self.loop.call_soon_threadsafe(self._queue, name)
+
+    async def wait(self):
+        """Waits until there are joystick events or a timer is due.
+           Returns (the joystick events, the names of due timers)"""
+        while(not self.queued):
+            timeout = None #No timers, so wait for the joystick
+            if(self.timers):
+                deadline = min(timer[1] for timer in self.timers.values())
+                timeout = deadline - time.time()
+                if(timeout <= 0):
+                    break
+            self.queued_event.clear()
+            try:
+                await asyncio.wait_for(self.queued_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+        queued = list(self.queued)
+        self.queued.clear()
+        self.queued_event.clear()
+        #Notices (see notify) come back as due timers
+        events = [event for event in queued if not isinstance(event, str)]
+        due = [event for event in queued if isinstance(event, str)]
+        if(events):
+            metrics.count("stick_events", len(events))
+
+        now = time.time()
+        for name, timer in self.timers.items():
+            if(timer[1] <= now):
+                due.append(name)
+                timer[1] = now + timer[0]
+        if(now >= self.next_report):
+            print("CPU use: %.2f%%" % self.cpu_usage(reset=True))
+            self.next_report = now + CPU_REPORT_INTERVAL
+        return events, due
+
+    async def run_mode(self, mode):
+        """Runs a mode's coroutine until it returns, fails or is
+           cancelled by pressing up. Returns False if it failed"""
+        self.mode = asyncio.ensure_future(mode)
+        try:
+            #Unlike awaiting the task, doesn't raise what it raises
+            await asyncio.wait([self.mode])
+        except asyncio.CancelledError:
+            self.mode.cancel() #The program is stopping
+            raise
+        finally:
+            task, self.mode = self.mode, None
+            #Whatever timers the mode left behind
+            self.timers.clear()
+        if(task.cancelled() or task.exception() is None):
+            return True
+        print("Had some trouble at time: " + str(time.time()) +
+              " (" + repr(task.exception()) + ")")
+        return False
+
+    def cpu_usage(self, reset=False):
+        """Returns the CPU time used since the start (or the last
+           reset) as a percent of the wall clock time, 100 is one
+           core kept busy"""
+        cpu = time.process_time() - self.cpu_start
+        wall = time.time() - self.wall_start
+        if(reset):
+            self.cpu_start = time.process_time()
+            self.wall_start = time.time()
+        if(wall <= 0):
+            return 0.0
+        return 100.0 * cpu / wall
+
+#--------------------- BACKGROUND REFRESHER ----------------------#
+
+# The data used to be downloaded only while the outdoor HUD was showing,
+#  and its first frame had to wait for the network. Now a task keeps
+#  the cache current on its own schedule, whatever mode is showing. The
+#  modes draw whatever is in the cache straight away (even if it is
+#  stale), and draw again when the refresher says it has new data.
+
+#How often do you want to request the forecast data?
+REFRESH_RATE = 600 #Every 10 min (600 seconds)
+#How soon to try again after a refresh that didn't get everything
+# (what did come in is still in the cache then)
+REFRESH_RETRY = 60
+
+class ForecastRefresher(object):
+    """Fetches the data for a list of cities every interval seconds
+       from a task on the event loop, or after retry seconds if some
+       of it didn't come in"""
+
+    def __init__(self, city_ids, scheduler, interval=REFRESH_RATE,
+                 history=None, retry=REFRESH_RETRY):
+        self.city_ids = list(city_ids)
+        self.scheduler = scheduler
+        self.interval = interval
+        self.retry = retry
+        #Made by run, on the loop it runs on
+        self.wake = None
+        #The HistoryLog new observations of SomeCity go in, if any
+        self.history = history
+        #When the last one recorded was downloaded (the ones loaded
+        # from the snapshot file are older, and aren't recorded)
+        self.recorded = time.time()
+
+    def refresh_now(self):
+        """Refreshes without waiting for the interval (data that
+           is still within its TTL comes from the cache)"""
+        if(self.wake is not None):
+            self.wake.set()
+
+    def record_history(self):
+        """Records SomeCity's current conditions in the history log,
+           once for each download"""
+        table = forecast_cache.peek(SomeCity, "observation")[0]
+        if(self.history is None or table is None or
+           table.fetched <= self.recorded):
+            return
+        self.recorded = table.fetched
+        self.history.record({"outdoor temperature": float(table["temp"][0]),
+                             "outdoor pressure": float(table["pressure"][0]),
+                             "outdoor humidity": float(table["humidity"][0])})
+
+    async def run(self):
+        """Refresher task, the first refresh is straight away. The
+           requests are sent from threads, the loop doesn't wait on
+           the network"""
+        self.wake = asyncio.Event()
+        while(True):
+            complete = await in_thread(fetch_cities, self.city_ids)
+            if(complete):
+                startup_mark("first forecast download")
+            #Once for the whole refresh, not for each request
+            await in_thread(forecast_cache.save_snapshot)
+            self.record_history()
+            #Any mode showing this data can draw it again
+            self.scheduler.notify("new data")
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.interval
+                                       if complete else self.retry)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+
+#Keeps the forecast data current, started in main
+refresher = None
+
+#------------------------- MODE REGISTRY -------------------------#
+
+# Adding a mode used to mean another branch in main's if/elif chain
+#  and in check_stick_events, and a copy of a whole loop. Now each
+#  menu slot (0 to 7, left to right) holds a Mode: its hooks are run
+#  by run_mode_hooks (enter, then render and tick until it finishes
+#  or up is pressed, then exit) and its menu image is drawn by
+#  display_option. Besides the built-in modes, a slot can be given a
+#  mode from another module as "module:attr", in sWeather.cfg:
+#
+#   [modes]
+#   6 = sweather_wind:WindMode
+#
+#  or by an installed package, with an entry point in the
+#  "sweather.modes" group named after the slot it goes in. Those
+#  modules are only imported the first time their slot is picked, so
+#  they add nothing to startup, and a mode that can't be imported, or
+#  fails while running, is printed and goes back to the main menu.
+
+#The entry point group installed modes are found in
+MODE_ENTRY_POINTS = "sweather.modes"
+#Shown on the menu for a mode that isn't loaded yet, or has no image
+MODE_SPRITE = compile_sprite([
+    "........",
+    "........",
+    "...#....",
+    "...#....",
+    ".#####..",
+    "...#....",
+    "...#....",
+    "........",
+    ])
+
+class Mode(object):
+    """A main menu option. Subclasses override the hooks they need,
+       any of which can also be a coroutine function (for anything
+       slow, await in_thread(...) so the loop isn't held up)"""
+    #Names its frames for the renderer's counters, and its failures
+    name = "mode"
+    #Its menu image: 8 strings of 8 characters ("#" lit, "." off),
+    # or a mask from compile_sprite. None for MODE_SPRITE
+    sprite = None
+    #Timer name: seconds, started after enter, due every that many
+    # seconds (see Scheduler.every)
+    timers = {}
+
+    def __init__(self):
+        #Set when it is picked: the hat it draws on, and whether
+        # it is done (set it to go back to the main menu)
+        self.hat = None
+        self.finished = False
+
+    def enter(self):
+        """Called when it is picked on the main menu"""
+
+    def render(self):
+        """Returns the Frame to show, None to leave the screen be.
+           Called after enter, and whenever tick returns True"""
+        return None
+
+    def tick(self, events, due):
+        """Called with the joystick events and the names of the due
+           timers and notices (see Scheduler.wait), until finished.
+           Returns True if it needs to be rendered again"""
+        return False
+
+    def exit(self):
+        """Called when it goes back to the main menu, however it does"""
+
+async def call_hook(hook, *args):
+    """Calls a mode's hook, and awaits what it returns if it has to"""
+    result = hook(*args)
+    if(inspect.isawaitable(result)):
+        result = await result
+    return result
+
+async def run_mode_hooks(mode, hat):
+    """Runs a Mode on hat until it is finished, or cancelled"""
+    mode.hat = hat
+    mode.finished = False
+    try:
+        await call_hook(mode.enter)
+        for name, seconds in mode.timers.items():
+            scheduler.every(name, seconds, now=False)
+        redraw = True
+        while(not mode.finished):
+            if(redraw):
+                frame = await call_hook(mode.render)
+                if(frame is not None):
+                    show_frame(hat, frame, mode.name)
+            #Sleep until the stick is used or a timer is due
+            events, due = await scheduler.wait()
+            redraw = await call_hook(mode.tick, events, due)
+    finally:
+        for name in mode.timers:
+            scheduler.cancel(name)
+        await call_hook(mode.exit)
+
+def load_mode(spec):
+    """Imports a "module:attr" spec and returns the Mode it names,
+       made with no arguments if it is a Mode class"""
+    module_name, _, attr = spec.partition(":")
+    mode = importlib.import_module(module_name.strip())
+    for name in attr.strip().split("."):
+        mode = getattr(mode, name)
+    if(isinstance(mode, type)):
+        mode = mode()
+    if(not isinstance(mode, Mode)):
+        raise TypeError(spec + " isn't a Mode")
+    mode.sprite = check_sprite(mode.sprite)
+    return mode
+
+class ModeRegistry(object):
+    """The Mode in each main menu slot"""
+
+    def __init__(self):
+        #Slot: its Mode, or its "module:attr" spec until it is loaded
+        self.modes = {}
+        #Slot: why its mode couldn't be loaded
+        self.failed = {}
+
+    def register(self, slot, mode, replace=True):
+        """Puts a Mode, or a "module:attr" spec of one, in a menu
+           slot. Returns False if the slot is taken and replace
+           is False"""
+        slot = int(slot)
+        if(not 0 <= slot <= 7):
+            raise ValueError("Menu slots are 0 to 7, not " + str(slot))
+        if(slot in self.modes and not replace):
+            return False
+        self.modes[slot] = mode
+        self.failed.pop(slot, None)
+        if(not isinstance(mode, str)):
+            #Checked now, as a spec's mode is when it is loaded
+            try:
+                mode.sprite = check_sprite(mode.sprite)
+            except ValueError as problem:
+                self.fail(slot, mode.name, problem)
+        return True
+
+    def fail(self, slot, name, problem):
+        """Leaves a slot empty, as its mode couldn't be loaded"""
+        print("Had some trouble loading " + name + " for menu slot " +
+              str(slot) + " at time: " + str(time.time()) +
+              " (" + repr(problem) + ")")
+        metrics.count("mode_failures", mode=name)
+        self.failed[slot] = problem
+
+    def __contains__(self, slot):
+        return slot in self.modes and slot not in self.failed
+
+    def get(self, slot):
+        """Returns the Mode in a slot, importing it the first time,
+           None if there is none or it couldn't be loaded"""
+        if(slot not in self):
+            return None
+        mode = self.modes[slot]
+        if(isinstance(mode, str)):
+            try:
+                mode = load_mode(mode)
+            except Exception as problem:
+                self.fail(slot, mode, problem)
+                return None
+            self.modes[slot] = mode
+        return mode
+
+    def sprite(self, slot):
+        """The menu image of a slot as a mask, None if it is empty"""
+        if(slot not in self):
+            return None
+        mode = self.modes[slot]
+        if(isinstance(mode, str) or mode.sprite is None):
+            return MODE_SPRITE
+        return mode.sprite
+
+def load_modes(config=CONFIG):
+    """Returns (slot, "module:attr") for each mode listed under
+       [modes] in config"""
+    if(not config.has_section("modes")):
+        return []
+    return list(config.items("modes"))
+
+def find_mode_entry_points(group=MODE_ENTRY_POINTS):
+    """Returns (slot, "module:attr") for each mode installed with an
+       entry point. Slow on a pi, as it reads every installed
+       package's metadata"""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return [] #Before python 3.8
+    found = entry_points()
+    if(hasattr(found, "select")):
+        found = found.select(group=group)
+    else:
+        found = found.get(group, ())
+    return [(entry.name, entry.value) for entry in found]
+
+def register_modes(found, replace=True):
+    """Registers (slot, "module:attr") pairs, printing the bad ones"""
+    for slot, spec in found:
+        try:
+            if(not mode_registry.register(slot, spec, replace)):
+                print("Not loading " + spec + ", menu slot " + str(slot) +
+                      " is taken")
+        except ValueError as problem:
+            print("Not loading " + spec + " (" + str(problem) + ")")
+
+#Every mode on the main menu, the built-in ones are registered below
+# them (see MAIN LOOP)
+mode_registry = ModeRegistry()
 
 #--------------------- OUTDOOR HUD LOOP & FUNCTIONS----------------------#
       
-def run_outdoor_hud_loop(hat, curr_x):
-    """Run the program loop for this mini program"""
-    global program_state
-
-    #How often do you want to request the forecast data?
-    REFRESH_RATE = 600 #Every 10 min (600 seconds)
-    #Clear the screen
-    hat.clear()
-    #We are initializing this screen now
-    init = True
-    #Capture the start time for refresh rate calculations
-    start_time = time.time()
-    #Run the sub program loop
-    while(True):
-        #Check to see if user wants to return to main menu
-        return_requested = check_stick_events_2(hat)
-        if(return_requested):
-            break #Exit while to return to main menu
-
-        counter = time.time() - start_time
-        #If it's been < 10 min since the first, or most recent data download...
-        if(counter > REFRESH_RATE or init):
-            #Send another request for data
-            owm = OWM(API_KEY)
-            
-            """FOR 8-DAY FORECAST (ROW 1 & ROW 2)"""
-            #Retrieve daily forecast for 8 days (includes today)
-            fc = owm.daily_forecast_at_id(SomeCity, limit=8)
-            f = fc.get_forecast()
-            i = 0
-            for weather in f:
-                #FOR DEBUGGING
-                #print("At " , str(utc_to_eastern(weather.get_reference_time('date'))),weather.get_weather_code())
-                if(i == 8):
-                    break
-
-                # Where W_CODES[weather.get_weather_code()][0] is giving the
-                #  [weather.get_weather_code()] as a KEY to get the data object
-                #  that holds the color at index [0] and description string
-                #  (unused here) at index [1]
-                
-                #Top row
-                hat.set_pixel(i, 0,W_CODES[weather.get_weather_code()][0])
-                
-                #Second row down from top
-                hat.set_pixel(i, 1,W_CODES[weather.get_weather_code()][0])
-                i += 1
-                
-            """FOR 3 HOUR FORECAST (ROW 3 & ROW 4)"""
-            #Current conditions
-            w = get_observation(SomeCity,owm)
-            
-            #Set leftmost pixels to show current status
-            #Row 3
-            hat.set_pixel(0, 2,W_CODES[w.get_weather_code()][0])
-            #Row 4
-            hat.set_pixel(0, 3,W_CODES[w.get_weather_code()][0])
-            
-            #Get current temperature
-            temp_now = w.get_temperature('fahrenheit')["temp"]
-            #Restrict temp_now readings to bound for display purposes
-            if(temp_now > 100.00):
-                temp_now = 100.00
-            elif(temp_now < 0.00):
-                temp_now = 0.00
-
-            #Get current humidity
-            humi_now = w.get_humidity()
-            #Get current pressure
-            pres_now = w.get_pressure()["press"]
-            #Set current temperature color here for leftmost pixels
-            curr_temp_color = cold_ok_or_hot(temp_now)
-            
-            """ROW 5 Code -- 3HR temperature forecast"""
-            #Set leftmost pixel for ROW 5
-            hat.set_pixel(0,4,curr_temp_color)
-            
-            #Get the 3hr forecast for the next 7 days        
-            fc = owm.three_hours_forecast_at_id(SomeCity)
-            #A list of weather objects
-            f = fc.get_forecast()
-            i = 1
-            #Fill in the rest of the row after first pixels for rows 3,4,5
-            for weather in f:
-                if(i == 8):
-                    break
-                #Row 3
-                hat.set_pixel(i, 2,W_CODES[weather.get_weather_code()][0])
-                #Row 4
-                hat.set_pixel(i, 3,W_CODES[weather.get_weather_code()][0])
-                #Get the temp for the 3hr interval
-                temp_then = weather.get_temperature('fahrenheit')["temp"]
-                #Also set the temperature indicator row color to show if
-                # the temp is high, low, or tolerable at 
-                # ROW 5
-                hat.set_pixel(i,4,cold_ok_or_hot(temp_then))
-                i += 1
-
-            """TEMPERATURE (ROW 6)"""
-            #Where 8/100 = 12.5, so every pixel is 12.5 degrees F of temp.
-            num_pixels = int(temp_now / 12.5)
-            #Temperature displays on row y == 5(6th row) from 0
-            # to 100 degrees where each pixel represents 12.5 degrees F
-            for i in range(num_pixels):
-                hat.set_pixel(i,5,curr_temp_color)
-            for i in range(8-num_pixels):
-                hat.set_pixel(i + num_pixels,5,nwhite)
-
-            """HUMIDITY (ROW 7)"""
-            curr_humi_color = dry_humid_or_ok(humi_now)
-            num_pixels = int(humi_now / 12.5)
-            #Humidity displays on row y == 6 (7th row)
-            #as a relative percent
-            for i in range(num_pixels):
-                hat.set_pixel(i,6, curr_humi_color)
-            for i in range(8-num_pixels):
-                hat.set_pixel(i + num_pixels,6,nwhite)
-
-            """AIR PRESSURE (ROW 8)"""
-            #Air pressure (in millibars) displays on
-            # the last row as one of three colors indicating
-            # if the air pressure is high, low, or reasonable
-            # for normal conditions
-            curr_pres_color = pres_lo_hi_or_ok(pres_now)
-            for i in range(8):
-                hat.set_pixel(i,7,curr_pres_color)
-            
-            #Reset counter for refreshing
-            start_time = time.time()
-            init = False
-            
-    #Goes here after "break"
-    program_state = 0 #Main menu
-    return_to_main_menu(hat, curr_x)
+class OutdoorHud(Mode):
+    """The outdoor HUD for SomeCity"""
+    name = "outdoor hud"
+    sprite = MENU_SPRITES[0]
+
+    def enter(self):
+        #Current conditions older than a refresh interval mean the
+        # refresher missed a round, so it doesn't wait for the next
+        table = forecast_cache.peek(SomeCity, "observation")[0]
+        if(refresher is not None and table is not None and
+           table.staleness() > REFRESH_RATE):
+            refresher.refresh_now()
+
+    def render(self):
+        #The latest data straight away if there is any (it may be
+        # stale, e.g. loaded from the snapshot file), then again every
+        # time the refresher has downloaded new data
+        frame, live = outdoor_hud_frame(SomeCity)
+        if(live):
+            startup_mark("first live outdoor HUD frame")
+        return frame
+
+    def tick(self, events, due):
+        return "new data" in due
+
+def outdoor_hud_frame(city_id):
+    """The outdoor HUD for a city from the cached data, a blank
+       frame if there is none. Returns (frame, True if it was
+       drawn from live, not stale, data)"""
+    #Daily forecast for 8 days (includes today), the current
+    # conditions and the 3hr forecast, as kept by the refresher
+    peeked = [forecast_cache.peek(city_id, endpoint)
+              for endpoint in ("daily", "observation", "3h")]
+    data = [entry[0] for entry in peeked]
+    if(None in data):
+        return Frame(), False #Nothing to draw yet
+    #At most one device write for the whole HUD, and none
+    # if nothing changed since the last refresh
+    with metrics.timer("render_outdoor_hud"):
+        frame = render_outdoor_hud(*data)
+    return frame, not any(entry[1] for entry in peeked)
+
+def render_outdoor_hud(daily, w, forecast_3h):
+    """Draws the outdoor HUD from the daily forecast, the current
+       conditions and the 3hr forecast (forecast tables)"""
+    #The whole HUD is drawn on this frame, then shown at once
+    frame = Frame()
+
+    """FOR 8-DAY FORECAST (ROW 1 & ROW 2)"""
+    #One pixel column per day, in the color of its weather code
+    # (see W_CODES), the same colors on the top and second rows
+    colors = weather_code_colors(daily["code"][:8])
+    frame.pixels[0:2, :len(colors)] = colors
+
+    """FOR 3 HOUR FORECAST (ROW 3 & ROW 4)"""
+    #Leftmost pixels show current status, then the next 7
+    # 3hr intervals, on rows 3 and 4
+    colors = weather_code_colors(np.concatenate((w["code"][:1],
+                                                 forecast_3h["code"][:7])))
+    frame.pixels[2:4, :len(colors)] = colors
+
+    #Get current temperature
+    temp_now = float(w["temp"][0])
+    #Restrict temp_now readings to bound for display purposes
+    if(temp_now > 100.00):
+        temp_now = 100.00
+    elif(temp_now < 0.00):
+        temp_now = 0.00
+
+    #Get current humidity
+    humi_now = float(w["humidity"][0])
+    #Get current pressure
+    pres_now = float(w["pressure"][0])
+    #Set current temperature color here for leftmost pixels
+    curr_temp_color = cold_ok_or_hot(temp_now)
+
+    """ROW 5 Code -- 3HR temperature forecast"""
+    #The current temperature on the leftmost pixel, then the temp
+    # for each 3hr interval, colored to show if the temp is high,
+    # low, or tolerable
+    temps = np.concatenate(([temp_now], forecast_3h["temp"][:7]))
+    frame.pixels[4, :len(temps)] = temperature_colors(temps)
+
+    """TEMPERATURE (ROW 6)"""
+    #Where 8/100 = 12.5, so every pixel is 12.5 degrees F of temp.
+    num_pixels = int(temp_now / 12.5)
+    #Temperature displays on row y == 5(6th row) from 0
+    # to 100 degrees where each pixel represents 12.5 degrees F
+    frame.fill_row(5, curr_temp_color, stop=num_pixels)
+    frame.fill_row(5, nwhite, start=num_pixels)
+
+    """HUMIDITY (ROW 7)"""
+    curr_humi_color = dry_humid_or_ok(humi_now)
+    num_pixels = int(humi_now / 12.5)
+    #Humidity displays on row y == 6 (7th row)
+    #as a relative percent
+    frame.fill_row(6, curr_humi_color, stop=num_pixels)
+    frame.fill_row(6, nwhite, start=num_pixels)
+
+    """AIR PRESSURE (ROW 8)"""
+    #Air pressure (in millibars) displays on
+    # the last row as one of three colors indicating
+    # if the air pressure is high, low, or reasonable
+    # for normal conditions
+    curr_pres_color = pres_lo_hi_or_ok(pres_now)
+    frame.fill_row(7, curr_pres_color)
+    return frame
     
 def cold_ok_or_hot(temp_then):
-    """Determines whether the temperature is too cold, too hot, or ok"""
-    if(temp_then >= 80.00): #In degrees F
-        return hot #Hot temperature range
-    elif(temp_then >= 60.00 and temp_then < 80.00):
-        return ok #Comfortable temperature range
-    elif(temp_then < 60.00 and temp_then >= 50.00):
-        return almost_ok #Almost green (ok) temperature range
-    elif(temp_then < 50.00 and temp_then >= 40.00):
-        return cold
-    elif(temp_then < 40.00 and temp_then > 33.00):#33 for a degree of error
-        return very_cold #Very cold temperature range
-    elif(temp_then <= 33.00):
-        return freezing #It's freezing
+    """Determines whether the temperature (degrees F) is too cold,
+       too hot, or ok, see COLOR_BANDS"""
+    return temperature_colors([temp_then])[0].tolist()
 
 def dry_humid_or_ok(humi_then):
-    """Determines the comfort value of the humidity"""
-    if(humi_then >= 55 and humi_then <= 65): #As a relative percent
-        return humi_ok #Comfortable temperature range
-    elif(humi_then < 55):
-        return humi_low
-    elif(humi_then > 65):
-        return humi_hi
+    """Determines the comfort value of the humidity (relative %)"""
+    return humidity_colors([humi_then])[0].tolist()
 
 def pres_lo_hi_or_ok(pres_then):
-    """Determines the color value of the air pressure"""
-    if pres_then < 979.00:#in millibars
-        return pres_low
-    elif pres_then >= 979.00 and pres_then <= 1027.00:
-        return pres_ok
-    elif(pres_then > 1027.00):
-        return pres_hi
+    """Determines the color value of the air pressure (millibars)"""
+    return pressure_colors([pres_then])[0].tolist()
+
+#--------------------- CITY HUD LOOP ----------------------#
+
+# The outdoor HUD for each of CITIES in turn, a few seconds each.
+#  Left and right go to the previous and next city straight away.
+
+#Seconds each city is shown for
+CITY_HUD_SECONDS = 10
+
+class CityHud(Mode):
+    """The outdoor HUD of each of CITIES in turn"""
+    name = "city hud"
+    sprite = MENU_SPRITES[4]
+    timers = {"next city": CITY_HUD_SECONDS}
+
+    def enter(self):
+        self.city = 0
+
+    def render(self):
+        return outdoor_hud_frame(CITIES[self.city])[0]
+
+    def tick(self, events, due):
+        step = 0
+        for event in events:
+            if(event.action == "pressed"):
+                step += {"left": -1, "right": 1}.get(event.direction, 0)
+        if(step):
+            self.city = (self.city + step) % len(CITIES)
+            scheduler.every("next city", CITY_HUD_SECONDS, now=False)
+        elif("next city" in due):
+            self.city = (self.city + 1) % len(CITIES)
+        return bool(step) or "next city" in due or "new data" in due
+
+#------------------------ SENSOR SAMPLER ------------------------#
+
+# Each sensor read is a slow I2C transaction, and the indoor HUD used
+#  to make three of them while drawing, once a minute, and show that
+#  one (noisy) sample. A task now reads the sensors SAMPLE_RATE
+#  times a second into a ring buffer of the last SAMPLE_WINDOW
+#  samples, and keeps an exponential moving average of each. The HUD
+#  draws from the buffer and never waits on the sensors.
+
+#Samples per second
+SAMPLE_RATE = 1.0
+#How many samples are kept
+SAMPLE_WINDOW = 600
+#Weight of each new sample in the moving average, 0 to 1
+SAMPLE_SMOOTHING = 0.1
+#The sensors, in the order of the buffer's columns after the time
+SENSOR_NAMES = ("temperature", "pressure", "humidity")
+
+class SensorSampler(object):
+    """Reads a hat's sensors from a task on the event loop"""
+
+    def __init__(self, hat, rate=SAMPLE_RATE, size=SAMPLE_WINDOW,
+                 smoothing=SAMPLE_SMOOTHING, history=None):
+        self.hat = hat
+        self.rate = rate
+        self.smoothing = smoothing
+        #The HistoryLog every sample is also recorded in, if any
+        self.history = history
+        #Unix time, degrees F, millibars, relative % per row
+        self.samples = np.full((size, 1 + len(SENSOR_NAMES)), np.nan)
+        #How many samples were ever taken, the next goes in row
+        # count % size
+        self.count = 0
+        self.ema = None
+        #Samples are taken on other threads than the one reading them
+        self.lock = threading.Lock()
+
+    async def run(self):
+        """Sampler task, the first sample is straight away. The
+           sensors are read on a thread, as each read blocks on I2C"""
+        while(True):
+            await in_thread(self.sample)
+            await asyncio.sleep(1.0 / self.rate)
+
+    def sample(self):
+        """Reads every sensor once into the buffer"""
+        try:
+            with metrics.timer("sensor_read"):
+                values = np.array([
+                    self.hat.get_temperature_from_humidity()*(9/5) + 32, #To fahrenheit
+                    self.hat.pressure,
+                    self.hat.humidity])
+        except (OSError, ValueError):
+            metrics.count("sensor_failures")
+            return
+        now = time.time()
+        with self.lock:
+            self.samples[self.count % len(self.samples)] = \
+                np.concatenate(([now], values))
+            self.count += 1
+            if(self.ema is None):
+                self.ema = values
+            else:
+                self.ema = self.ema + self.smoothing * (values - self.ema)
+        if(self.history is not None):
+            self.history.record(dict(zip(HISTORY_CHANNELS, values.tolist())), now)
+
+    def window(self, seconds=None):
+        """Returns the samples of the last seconds (all of them if
+           None), oldest first, as rows of time and SENSOR_NAMES"""
+        with self.lock:
+            kept = min(self.count, len(self.samples))
+            start = self.count % len(self.samples) if self.count > kept else 0
+            rows = np.roll(self.samples[:kept], -start, axis=0)
+        if(seconds is not None):
+            rows = rows[rows[:, 0] >= time.time() - seconds]
+        return rows
+
+    def smoothed(self, method="ema", seconds=None):
+        """Returns {sensor: smoothed value}, the moving average or
+           the median of the window, None before the first sample"""
+        if(method == "ema"):
+            with self.lock:
+                values = self.ema
+        else:
+            rows = self.window(seconds)
+            values = np.median(rows[:, 1:], axis=0) if len(rows) else None
+        if(values is None):
+            return None
+        return dict(zip(SENSOR_NAMES, values.tolist()))
+
+    def stats(self, seconds=None):
+        """Returns {sensor: {"min", "max", "median", "ema"}} over
+           the window, None before the first sample"""
+        rows = self.window(seconds)
+        ema = self.smoothed()
+        if(not len(rows) or ema is None):
+            return None
+        return dict((name, {"min": float(rows[:, i + 1].min()),
+                            "max": float(rows[:, i + 1].max()),
+                            "median": float(np.median(rows[:, i + 1])),
+                            "ema": ema[name]})
+                    for i, name in enumerate(SENSOR_NAMES))
+
+#Samples the hat's sensors, started in main
+sensor_sampler = None
+
+#------------------------- HISTORY LOG --------------------------#
+
+# The sampler only keeps the last few minutes and the forecast cache
+#  only the latest download, so there was no way to see how things had
+#  been changing. Every sensor sample and every new observation is now
+#  also appended to a history file of fixed size, memory-mapped so it
+#  never has to be read into memory: a ring of the raw records, and
+#  rings of 1 minute and 1 hour averages, each worked out when its
+#  minute or hour ends. A year of hours, a week of minutes and an hour
+#  of raw samples take under 1MB, on disk and in memory, for good.
+#
+# Records are written in place into the mapped pages and the kernel
+#  writes the dirty pages back on its own, so however often samples
+#  come in, the card only sees the few pages that changed once every
+#  writeback period (about 30 seconds). The file is only synced when
+#  an hour ends. A record is written before the ring's next index is
+#  moved past it, so a power cut loses at most the last few records.
+
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "sWeather.history")
+HISTORY_MAGIC = b"sWhist01"
+#The values each record has, NaN where it has none
+HISTORY_CHANNELS = (tuple("indoor " + name for name in SENSOR_NAMES) +
+                    tuple("outdoor " + name for name in SENSOR_NAMES))
+#(name, seconds each record averages, records kept), 0 seconds for
+# records as they came in
+HISTORY_TIERS = (("raw", 0, 4096),      #About an hour at 1 sample/s
+                 ("minute", 60, 10080), #A week
+                 ("hour", 3600, 8760))  #A year
+HISTORY_DTYPE = np.dtype([("time", "<f8"), #Unix time, start of the average
+                          ("values", "<f4", (len(HISTORY_CHANNELS),))])
+#The start of the file, then each tier's ring of records in turn
+HISTORY_HEADER = np.dtype([("magic", "S8"),
+                           ("next", "<i8", (len(HISTORY_TIERS),)),  #Ring index
+                           ("count", "<i8", (len(HISTORY_TIERS),)), #Records kept
+                           ("spare", "<i8")])
+
+def open_history_file(path, size):
+    """Memory-maps the history file at path, first making a new
+       empty one if it is missing or isn't a history file of size
+       bytes"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if(os.fstat(fd).st_size != size or
+           os.pread(fd, len(HISTORY_MAGIC), 0) != HISTORY_MAGIC):
+            #Zeros, left sparse until the records are written
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, size)
+            os.pwrite(fd, HISTORY_MAGIC, 0)
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd) #The map keeps its own handle
+
+class HistoryLog(object):
+    """Ring buffers of records, by tier, in a memory-mapped file"""
+
+    def __init__(self, path=HISTORY_FILE, tiers=HISTORY_TIERS):
+        self.tiers = tiers
+        self.tier_index = dict((tier[0], i) for i, tier in enumerate(tiers))
+        size = (HISTORY_HEADER.itemsize +
+                sum(tier[2] for tier in tiers) * HISTORY_DTYPE.itemsize)
+        self.mm = open_history_file(path, size)
+        #Views of the mapped file, writing to them writes the file
+        header = np.frombuffer(self.mm, dtype=HISTORY_HEADER, count=1)
+        self.next = header["next"][0]
+        self.count = header["count"][0]
+        self.rings = []
+        offset = HISTORY_HEADER.itemsize
+        for name, seconds, kept in tiers:
+            self.rings.append(np.frombuffer(self.mm, dtype=HISTORY_DTYPE,
+                                            count=kept, offset=offset))
+            offset += kept * HISTORY_DTYPE.itemsize
+        #Per tier after the raw one: [start of the minute or hour still
+        # going, sums of its values, how many of each were added]
+        self.partial = [None] + [self._new_partial() for tier in tiers[1:]]
+        #The sampler and the refresher record from their own threads
+        self.lock = threading.Lock()
+        self._resume()
+
+    def _new_partial(self):
+        return [None, np.zeros(len(HISTORY_CHANNELS)),
+                np.zeros(len(HISTORY_CHANNELS))]
+
+    def record(self, values, when=None):
+        """Appends {channel: value} for some of HISTORY_CHANNELS,
+           and adds them to the averages"""
+        when = time.time() if when is None else when
+        row = np.full(len(HISTORY_CHANNELS), np.nan)
+        for name, value in values.items():
+            row[HISTORY_CHANNELS.index(name)] = value
+        with self.lock:
+            self._append(0, when, row)
+            self._add(1, when, row)
+
+    def _append(self, tier, when, row):
+        """Writes a record into a tier's ring (with the lock held)"""
+        ring = self.rings[tier]
+        i = int(self.next[tier])
+        ring[i] = (when, row)
+        #Only counted once it is all there
+        self.next[tier] = (i + 1) % len(ring)
+        self.count[tier] = min(self.count[tier] + 1, len(ring))
+
+    def _add(self, tier, when, row):
+        """Adds a row to the average of the period it is in, first
+           writing out the one before if that has ended"""
+        if(tier >= len(self.tiers)):
+            return
+        seconds = self.tiers[tier][1]
+        start = when - when % seconds
+        partial = self.partial[tier]
+        if(partial[0] is not None):
+            if(start > partial[0]):
+                self._end_period(tier)
+                partial = self.partial[tier] #A new one, for this period
+            else:
+                start = partial[0] #Late, it goes in the current one
+        partial[0] = start
+        seen = ~np.isnan(row)
+        partial[1][seen] += row[seen]
+        partial[2][seen] += 1
+
+    def _end_period(self, tier):
+        """Writes out the average of the period still going"""
+        start, sums, counts = self.partial[tier]
+        with np.errstate(invalid="ignore"):
+            means = sums / counts #NaN for channels with no values
+        self._append(tier, start, means)
+        self.partial[tier] = self._new_partial()
+        self._add(tier + 1, start, means)
+        if(tier == len(self.tiers) - 1):
+            self.flush()
+
+    def _resume(self):
+        """Picks the minute and hour that were going when the file was
+           last written back up from the records of the tier below"""
+        for tier in range(1, len(self.tiers)):
+            rows = self.records(tier - 1)
+            if(not len(rows)):
+                continue
+            seconds = self.tiers[tier][1]
+            start = rows["time"][-1] - rows["time"][-1] % seconds
+            done = self.records(tier)
+            if(len(done) and done["time"][-1] >= start):
+                continue
+            for row in rows[rows["time"] >= start].tolist():
+                self._add(tier, row[0], np.array(row[1]))
+
+    def records(self, tier, since=None):
+        """Returns a copy of a tier's records (by name or index),
+           oldest first, only those from since on if it is given"""
+        tier = self.tier_index.get(tier, tier)
+        with self.lock:
+            ring = self.rings[tier]
+            count = int(self.count[tier])
+            if(count < len(ring)):
+                rows = ring[:count].copy()
+            else:
+                i = int(self.next[tier])
+                rows = np.concatenate((ring[i:], ring[:i]))
+        if(since is not None):
+            rows = rows[rows["time"] >= since]
+        return rows
+
+    def trend(self, channel, tier, seconds, columns=8, now=None):
+        """Returns the average of a channel over each of the last
+           columns spans of seconds, oldest first, NaN for a span
+           with no records. The minute or hour still going counts as
+           a record, so the latest span isn't empty until it ends"""
+        now = time.time() if now is None else now
+        start = now - columns * seconds
+        tier = self.tier_index.get(tier, tier)
+        channel = HISTORY_CHANNELS.index(channel)
+        rows = self.records(tier, since=start)
+        times = rows["time"]
+        values = rows["values"][:, channel].astype(float)
+        with self.lock:
+            partial = self.partial[tier]
+            if(partial is not None and partial[0] is not None and
+               partial[0] >= start and partial[2][channel]):
+                times = np.append(times, partial[0])
+                values = np.append(values,
+                                   partial[1][channel] / partial[2][channel])
+        seen = ~np.isnan(values)
+        spans = np.clip(((times[seen] - start) // seconds).astype(int),
+                        0, columns - 1)
+        sums = np.bincount(spans, weights=values[seen], minlength=columns)
+        counts = np.bincount(spans, minlength=columns)
+        with np.errstate(invalid="ignore"):
+            return sums / counts
+
+    def flush(self):
+        """Writes the changed pages to the card now"""
+        self.mm.flush()
+
+    def close(self):
+        self.flush()
+        self.next = self.count = self.rings = None
+        self.mm.close()
+
+#Sensor samples and observations over time, opened in main
+history_log = None
+
+#--------------------- TRENDS LOOP & FUNCTIONS ----------------------#
+
+# A sparkline of one reading for each of the last 8 periods, indoors
+#  on the top half of the screen and outdoors on the bottom half, from
+#  the history log. Left and right switch between temperature, pressure
+#  and humidity, the middle button between the last 2 hours, day and
+#  8 days.
+
+#The readings shown, and their colors (the indoor HUD's)
+TREND_QUANTITIES = (("temperature", red),
+                    ("pressure", green),
+                    ("humidity", blue))
+#(history tier, seconds per column) of each time span
+TREND_SPANS = (("minute", 900),      #2 hours
+               ("hour", 3 * 3600),   #A day
+               ("hour", 24 * 3600))  #8 days
+#How often the sparklines are redrawn, in seconds
+TREND_REFRESH = 60
+
+class Trends(Mode):
+    """Sparklines from the history log"""
+    name = "trends"
+    sprite = MENU_SPRITES[5]
+    timers = {"trends": TREND_REFRESH}
+
+    def enter(self):
+        self.quantity = 0
+        self.span = 0
+
+    def render(self):
+        return render_trends(history_log, self.quantity, self.span)
+
+    def tick(self, events, due):
+        changed = False
+        for event in events:
+            if(event.action == "pressed"):
+                if(event.direction in ("left", "right")):
+                    self.quantity = (self.quantity + {"left": -1, "right": 1}[event.direction]) \
+                                    % len(TREND_QUANTITIES)
+                    changed = True
+                elif(event.direction == "middle"):
+                    self.span = (self.span + 1) % len(TREND_SPANS)
+                    changed = True
+        return changed or "trends" in due
+
+def render_trends(history, quantity, span):
+    """The indoor and outdoor sparklines of a reading as a Frame,
+       blank if there is no history"""
+    frame = Frame()
+    if(history is None):
+        return frame
+    name, color = TREND_QUANTITIES[quantity]
+    tier, seconds = TREND_SPANS[span]
+    color = np.asarray(color)
+    for top, place, shade in ((0, "indoor", color), (4, "outdoor", color // 3)):
+        render_sparkline(frame, history.trend(place + " " + name, tier, seconds),
+                         top, 4, shade)
+    return frame
+
+def render_sparkline(frame, values, top, height, color):
+    """Draws 8 values as bars in rows top to top+height-1 of frame,
+       scaled so the lowest is 1 pixel high and the highest fills
+       them all. NaN values are left out"""
+    seen = ~np.isnan(values)
+    if(not seen.any()):
+        return
+    values = np.where(seen, values, 0)
+    low, high = values[seen].min(), values[seen].max()
+    if(high > low):
+        heights = 1 + np.round((values - low) / (high - low) * (height - 1))
+    else:
+        heights = np.full(len(values), (height + 1) // 2) #Flat
+    rows = np.arange(height)[:, None]
+    lit = (rows >= height - heights) & seen
+    frame.pixels[top:top + height][lit] = color
 
 #--------------------- INDOOR HUD LOOP & FUNCTIONS----------------------#
     
 # Most of the following code was taken from the bar graph example
 #  in the sense hat emulator provided with Raspbian OS
 
-def run_indoor_hud_loop(hat, curr_x):
-    """Run the program loop for this mini app"""
-    global program_state
-    
-    REFRESH_RATE = 60 #Every 60 seconds
-    
-    #We are initializing this screen now
-    init = True
-    #Capture the start time for refresh rate calculations
-    start_time = time.time()
-    #Run the sub program loop
-    while(True):
-        #Check to see if user wants to return to main menu
-        return_requested = check_stick_events_2(hat)
-        if(return_requested):
-            break #Return to main menu
-
-        counter = time.time() - start_time
-        #If it's been < 60 sec since the first, or most recent sensing
-        if(counter > REFRESH_RATE or init):
-            display_readings(hat)
-            #Reset counter for refreshing
-            start_time = time.time()
-            init = False
-
-    #Goes here after break
-    program_state = 0 #Main menu
-    return_to_main_menu(hat, curr_x)
+class IndoorHud(Mode):
+    """The hat's own sensor readings as bars"""
+    name = "indoor hud"
+    sprite = MENU_SPRITES[1]
+    #Sensed when it starts, then every 60 sec. Until the sampler has
+    # a sample, it looks for one every second
+    timers = {"indoor hud": 60, "first sample": 1}
+
+    def render(self):
+        self.waiting = sampled_readings(self.hat) is None
+        if(not self.waiting):
+            scheduler.cancel("first sample")
+        return render_readings(self.hat)
+
+    def tick(self, events, due):
+        if(self.waiting and "first sample" in due):
+            return sampled_readings(self.hat) is not None
+        #If it's been 60 sec since the first, or most recent sensing
+        return "indoor hud" in due
         
         
 def clamp_2(value, min_value, max_value):
@@ -740,6 +2638,10 @@ def render_bar(screen, origin, width, height, color):
     # Invert the Y-coords so we're drawing bottom up
     max_y, max_x = screen.shape[:2]
     y1, y2 = max_y - y2, max_y - y1
+    # Clip to the screen (a negative index would wrap around)
+    x1, y1 = max(x1, 0), max(y1, 0)
+    if(x2 <= x1 or y2 <= y1):
+        return
     # Draw the bar
     screen[y1:y2, x1:x2, :] = color
 
@@ -748,92 +2650,239 @@ def display_readings(hat):
     Display the temperature, pressure, and humidity readings of the HAT as red,
     green, and blue bars on the screen respectively.
     """
-    temp_f = hat.get_temperature_from_humidity()*(9/5) + 32 #convert to fahrenheit
+    show_frame(hat, render_readings(hat), "indoor hud")
+
+def sampled_readings(hat):
+    """The sampler's smoothed readings of hat's sensors, None if it
+       isn't sampling them or hasn't yet"""
+    if(sensor_sampler is None or sensor_sampler.hat is not hat):
+        return None
+    return sensor_sampler.smoothed()
+
+def render_readings(hat):
+    """The indoor HUD's bars as a Frame, see display_readings. The
+       sensors are never read here (each read is a slow I2C
+       transaction), without a sample yet the bars are placeholders"""
+    readings = sampled_readings(hat)
+    if(readings is None):
+        #A pixel of no_reading at the foot of each bar
+        screen = np.empty((8, 8, 3), dtype=np.uint8)
+        screen[:] = nwhite
+        for x in (0, 3, 6):
+            render_bar(screen, (x, 0), 2, 1, color=no_reading)
+        return Frame(screen)
+    temp_f = readings["temperature"]
+    pressure = readings["pressure"]
+    humidity = readings["humidity"]
     
     # Calculate the environment values in screen coordinates
     temperature_range = (0, 100)
     pressure_range = (950, 1050)
     humidity_range = (0, 100)
     temperature = scale(clamp_2(temp_f, *temperature_range), *temperature_range)
-    pressure = scale(clamp_2(hat.pressure, *pressure_range), *pressure_range)
-    humidity = scale(clamp_2(hat.humidity, *humidity_range), *humidity_range)
+    pressure = scale(clamp_2(pressure, *pressure_range), *pressure_range)
+    humidity = scale(clamp_2(humidity, *humidity_range), *humidity_range)
     # Render the bars
     screen = np.zeros((8, 8, 3), dtype=np.uint8)
     
     render_bar(screen, (0, 0), 2, round(temperature), color=(255, 0, 0))
     render_bar(screen, (3, 0), 2, round(pressure), color=(0, 255, 0))
     render_bar(screen, (6, 0), 2, round(humidity), color=(0, 0, 255))
-    hat.set_pixels([pixel for row in screen for pixel in row])
-
-    #Fill screen background
-    pixels = hat.get_pixels()
-    for i in range(64):
-        if(pixels[i] == [0,0,0]):
-            pixels[i] = nwhite
-    hat.set_pixels(pixels)
+
+    #Fill screen background (every pixel not covered by a bar)
+    screen[(screen == 0).all(axis=2)] = nwhite
+    return Frame(screen)
     
+#------------------------- TEXT SCROLLER -------------------------#
+
+# hat.show_message builds every letter again each time it is called,
+#  then sleeps between frames without looking at the joystick, so a
+#  long readout could not be stopped until it had scrolled to the end.
+#  The scroller draws a message once into a strip 8 pixels high and as
+#  wide as the text, and keeps it. A Readout shows 8 columns of it at
+#  a time on a scheduler timer, reading the joystick between frames:
+#  up exits (it cancels the readout), the middle button pauses, and
+#  left/right scroll slower/faster.
+
+#Seconds per column, the speed show_message was called with
+SCROLL_SPEED = 0.035
+#Slowest and fastest speeds left/right can set
+SCROLL_SPEED_LIMITS = (0.2, 0.01)
+#How many drawn messages to keep
+STRIP_CACHE_SIZE = 8
+
+class TextScroller(object):
+    """Scrolls text across one hat in the hat's own font"""
+
+    def __init__(self, hat):
+        self.hat = hat
+        #Character: 8 row mask of its lit pixels
+        self.glyphs = {}
+        #(text, color, back): 8 x width x 3 strip, oldest first
+        self.strips = collections.OrderedDict()
+
+    def glyph(self, char):
+        """Returns the mask of a character, trimmed of blank columns
+           either side like show_message does. Characters the font
+           doesn't have get the hat's "?" glyph"""
+        if(char not in self.glyphs):
+            pixels = np.array(self.hat._get_char_pixels(char), dtype=np.uint8)
+            #The font is stored rotated, 8 pixels per column, bottom
+            # row first (see SenseHat._load_text_assets)
+            mask = (pixels == 255).all(axis=1).reshape(-1, 8).T[::-1]
+            lit = np.flatnonzero(mask.any(axis=0))
+            if(len(lit)):
+                mask = mask[:, lit[0]:lit[-1] + 1]
+            self.glyphs[char] = mask
+        return self.glyphs[char]
+
+    def strip(self, text, color, back=black):
+        """Returns text drawn as an 8 x width x 3 strip, with a blank
+           screen either side so it scrolls in and out"""
+        key = (text, tuple(color), tuple(back))
+        if(key in self.strips):
+            self.strips.move_to_end(key)
+            return self.strips[key]
+        columns = [np.zeros((8, 8), dtype=bool)]
+        for char in text:
+            columns.append(self.glyph(char))
+            columns.append(np.zeros((8, 1), dtype=bool)) #Letter spacing
+        columns.append(np.zeros((8, 8), dtype=bool))
+        mask = np.concatenate(columns, axis=1)
+        strip = np.empty(mask.shape + (3,), dtype=np.uint8)
+        strip[:] = back
+        strip[mask] = color
+        self.strips[key] = strip
+        if(len(self.strips) > STRIP_CACHE_SIZE):
+            self.strips.popitem(last=False)
+        return strip
+
+#One scroller per hat, so its drawn messages are kept between readouts
+scrollers = {}
+
+def get_scroller(hat):
+    """Returns the TextScroller for hat"""
+    if hat not in scrollers:
+        scrollers[hat] = TextScroller(hat)
+    return scrollers[hat]
+
+class Readout(Mode):
+    """Scrolls a line of text across the screen once, subclasses
+       say what it is by overriding text"""
+    name = "readout"
+    color = nwhite
+    back = black
+
+    async def text(self):
+        """Returns the text to read out, None if there is nothing
+           to read out"""
+        return None
+
+    async def enter(self):
+        self.start = 0
+        self.paused = False
+        self.speed = SCROLL_SPEED
+        text = await self.text()
+        if(text is None):
+            self.finished = True #Back to the main menu
+            return
+        if(not hasattr(self.hat, "_get_char_pixels")):
+            #No font to draw with, so it can't be stopped, but it
+            # doesn't hold up the loop either
+            try:
+                await in_thread(functools.partial(
+                    self.hat.show_message, text, scroll_speed=self.speed,
+                    text_colour=self.color, back_colour=self.back))
+            finally:
+                get_renderer(self.hat).forget()
+            self.finished = True
+            return
+        self.strip = get_scroller(self.hat).strip(text, self.color, self.back)
+        scheduler.every("scroll", self.speed, now=False)
+
+    def render(self):
+        #The same frames show_message would show
+        frame = Frame()
+        frame.pixels[:] = self.strip[:, self.start:self.start + 8]
+        return frame
+
+    def tick(self, events, due):
+        for event in events:
+            if(event.action != "pressed"):
+                continue
+            if(event.direction == "middle"):
+                self.paused = not self.paused
+                if(self.paused):
+                    scheduler.cancel("scroll")
+                else:
+                    scheduler.every("scroll", self.speed)
+            elif(event.direction in ("left", "right")):
+                if(event.direction == "left"):
+                    self.speed = min(self.speed * 1.5, SCROLL_SPEED_LIMITS[0])
+                else:
+                    self.speed = max(self.speed / 1.5, SCROLL_SPEED_LIMITS[1])
+                if(not self.paused):
+                    scheduler.every("scroll", self.speed, now=False)
+        if("scroll" not in due or self.paused):
+            return False
+        self.start += 1
+        if(self.start >= self.strip.shape[1] - 8):
+            self.finished = True #It has gone by
+            return False
+        return True
+
+    def exit(self):
+        scheduler.cancel("scroll")
+
  #--------------------------- 3 HOUR READOUT ------------------------#
     
-def run_3h_readout(hat, curr_x):
+def readout_3h_text(current, forecast_3h):
+    """The 3hr readout for the current conditions and the next 8
+       forecasts (forecast tables)"""
+    dates = current.dates() + forecast_3h.dates()[:8]
+    statuses = current.statuses() + forecast_3h.statuses()[:8]
+    readout_string = ""
+    for date, status in zip(dates, statuses):
+        readout_string = readout_string + "At " + str(utc_to_eastern(date).time())[0:5]
+        readout_string = readout_string + " " + status + " - "
+    return readout_string
+
+class Readout3h(Readout):
     """Displays a text readout of the forecast for the next day or so
        in three-hour intervals"""
-    global program_state
-    readout_3h = []
-    readout_string = ""
-    owm = OWM(API_KEY)
-    #Current conditions
-    current_conditions = get_observation(SomeCity,owm)
-    readout_3h.append(current_conditions)
-    
-     #Get the 3hr forecast for the next 7 days        
-    fc = owm.three_hours_forecast_at_id(SomeCity)
-    #A list of weather objects
-    f = fc.get_forecast()
-    i = 1
-    for weather in f:
-        readout_3h.append(weather)
-        if(i == 8):
-            break
-        i += 1
-    for weather in readout_3h:
-        readout_string = readout_string + "At " + str(utc_to_eastern(weather.get_reference_time('date')).time())[0:5]
-        readout_string = readout_string + " " + weather.get_detailed_status() + " - "
-
-    hat.show_message(readout_string, scroll_speed = 0.035, text_colour = nwhite)
-    
-    #Goes here after break
-    program_state = 0 #Main menu
-    return_to_main_menu(hat, curr_x)
+    name = "3h readout"
+    sprite = MENU_SPRITES[2]
+
+    async def text(self):
+        #Current conditions and the 3hr forecast for the next 7 days,
+        # requested at the same time (up still works while they are)
+        data = await in_thread(fetch_all, SomeCity, ("observation", "3h"))
+        if(None in data.values()):
+            return None #Nothing to read out
+        return readout_3h_text(data["observation"], data["3h"])
 
  #--------------------------- 8 DAY READOUT ------------------------#
 
-def run_8d_readout(hat, curr_x):
+def readout_8d_text(daily):
+    """The 8 day readout for a daily forecast table"""
+    readout_string = ""
+    for date, status in zip(daily.dates()[:9], daily.statuses()[:9]):
+        readout_string = readout_string + " For " + str(utc_to_eastern(date))[0:10]
+        readout_string = readout_string + " " + status + " - "
+    return readout_string
+
+class Readout8d(Readout):
     """Displays a text readout of the forecast for the next 8 days
        and gives the respective dates"""
-    global program_state
-    readout_8d = []
-    readout_string = ""
-    #Send another request for data
-    owm = OWM(API_KEY)
-            
-    #Retrieve daily forecast for 8 days (includes today)
-    fc = owm.daily_forecast_at_id(SomeCity, limit=8)
-    f = fc.get_forecast()
-    i = 0
-    for weather in f:
-        readout_8d.append(weather)
-        if(i == 8):
-            break
-        i += 1
-    for weather in readout_8d:
-        readout_string = readout_string + " For " + str(utc_to_eastern(weather.get_reference_time('date')))[0:10]
-        readout_string = readout_string + " " + weather.get_detailed_status() + " - "
-
-    hat.show_message(readout_string, scroll_speed = 0.035, text_colour = nwhite)
-    
-    #Goes here after break
-    program_state = 0 #Main menu
-    return_to_main_menu(hat, curr_x)
+    name = "8d readout"
+    sprite = MENU_SPRITES[3]
+
+    async def text(self):
+        #Retrieve daily forecast for 8 days (includes today)
+        f = (await in_thread(fetch_all, SomeCity, ("daily",)))["daily"]
+        if(f is None):
+            return None #Nothing to read out
+        return readout_8d_text(f)
 
  #--------------------------- SOME NEW READOUT OR LOOP ------------------------#
     """
@@ -844,88 +2893,264 @@ def run_8d_readout(hat, curr_x):
                 -INFO FOR ANOTHER CITY (copy+paste outdoor hud functionality)
                 -ANYTHING ELSE PYOWM SUPPLIES AS DATA!
 
-    program_state = 0 #Main menu
-    return_to_main_menu(hat, curr_x)
+    class SomeNewMode(Mode):
+        name = "some new mode"
+        sprite = ["........", ...] #Its menu image
+        timers = {"some new mode": 60} #Redraw every minute
+
+        def render(self):
+            #Return a Frame to show, anything slow can be
+            # awaited in an async render with in_thread(...)
+        def tick(self, events, due):
+            #Return True to render again
+            return "some new mode" in due
+
+    Then register it under a free spot on the main menu bar (see
+    MAIN LOOP), or keep it in a module of its own and list it in
+    sWeather.cfg (see MODE REGISTRY).
     
     """
 
+#---------------------------- STARTUP ----------------------------#
+
+# The first forecast download used to wait for the whole welcome
+#  animation (about 6 seconds of show_letter and show_message). Now the
+#  refresher starts before the animation and downloads while it plays,
+#  the animation can be skipped with --no-intro, and the time taken to
+#  get to the welcome screen, the first download and the first outdoor
+#  HUD frame drawn from live data is printed, from when the program
+#  started and from when the pi booted.
+
+#Name: (module, class or function returning a hat) of each Sense Hat
+# backend, only the module of the one picked is imported. sense_hat
+# writes frames straight to the led matrix's framebuffer when it can,
+# and is the stock SenseHat otherwise (see sense_fb.py), stock is
+# always the stock SenseHat. A backend needs the parts of the
+# SenseHat API used here: set_pixels, set_pixel, clear, show_message,
+# show_letter, stick.wait_for_event, get_temperature_from_humidity,
+# humidity and pressure. It can also have set_rows(pixels, rows) (see
+# FrameRenderer) and _get_char_pixels (see TextScroller).
+HAT_BACKENDS = {"sense_hat": ("sense_fb", "open_sense_hat"),
+                "stock": ("sense_hat", "SenseHat"),
+                "emulator": ("sense_emu", "SenseHat"), #Emus are funny-looking birds
+                "headless": ("sense_headless", "HeadlessHat")}
+
+def parse_args(argv=None):
+    """Reads the command line options"""
+    parser = argparse.ArgumentParser(
+        description="Weather Sense for Raspberry Pi Sense Hat")
+    parser.add_argument("--backend", choices=sorted(HAT_BACKENDS),
+                        default="sense_hat",
+                        help="what to draw on and read the sensors from")
+    parser.add_argument("--emulator", dest="backend", action="store_const",
+                        const="emulator",
+                        help="run on the Sense Hat emulator (--backend emulator)")
+    parser.add_argument("--no-intro", action="store_true",
+                        help="skip the welcome animation")
+    parser.add_argument("--outdoor-hud", action="store_true",
+                        help="start in the outdoor HUD instead of the main menu")
+    parser.add_argument("--sample-rate", type=float, default=SAMPLE_RATE,
+                        help="sensor samples per second for the indoor HUD")
+    parser.add_argument("--metrics-textfile", metavar="PATH",
+                        help="write timings and counters here for Prometheus' "
+                             "node exporter, every %d s" % METRICS_INTERVAL)
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve timings and counters on localhost at "
+                             "/metrics and /metrics.json")
+    return parser.parse_args(argv)
+
+def open_hat(backend="sense_hat"):
+    """Returns a new hat from one of HAT_BACKENDS"""
+    module_name, class_name = HAT_BACKENDS[backend]
+    return getattr(importlib.import_module(module_name), class_name)()
+
+def boot_time():
+    """Returns when the pi booted (Unix time), None if unknown"""
+    try:
+        with open("/proc/uptime") as uptime:
+            return time.time() - float(uptime.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+#Startup step: seconds from START_TIME, only the first time is kept
+startup_marks = {}
+
+def startup_mark(name):
+    """Prints how long startup took to get to a step, the first
+       time the step is reached"""
+    if(name in startup_marks):
+        return
+    now = time.time()
+    startup_marks[name] = now - START_TIME
+    report = "Startup: %s after %.2fs" % (name, now - START_TIME)
+    booted = boot_time()
+    if(booted is not None):
+        report += " (%.2fs after boot)" % (now - booted)
+    print(report)
+
+def play_intro(hat):
+    """The welcome animation"""
+    #Time between letters
+    wait_time = 0.4
+    # Show welcome message
+
+    hat.show_letter("W",\
+                     text_colour = red,\
+                     back_colour = black)
+    time.sleep(wait_time)
+    hat.show_letter("e",\
+                     text_colour = orange,\
+                     back_colour = black)
+    time.sleep(wait_time)
+    hat.show_letter("l",\
+                     text_colour = yellow,\
+                     back_colour = black)
+    time.sleep(wait_time)
+    hat.show_letter("c",\
+                     text_colour = green,\
+                     back_colour = black)
+    time.sleep(wait_time)
+    hat.show_letter("o",\
+                     text_colour = blue,\
+                     back_colour = black)
+    time.sleep(wait_time)
+    hat.show_letter("m",\
+                     text_colour = violet,\
+                     back_colour = black)
+    time.sleep(wait_time)
+    hat.show_letter("e",\
+                     text_colour = pink,\
+                     back_colour = black)
+    time.sleep(wait_time)
+
+    welc_speed = 0.05
+
+    hat.show_message(" to ",\
+                     scroll_speed = welc_speed,\
+                     text_colour = white,\
+                     back_colour = black)
+    hat.show_message("sWEATHER v" + VERSION + "!",\
+                     scroll_speed = welc_speed,\
+                     text_colour = nwhite,\
+                     back_colour = black)
+
 ######## MAIN LOOP ######### 
 
-hat.clear()
-
-#Time between letters
-wait_time = 0.4
-# Show welcome message
-
-hat.show_letter("W",\
-                 text_colour = red,\
-                 back_colour = black)
-time.sleep(wait_time)
-hat.show_letter("e",\
-                 text_colour = orange,\
-                 back_colour = black)
-time.sleep(wait_time)
-hat.show_letter("l",\
-                 text_colour = yellow,\
-                 back_colour = black)
-time.sleep(wait_time)
-hat.show_letter("c",\
-                 text_colour = green,\
-                 back_colour = black)
-time.sleep(wait_time)
-hat.show_letter("o",\
-                 text_colour = blue,\
-                 back_colour = black)
-time.sleep(wait_time)
-hat.show_letter("m",\
-                 text_colour = violet,\
-                 back_colour = black)
-time.sleep(wait_time)
-hat.show_letter("e",\
-                 text_colour = pink,\
-                 back_colour = black)
-time.sleep(wait_time)
-
-welc_speed = 0.05
-
-hat.show_message(" to ",\
-                 scroll_speed = welc_speed,\
-                 text_colour = white,\
-                 back_colour = black)
-hat.show_message("sWEATHER v" + VERSION + "!",\
-                 scroll_speed = welc_speed,\
-                 text_colour = nwhite,\
-                 back_colour = black)
-
-#Show the welcome screen
-hat.set_pixels(screen_welc)
-    
-while(True):
-    
-    if (program_state == 0):#Main menu
-        check_stick_events(hat, curr_x)
-    elif(program_state == 1):#Outdoor HUD loop
-        # Always good to try and catch exceptions
-        #  when dealing with online stuff
-        #try:
-        run_outdoor_hud_loop(hat, curr_x)
-           # continue
-        #except:
-         #   print("Had some trouble at time: " + str(time.time()))
-          #  continue
-            
-    elif(program_state == 2):#Indoor HUD loop
-        run_indoor_hud_loop(hat, curr_x)
-    elif(program_state == 3):#3hr readout
-        run_3h_readout(hat, curr_x)
-    elif(program_state == 4):#8d readout
-        run_8d_readout(hat, curr_x)
-        
-    # Feel free to extend this! there are 4 more free
-    #  spots on the main menu bar to add mini sub programs
-    #  of your own! Just follow the function calls here and
-    #  you should be able to see how to add some
-    #  functionality of your own.
-    #
-    # See: (Ctrl+F) "SOME NEW READOUT OR LOOP"
-    
+#The built-in modes, by main menu slot (see MODE REGISTRY)
+mode_registry.register(0, OutdoorHud())
+mode_registry.register(1, IndoorHud())
+mode_registry.register(2, Readout3h())
+mode_registry.register(3, Readout8d())
+mode_registry.register(4, CityHud())
+mode_registry.register(5, Trends())
+
+def main(argv=None):
+    """Runs sWeather until it is stopped"""
+    global hat, history_log
+    args = parse_args(argv)
+    if(args.metrics_textfile):
+        metrics.export_textfile(args.metrics_textfile)
+    if(args.metrics_port):
+        metrics.serve(args.metrics_port)
+    hat = open_hat(args.backend)
+    hat.clear()
+
+    #The last data downloaded before the program stopped, so the
+    # outdoor HUD has something to show while it requests new data
+    forecast_cache.load_snapshot(SNAPSHOT_FILE)
+
+    #Modes listed in sWeather.cfg, in place of the built-in ones
+    register_modes(load_modes())
+
+    #The readings so far, for the trends
+    try:
+        history_log = HistoryLog(HISTORY_FILE)
+    except (OSError, ValueError) as problem:
+        print("No history, couldn't open " + HISTORY_FILE +
+              " (" + repr(problem) + ")")
+
+    try:
+        asyncio.run(run_sweather(args))
+    finally:
+        if(history_log is not None):
+            history_log.flush()
+        #Anything downloaded since the last refresh
+        forecast_cache.save_snapshot()
+
+async def discover_modes():
+    """Registers the installed modes (see find_mode_entry_points),
+       in the menu slots that are free"""
+    found = await in_thread(find_mode_entry_points)
+    register_modes(found, replace=False)
+    #Their images, if the menu is showing (the cursor is only on
+    # the menu bar once the welcome screen has been left)
+    if(found and scheduler.mode is None and 0 <= curr_x <= 7):
+        return_to_main_menu(hat, curr_x)
+
+async def run_sweather(args):
+    """Starts the tasks, then runs the main menu and the modes
+       on the event loop until the program is stopped"""
+    global scheduler, refresher, sensor_sampler, curr_x
+
+    #Everything waits on the joystick through this
+    scheduler = Scheduler(hat)
+    #Writes the frames every view draws
+    get_renderer(hat).start()
+
+    #Keeps the forecast data current whatever mode is showing, the
+    # first download happens while the welcome animation plays
+    refresher = ForecastRefresher(CITIES, scheduler, history=history_log)
+    #Keeps the indoor HUD's readings current
+    sensor_sampler = SensorSampler(hat, args.sample_rate, history=history_log)
+    #Kept here, the loop only keeps weak references to its tasks
+    tasks = [asyncio.ensure_future(refresher.run()),
+             asyncio.ensure_future(sensor_sampler.run()),
+             #Installed modes, looked for while the intro plays
+             asyncio.ensure_future(discover_modes())]
+
+    if(not args.no_intro):
+        await in_thread(play_intro, hat)
+
+    #Show the welcome screen
+    show_frame(hat, Frame(screen_welc), "welcome")
+    startup_mark("welcome screen")
+
+    slot = None
+    if(args.outdoor_hud):
+        curr_x = 0 #The outdoor HUD's spot on the menu bar
+        slot = curr_x
+
+    while(True):
+
+        if (slot is None):#Main menu
+            #Sleeps until the stick is used
+            events, due = await scheduler.wait()
+            with metrics.timer("menu_stick"):
+                slot = check_stick_events(events)
+        else:
+            # Always good to try and catch exceptions
+            #  when dealing with online stuff, a mode that
+            #  fails goes back to the main menu like up does
+            mode = mode_registry.get(slot)
+            if(mode is not None and
+               not await scheduler.run_mode(run_mode_hooks(mode, hat))):
+                metrics.count("mode_failures", mode=mode.name)
+                get_renderer(hat).forget()
+            slot = None
+            return_to_main_menu(hat, curr_x)
+
+        # Feel free to extend this! there are 2 more free
+        #  spots on the main menu bar to add mini sub programs
+        #  of your own! Just follow the function calls here and
+        #  you should be able to see how to add some
+        #  functionality of your own.
+        #
+        # See: (Ctrl+F) "SOME NEW READOUT OR LOOP"
+
+if __name__ == "__main__":
+    #Run as a script this module is __main__, and a mode's module that
+    # imports sWeather would get a second copy of it, with a Mode class
+    # of its own (so its modes would fail load_mode's check), and its
+    # own cache and scheduler. This way it gets this one
+    sys.modules.setdefault("sWeather", sys.modules[__name__])
+    main()
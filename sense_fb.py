@@ -0,0 +1,153 @@
+"""
+    A Sense Hat that writes straight to the led matrix's framebuffer
+
+The stock SenseHat.set_pixels checks all 64 pixels in Python, opens
+the framebuffer device, and seeks and writes each pixel's two bytes
+one at a time. FramebufferHat memory-maps the device once and writes
+whole frames into the mapping: the [R,G,B] pixels are packed to
+RGB565 with a few numpy operations into buffers made once, and only
+the rows that changed are copied to the device. Everything else
+(joystick, sensors, show_message...) is the stock SenseHat's.
+
+sWeather uses it for the sense_hat backend when the device is there,
+and the stock SenseHat otherwise (see open_sense_hat):
+
+    python3 sWeather.py --backend sense_hat
+
+"""
+
+import glob
+import mmap
+import os
+
+import numpy as np
+
+#What the Sense Hat's framebuffer driver calls itself in sysfs
+SENSE_FB_NAME = "RPi-Sense FB"
+#The led matrix, as (rows, columns) of 16 bit RGB565 pixels
+SENSE_FB_SHAPE = (8, 8)
+SENSE_FB_SIZE = SENSE_FB_SHAPE[0] * SENSE_FB_SHAPE[1] * 2
+
+def find_framebuffer(sysfs="/sys/class/graphics", dev="/dev"):
+    """Returns the /dev path of the Sense Hat's framebuffer, None if
+       there isn't one (the same search as SenseHat._get_fb_device)"""
+    for folder in sorted(glob.glob(os.path.join(sysfs, "fb*"))):
+        try:
+            with open(os.path.join(folder, "name")) as f:
+                name = f.read().strip()
+        except OSError:
+            continue
+        device = os.path.join(dev, os.path.basename(folder))
+        if(name == SENSE_FB_NAME and os.path.exists(device)):
+            return device
+    return None
+
+#------------------------- FRAMEBUFFER -------------------------#
+
+class Framebuffer(object):
+    """The led matrix's framebuffer device, memory-mapped"""
+
+    def __init__(self, device):
+        self.device = device
+        fd = os.open(device, os.O_RDWR)
+        try:
+            self.map = mmap.mmap(fd, SENSE_FB_SIZE, mmap.MAP_SHARED,
+                                 mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd) #The mapping keeps the device open
+        #The device's pixels, in the pi's own byte order like the
+        # stock SenseHat writes them
+        self.pixels = np.frombuffer(self.map, dtype=np.uint16).reshape(
+            SENSE_FB_SHAPE)
+        #Packed frame and scratch space, made once (see pack)
+        self.packed = np.zeros(SENSE_FB_SHAPE, dtype=np.uint16)
+        self.scratch = np.zeros(SENSE_FB_SHAPE, dtype=np.uint16)
+        #Which rows to copy, see write
+        self.rows = np.zeros((SENSE_FB_SHAPE[0], 1), dtype=bool)
+
+    def pack(self, pixels):
+        """Packs 8x8x3 [R,G,B] pixels into self.packed as RGB565,
+           (r >> 3) << 11 | (g >> 2) << 5 | b >> 3"""
+        packed, scratch = self.packed, self.scratch
+        np.right_shift(pixels[..., 0], 3, out=packed)
+        np.left_shift(packed, 11, out=packed)
+        np.right_shift(pixels[..., 1], 2, out=scratch)
+        np.left_shift(scratch, 5, out=scratch)
+        np.bitwise_or(packed, scratch, out=packed)
+        np.right_shift(pixels[..., 2], 3, out=scratch)
+        np.bitwise_or(packed, scratch, out=packed)
+        return packed
+
+    def write(self, rows=None):
+        """Copies the packed rows to the device, all of them if rows
+           is None"""
+        if(rows is None):
+            np.copyto(self.pixels, self.packed)
+        else:
+            self.rows[:] = False
+            self.rows[rows] = True
+            np.copyto(self.pixels, self.packed, where=self.rows)
+
+    def close(self):
+        self.pixels = None
+        self.map.close()
+
+#-------------------------- SENSE HAT --------------------------#
+
+# The stock SenseHat turns the pixels it is given to suit its
+#  rotation (set_rotation) before writing them. A frame is turned the
+#  same way here: a rotation of r degrees writes np.rot90(frame,
+#  -r // 90), which puts every pixel where SenseHat's own pixel maps
+#  would. Turned frames are always written whole, as their rows are
+#  the frame's columns.
+
+class FramebufferHat(object):
+    """A stock SenseHat whose set_pixels (and set_rows) write to the
+       memory-mapped framebuffer"""
+
+    def __init__(self, hat, device):
+        self.hat = hat
+        self.framebuffer = Framebuffer(device)
+        #Frame converted from a pixel list by set_pixels
+        self.frame = np.zeros(SENSE_FB_SHAPE + (3,), dtype=np.uint8)
+
+    def __getattr__(self, name):
+        #Only called for what isn't defined here
+        return getattr(self.hat, name)
+
+    def set_rows(self, pixels, rows):
+        """Shows the given rows of an 8x8x3 uint8 frame"""
+        rotation = self.hat.rotation
+        if(rotation):
+            self.framebuffer.pack(np.rot90(pixels, -rotation // 90))
+            self.framebuffer.write()
+        else:
+            self.framebuffer.pack(pixels)
+            self.framebuffer.write(rows)
+
+    def set_pixels(self, pixel_list):
+        """The same as SenseHat.set_pixels, a list of 64 [R,G,B]"""
+        pixels = np.asarray(pixel_list)
+        if(pixels.shape != (64, 3)):
+            if(len(pixel_list) != 64):
+                raise ValueError('Pixel lists must have 64 elements')
+            raise ValueError('Pixels must contain 3 elements: Red, Green and Blue')
+        if(pixels.min() < 0 or pixels.max() > 255):
+            raise ValueError('Pixel elements must be between 0 and 255')
+        self.frame[:] = pixels.reshape(self.frame.shape)
+        self.set_rows(self.frame, None)
+
+def open_sense_hat():
+    """Returns a FramebufferHat, or the stock SenseHat if its
+       framebuffer can't be mapped"""
+    from sense_hat import SenseHat
+    hat = SenseHat()
+    device = find_framebuffer()
+    if(device is None):
+        return hat
+    try:
+        return FramebufferHat(hat, device)
+    except (OSError, ValueError) as problem:
+        print("Writing to the led matrix through SenseHat, couldn't map "
+              "%s: %s" % (device, problem))
+        return hat
@@ -0,0 +1,241 @@
+"""
+    A headless Sense Hat for sWeather
+
+HeadlessHat has the parts of the SenseHat API that sWeather uses, but
+keeps the led matrix in memory, so sWeather can be run, timed and
+tested on any Linux box without a Sense Hat or the emulator's window:
+
+    python3 sWeather.py --backend headless
+
+Every call that writes to the led matrix is recorded with the time it
+was made. Joystick events and sensor values can be scripted ahead of
+time, and are replayed when the program asks for them.
+
+"""
+
+import collections
+import heapq
+import importlib.util
+import os
+import threading
+import time
+
+#The same fields as sense_hat.stick.InputEvent
+InputEvent = collections.namedtuple("InputEvent",
+                                    ("timestamp", "direction", "action"))
+
+#The sensor values a new HeadlessHat reads
+DEFAULT_SENSORS = {"temperature": 21.0, #Celsius
+                   "humidity": 45.0,    #Relative %
+                   "pressure": 1013.0}  #Millibars
+
+#--------------------------- JOYSTICK ---------------------------#
+
+class HeadlessStick(object):
+    """A joystick that replays events pushed or scripted ahead of
+       time, like SenseStick it blocks until there is one"""
+
+    def __init__(self):
+        #(due time, order pushed, direction, action)
+        self.pending = []
+        self.pushed = 0
+        self.ready = threading.Condition()
+
+    def push(self, direction, action="pressed", delay=0):
+        """Queues an event that happens delay seconds from now"""
+        with self.ready:
+            heapq.heappush(self.pending, (time.time() + delay, self.pushed,
+                                          direction, action))
+            self.pushed += 1
+            self.ready.notify_all()
+
+    def script(self, events):
+        """Queues (seconds from now, direction[, action]) events"""
+        for event in events:
+            self.push(event[1], *event[2:], delay=event[0])
+
+    def press(self, direction, delay=0):
+        """Queues a press and release of direction"""
+        self.push(direction, "pressed", delay)
+        self.push(direction, "released", delay)
+
+    def _pop(self, timeout):
+        """Returns the next event once it is due, or None if there
+           is none within timeout seconds (None waits forever)"""
+        end = None if timeout is None else time.time() + timeout
+        with self.ready:
+            while(True):
+                now = time.time()
+                wait = None if end is None else end - now
+                if(self.pending):
+                    due = self.pending[0][0]
+                    if(due <= now):
+                        due, _, direction, action = heapq.heappop(self.pending)
+                        return InputEvent(due, direction, action)
+                    wait = due - now if wait is None else min(wait, due - now)
+                if(wait is not None and wait <= 0):
+                    return None
+                self.ready.wait(wait)
+
+    def wait_for_event(self, emptybuffer=False):
+        """Blocks until the next event is due, and returns it"""
+        if(emptybuffer):
+            self.get_events()
+        return self._pop(None)
+
+    def get_events(self):
+        """Returns every event that is due, without waiting"""
+        events = []
+        while(True):
+            event = self._pop(0)
+            if(event is None):
+                return events
+            events.append(event)
+
+#--------------------------- SENSE HAT ---------------------------#
+
+class HeadlessHat(object):
+    """An in-memory Sense Hat that records what is drawn on it"""
+
+    def __init__(self, sensors=None):
+        self.stick = HeadlessStick()
+        self.low_light = False
+        self.rotation = 0
+        self.pixels = [[0, 0, 0] for i in range(64)]
+        #(time.perf_counter(), call name, details) for every call
+        # that wrote to the led matrix
+        self.calls = []
+        #Sensor name: values still to be read, the last one is kept
+        self.sensors = {}
+        for name, value in DEFAULT_SENSORS.items():
+            self.sensors[name] = collections.deque([value])
+        for name, values in (sensors or {}).items():
+            self.script_sensor(name, values)
+        self.font = load_font()
+
+    def _record(self, name, details=None):
+        self.calls.append((time.perf_counter(), name, details))
+
+    #-- Call accounting
+
+    def counts(self):
+        """Returns how many times each drawing call was made"""
+        return dict(collections.Counter(call[1] for call in self.calls))
+
+    def reset_calls(self):
+        """Forgets the recorded calls"""
+        self.calls = []
+
+    #-- Led matrix
+
+    def set_rotation(self, r=0, redraw=True):
+        self.rotation = r
+
+    def set_pixel(self, x, y, *args):
+        pixel = list(args[0] if len(args) == 1 else args)
+        self.pixels[y * 8 + x] = pixel
+        self._record("set_pixel", (x, y, pixel))
+
+    def get_pixel(self, x, y):
+        return list(self.pixels[y * 8 + x])
+
+    def set_pixels(self, pixel_list):
+        if len(pixel_list) != 64:
+            raise ValueError('Pixel lists must have 64 elements')
+        self.pixels = [list(pixel) for pixel in pixel_list]
+        self._record("set_pixels")
+
+    def get_pixels(self):
+        return [list(pixel) for pixel in self.pixels]
+
+    def clear(self, *args):
+        colour = list(args[0] if len(args) == 1 else args or (0, 0, 0))
+        self.pixels = [list(colour) for i in range(64)]
+        self._record("clear", colour)
+
+    def show_message(self, text_string, scroll_speed=.1,
+                     text_colour=[255, 255, 255], back_colour=[0, 0, 0]):
+        """Recorded, but returns straight away instead of scrolling,
+           and leaves the screen blank like the end of a real scroll"""
+        self.pixels = [list(back_colour) for i in range(64)]
+        self._record("show_message", text_string)
+
+    def show_letter(self, s, text_colour=[255, 255, 255],
+                    back_colour=[0, 0, 0]):
+        if len(s) > 1:
+            raise ValueError('Only one character may be passed into this method')
+        self.pixels = [list(back_colour) for i in range(64)]
+        self._record("show_letter", s)
+
+    def _get_char_pixels(self, s):
+        """The same as SenseHat._get_char_pixels, 40 pixels stored
+           rotated (see sense_hat)"""
+        if len(s) == 1 and s in self.font:
+            return list(self.font[s])
+        return list(self.font['?'])
+
+    #-- Sensors
+
+    def script_sensor(self, name, values):
+        """Sets the values the next reads of a sensor return, in
+           order. The last one is returned from then on"""
+        self.sensors[name] = collections.deque(values)
+
+    def _read(self, name):
+        values = self.sensors[name]
+        if(len(values) > 1):
+            return values.popleft()
+        return values[0]
+
+    def get_temperature(self):
+        return self._read("temperature")
+
+    get_temperature_from_humidity = get_temperature
+    get_temperature_from_pressure = get_temperature
+
+    def get_humidity(self):
+        return self._read("humidity")
+
+    def get_pressure(self):
+        return self._read("pressure")
+
+    @property
+    def temp(self):
+        return self.get_temperature()
+
+    temperature = temp
+
+    @property
+    def humidity(self):
+        return self.get_humidity()
+
+    @property
+    def pressure(self):
+        return self.get_pressure()
+
+#----------------------------- FONT -----------------------------#
+
+# The scroller in sWeather draws text with the hat's own font. That
+#  comes from the sense_hat package's text image if sense_hat and PIL
+#  are installed (only the image is read, sense_hat isn't imported),
+#  and otherwise every character is a plain 3 column block, which
+#  scrolls just as fast.
+
+def load_font():
+    """Returns the font as {character: 40 [R,G,B] pixels}"""
+    spec = importlib.util.find_spec("sense_hat")
+    if(spec is not None and spec.origin is not None):
+        folder = os.path.dirname(spec.origin)
+        try:
+            from PIL import Image
+            image = Image.open(os.path.join(folder, "sense_hat_text.png"))
+            pixels = [[255, 255, 255] if pixel[:3] == (255, 255, 255)
+                      else [0, 0, 0]
+                      for pixel in image.convert("RGB").getdata()]
+            with open(os.path.join(folder, "sense_hat_text.txt")) as f:
+                text = f.read()
+            return {s: pixels[i * 40:i * 40 + 40] for i, s in enumerate(text)}
+        except (ImportError, OSError):
+            pass
+    block = [[0, 0, 0]] * 8 + [[255, 255, 255]] * 24 + [[0, 0, 0]] * 8
+    return collections.defaultdict(lambda: block, {'?': block})
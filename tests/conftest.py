@@ -0,0 +1,51 @@
+"""
+    Shared pieces for the sWeather tests
+
+Run them from the top folder with:
+
+    python3 -m pytest tests
+
+Nothing here needs a Sense Hat, a network or pyowm.
+
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+#sWeather.py is a script in the folder above, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sWeather as sw
+
+class FakeClock(object):
+    """Stands in for the time module: time() only moves when sleep()
+       or advance() is called, everything else is the real module's"""
+
+    def __init__(self, now=1500000000.0):
+        self.now = now
+        #Called with the seconds before each sleep moves the time
+        self.on_sleep = None
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if(self.on_sleep is not None):
+            self.on_sleep(seconds)
+        self.now += seconds
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A FakeClock that sWeather reads the time from"""
+    fake = FakeClock()
+    monkeypatch.setattr(sw, "time", fake)
+    return fake
@@ -0,0 +1,22 @@
+"""The weather code palette against the W_CODES lookup it replaced"""
+
+import numpy as np
+import pytest
+
+import sWeather as sw
+
+def test_known_codes_match_w_codes():
+    codes = sorted(sw.W_CODES)
+    expected = [list(sw.W_CODES[code][0]) for code in codes]
+    assert sw.weather_code_colors(codes).tolist() == expected
+
+@pytest.mark.parametrize("code", [0, -1, 1, 199, 999, 1000, 12345])
+def test_unknown_code_gets_fallback(code):
+    assert code not in sw.W_CODES
+    assert sw.weather_code_colors([code]).tolist() == [list(sw.unknown_code)]
+
+def test_unknown_codes_among_known_ones():
+    colors = sw.weather_code_colors(np.array([800, 1000, 500, 0]))
+    assert colors.tolist() == [list(sw.W_CODES[800][0]), list(sw.unknown_code),
+                               list(sw.W_CODES[500][0]), list(sw.unknown_code)]
+    assert colors.dtype == np.uint8
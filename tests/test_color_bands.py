@@ -0,0 +1,116 @@
+"""ColorBands against the if/elif thresholds they replaced"""
+
+import numpy as np
+import pytest
+
+import sWeather as sw
+
+def cold_ok_or_hot(temp_then):
+    if(temp_then >= 80.00):
+        return sw.hot
+    elif(temp_then >= 60.00 and temp_then < 80.00):
+        return sw.ok
+    elif(temp_then < 60.00 and temp_then >= 50.00):
+        return sw.almost_ok
+    elif(temp_then < 50.00 and temp_then >= 40.00):
+        return sw.cold
+    elif(temp_then < 40.00 and temp_then > 33.00):
+        return sw.very_cold
+    elif(temp_then <= 33.00):
+        return sw.freezing
+
+def dry_humid_or_ok(humi_then):
+    if(humi_then >= 55 and humi_then <= 65):
+        return sw.humi_ok
+    elif(humi_then < 55):
+        return sw.humi_low
+    elif(humi_then > 65):
+        return sw.humi_hi
+
+def pres_lo_hi_or_ok(pres_then):
+    if pres_then < 979.00:
+        return sw.pres_low
+    elif pres_then >= 979.00 and pres_then <= 1027.00:
+        return sw.pres_ok
+    elif(pres_then > 1027.00):
+        return sw.pres_hi
+
+def default_bands(name):
+    unit, edges, colors = sw.BAND_DEFAULTS[name]
+    return sw.ColorBands(edges, colors, sw.BAND_UNITS[name][unit])
+
+def around(edges):
+    """Each edge, and the readings just below and above it"""
+    edges = np.asarray(edges, dtype=float)
+    return np.concatenate((edges, np.nextafter(edges, -np.inf),
+                           np.nextafter(edges, np.inf), edges - 0.5,
+                           edges + 0.5))
+
+@pytest.mark.parametrize("name, old, edges", [
+    ("temperature", cold_ok_or_hot, [33, 40, 50, 60, 80]),
+    ("humidity", dry_humid_or_ok, [55, 65]),
+    ("pressure", pres_lo_hi_or_ok, [979, 1027]),
+])
+def test_default_bands_match_old_thresholds(name, old, edges):
+    readings = np.concatenate((around(edges), np.linspace(-40, 1100, 500)))
+    expected = np.array([old(reading) for reading in readings], dtype=np.uint8)
+    assert np.array_equal(default_bands(name).colors(readings), expected)
+
+def test_greater_than_edge_starts_just_above():
+    bands = sw.ColorBands(">10, 20", [[1, 0, 0], [2, 0, 0], [3, 0, 0]])
+    colors = bands.colors([10, np.nextafter(10, np.inf), 19.99, 20])[:, 0]
+    assert colors.tolist() == [1, 2, 2, 3]
+
+def test_nan_reading_gets_fallback():
+    bands = default_bands("humidity")
+    assert bands.colors([np.nan])[0].tolist() == list(sw.no_reading)
+
+def test_celsius_edges():
+    bands = sw.ColorBands(">0.5, 4.5, 10, 15.5, 26.5",
+                          sw.BAND_DEFAULTS["temperature"][2],
+                          sw.BAND_UNITS["temperature"]["C"])
+    assert bands.colors([32.0, 90.0]).tolist() == [sw.freezing, sw.hot]
+
+@pytest.mark.parametrize("edges, colors", [
+    ("10, 20", [[0, 0, 0]] * 2), #One color short
+    ("20, 10", [[0, 0, 0]] * 3), #Not increasing
+    ("10, 10", [[0, 0, 0]] * 3), #The same edge twice
+])
+def test_bad_bands_are_refused(edges, colors):
+    with pytest.raises(ValueError):
+        sw.ColorBands(edges, colors)
+
+def test_edge_and_just_above_it_are_increasing():
+    bands = sw.ColorBands("10, >10", [[1, 0, 0], [2, 0, 0], [3, 0, 0]])
+    assert bands.colors([9, 10, 11])[:, 0].tolist() == [1, 2, 3]
+
+def config(text):
+    parsed = sw.configparser.ConfigParser()
+    parsed.read_string(text)
+    return parsed
+
+def test_config_sets_unit_and_edges():
+    bands = sw.load_color_bands(config("[temperature]\n"
+                                       "unit = C\n"
+                                       "edges = 0, 5, 10, 15, 25\n"))
+    assert bands["temperature"].colors([32.0, 31.0]).tolist() == \
+        [sw.very_cold, sw.freezing]
+
+@pytest.mark.parametrize("settings", [
+    "unit = K\n", #Not a temperature unit
+    "edges = 10, cold\n", #Not a number
+    "edges = 50, 40, 30, 20, 10\n", #Not increasing
+    "edges = 10, 20\n", #Too few for the colors
+    "unit = 100%\n", #Not even a configparser value
+])
+def test_bad_config_keeps_the_defaults(settings, capsys):
+    bands = sw.load_color_bands(config("[temperature]\n" + settings +
+                                       "[humidity]\nedges = 40, 70\n"))
+    readings = np.linspace(-40, 120, 200)
+    assert np.array_equal(bands["temperature"].colors(readings),
+                          default_bands("temperature").colors(readings))
+    assert "Had some trouble reading the temperature bands" in \
+        capsys.readouterr().out
+    #The other bands still get their settings
+    assert bands["humidity"].colors([50, 60]).tolist() == \
+        [sw.humi_ok, sw.humi_ok]
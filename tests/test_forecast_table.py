@@ -0,0 +1,150 @@
+"""ForecastTable, from pyowm-like weathers and through the snapshot file"""
+
+import datetime
+
+import numpy as np
+import pytest
+
+import sWeather as sw
+
+class Weather(object):
+    """The parts of a pyowm Weather that ForecastTable reads"""
+
+    def __init__(self, time, code, temps, humidity, pressure, wind, status):
+        self.time = time
+        self.code = code
+        self.temps = temps
+        self.humidity = humidity
+        self.pressure = pressure
+        self.wind = wind
+        self.status = status
+
+    def get_reference_time(self):
+        return self.time
+
+    def get_weather_code(self):
+        return self.code
+
+    def get_temperature(self, unit):
+        assert unit == "fahrenheit"
+        return self.temps
+
+    def get_humidity(self):
+        return self.humidity
+
+    def get_pressure(self):
+        return {"press": self.pressure, "sea_level": None}
+
+    def get_wind(self):
+        return self.wind
+
+    def get_detailed_status(self):
+        return self.status
+
+T0 = 1500000000
+
+def weathers():
+    return [Weather(T0, 800, {"temp": 71.5}, 40, 1013, {"speed": 3.5},
+                    "clear sky"),
+            #Daily forecasts have "day" instead of "temp", and some
+            # have no wind speed
+            Weather(T0 + 10800, 500, {"day": 60.0, "night": 50.0}, 90, 1001,
+                    {}, "light rain")]
+
+def test_from_weathers_reads_every_column():
+    table = sw.ForecastTable.from_weathers(weathers(), T0 + 5)
+    assert len(table) == 2
+    assert table.fetched == T0 + 5
+    assert table["time"].tolist() == [T0, T0 + 10800]
+    assert table["code"].tolist() == [800, 500]
+    assert table["temp"].tolist() == [71.5, 60.0]
+    assert table["humidity"].tolist() == [40, 90]
+    assert table["pressure"].tolist() == [1013, 1001]
+    assert table["wind"][0] == 3.5
+    assert np.isnan(table["wind"][1])
+    assert table.statuses() == ["clear sky", "light rain"]
+    assert table.dates() == [
+        datetime.datetime(2017, 7, 14, 2, 40, tzinfo=datetime.timezone.utc),
+        datetime.datetime(2017, 7, 14, 5, 40, tzinfo=datetime.timezone.utc)]
+
+def test_row_shares_the_tables_memory():
+    table = sw.ForecastTable.from_weathers(weathers(), T0)
+    row = table.row(1)
+    assert len(row) == 1 and row.fetched == T0
+    assert row["code"].tolist() == [500]
+    row.rows["temp"] = 0
+    assert table["temp"][1] == 0
+
+def test_staleness(clock):
+    table = sw.ForecastTable.from_weathers(weathers(), clock.time())
+    clock.advance(90)
+    assert table.staleness() == 90
+
+def test_snapshot_round_trip(clock, tmp_path):
+    path = str(tmp_path / "forecast.snapshot")
+    cache = sw.ForecastCache(snapshot_file=path)
+    table = sw.ForecastTable.from_weathers(weathers(), clock.time())
+    cache.store("3h", {1: table, 2: table.row(0)})
+    clock.advance(60)
+    cache.store("observation", {1: table.row(1)})
+    cache.save_snapshot()
+
+    loaded = sw.ForecastCache()
+    assert loaded.load_snapshot(path)
+    assert sorted(loaded.entries) == [(1, "3h"), (1, "observation"),
+                                      (2, "3h")]
+    for key, (fetched, saved) in cache.entries.items():
+        loaded_fetched, again = loaded.entries[key]
+        #Keeps when it was fetched, so old data still shows up as stale
+        assert loaded_fetched == fetched == again.fetched
+        for column in sw.FORECAST_COLUMNS:
+            assert np.array_equal(again[column], saved[column],
+                                  equal_nan=column == "wind")
+        assert again.statuses() == saved.statuses()
+
+def test_snapshot_is_only_written_after_changes(clock, tmp_path):
+    path = tmp_path / "forecast.snapshot"
+    cache = sw.ForecastCache(snapshot_file=str(path))
+    cache.save_snapshot()
+    assert not path.exists()
+    cache.store("daily", {1: sw.ForecastTable.from_weathers(weathers(), T0)})
+    cache.save_snapshot()
+    assert path.exists()
+    path.write_bytes(b"left alone")
+    cache.save_snapshot()
+    assert path.read_bytes() == b"left alone"
+
+@pytest.mark.parametrize("contents", [
+    b"", #Empty
+    b"not a snapshot at all",
+    sw.SNAPSHOT_MAGIC + b"\0" * (sw.SNAPSHOT_DTYPE.itemsize - 1), #Cut short
+])
+def test_unusable_snapshot_is_ignored(tmp_path, contents):
+    path = tmp_path / "forecast.snapshot"
+    path.write_bytes(contents)
+    cache = sw.ForecastCache()
+    assert not cache.load_snapshot(str(path))
+    assert not cache.load_snapshot(str(tmp_path / "missing"))
+    assert cache.entries == {}
+
+class Refresher(object):
+    def __init__(self):
+        self.woken = 0
+
+    def refresh_now(self):
+        self.woken += 1
+
+def test_outdoor_hud_refreshes_data_older_than_a_refresh(clock, monkeypatch):
+    cache = sw.ForecastCache()
+    refresher = Refresher()
+    monkeypatch.setattr(sw, "forecast_cache", cache)
+    monkeypatch.setattr(sw, "refresher", refresher)
+    sw.OutdoorHud().enter() #Nothing yet, the first refresh is going
+    table = sw.ForecastTable.from_weathers(weathers()[:1], clock.time())
+    cache.store("observation", {sw.SomeCity: table})
+    clock.advance(sw.REFRESH_RATE)
+    sw.OutdoorHud().enter()
+    assert refresher.woken == 0
+    clock.advance(1)
+    sw.OutdoorHud().enter()
+    assert refresher.woken == 1
@@ -0,0 +1,104 @@
+"""Frame compositing, bars clipped to the frame, and the indoor HUD's bars"""
+
+import numpy as np
+
+import sWeather as sw
+
+def test_new_frame_is_one_color():
+    assert (sw.Frame().pixels == 0).all()
+    assert (sw.Frame(color=sw.red).pixels == sw.red).all()
+
+def test_set_pixel_is_column_then_row():
+    frame = sw.Frame()
+    frame.set_pixel(2, 5, sw.green)
+    assert frame.pixels[5, 2].tolist() == sw.green
+    assert frame.to_list()[5 * 8 + 2] == sw.green
+    assert np.count_nonzero(frame.pixels.any(axis=2)) == 1
+
+def test_set_pixels_takes_a_list_or_an_array():
+    pixels = [[i, 64 - i, i % 8] for i in range(64)]
+    frame = sw.Frame(pixels)
+    assert frame.to_list() == pixels
+    assert sw.Frame(frame.pixels).to_list() == pixels
+
+def test_fill_row_and_clear():
+    frame = sw.Frame()
+    frame.fill_row(3, sw.blue, start=2, stop=5)
+    lit = frame.pixels.any(axis=2)
+    assert np.flatnonzero(lit[3]).tolist() == [2, 3, 4]
+    assert lit.sum() == 3
+    #Columns past the edge are left out
+    frame.fill_row(4, sw.blue, start=6, stop=12)
+    assert np.flatnonzero(frame.pixels[4].any(axis=1)).tolist() == [6, 7]
+    frame.clear(sw.white)
+    assert (frame.pixels == sw.white).all()
+
+def test_sprite_draws_only_its_mask():
+    frame = sw.Frame(color=sw.nwhite)
+    mask = np.zeros((8, 8), dtype=bool)
+    mask[0, 0] = mask[7, 7] = True
+    frame.draw_sprite(mask, sw.red)
+    assert frame.pixels[mask].tolist() == [sw.red, sw.red]
+    assert (frame.pixels[~mask] == sw.nwhite).all()
+
+def test_copy_is_independent():
+    frame = sw.Frame()
+    copy = frame.copy()
+    copy.set_pixel(0, 0, sw.red)
+    assert (frame.pixels == 0).all()
+
+def test_bar_is_drawn_bottom_up():
+    screen = np.zeros((8, 8, 3), dtype=np.uint8)
+    sw.render_bar(screen, (3, 0), 2, 3, sw.green)
+    lit = screen.any(axis=2)
+    assert lit[5:, 3:5].all()
+    assert lit.sum() == 6
+
+def test_bar_is_clipped_to_the_frame():
+    screen = np.zeros((8, 8, 3), dtype=np.uint8)
+    sw.render_bar(screen, (6, 0), 4, 12, sw.blue)
+    lit = screen.any(axis=2)
+    assert lit[:, 6:].all()
+    assert lit.sum() == 16
+    #Nothing at all for an empty or negative bar
+    screen[:] = 0
+    sw.render_bar(screen, (0, 0), 2, 0, sw.red)
+    sw.render_bar(screen, (0, 0), 2, -3, sw.red)
+    assert not screen.any()
+
+def test_readings_out_of_range_fill_or_empty_the_bars():
+    for reading, rows in ((-40, 0), (50, 4), (150, 8)):
+        height = round(sw.scale(sw.clamp_2(reading, 0, 100), 0, 100))
+        screen = np.zeros((8, 8, 3), dtype=np.uint8)
+        sw.render_bar(screen, (0, 0), 2, height, sw.red)
+        assert screen[:, 0].any(axis=1).sum() == rows
+
+class UnreadHat(object):
+    """Fails the test if its sensors are read"""
+
+    def get_temperature_from_humidity(self):
+        raise AssertionError("read on the render path")
+
+    pressure = humidity = property(get_temperature_from_humidity)
+
+def test_readings_without_a_sample_are_placeholders(monkeypatch):
+    hat = UnreadHat()
+    monkeypatch.setattr(sw, "sensor_sampler", None)
+    placeholder = sw.render_readings(hat).pixels
+    #Sampling another hat doesn't count either
+    monkeypatch.setattr(sw, "sensor_sampler", sw.SensorSampler(object()))
+    assert np.array_equal(sw.render_readings(hat).pixels, placeholder)
+    monkeypatch.setattr(sw, "sensor_sampler", sw.SensorSampler(hat))
+    assert np.array_equal(sw.render_readings(hat).pixels, placeholder)
+    assert (placeholder[7, [0, 1, 3, 4, 6, 7]] == sw.no_reading).all()
+    assert (placeholder[:7] == sw.nwhite).all()
+
+def test_readings_come_from_the_sampler(monkeypatch):
+    from sense_headless import HeadlessHat
+    hat = HeadlessHat({"temperature": [10.0], #50 F
+                       "pressure": [1050.0], "humidity": [25.0]})
+    sampler = sw.SensorSampler(hat)
+    sampler.sample()
+    monkeypatch.setattr(sw, "sensor_sampler", sampler)
+    lit = (sw.render_readings(hat).pixels != sw.nwhite).any(axis=2)
+    assert lit[:, [0, 3, 6]].sum(axis=0).tolist() == [4, 8, 2]
@@ -0,0 +1,146 @@
+"""HistoryLog: rings, minute and hour averages, reopening, trends"""
+
+import numpy as np
+import pytest
+
+import sWeather as sw
+
+#Small rings, so they wrap around within a test
+TIERS = (("raw", 0, 8), ("minute", 60, 5), ("hour", 3600, 4))
+#The start of an hour
+T0 = 1500004800.0
+TEMP = "indoor temperature"
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "test.history")
+
+def open_log(path):
+    return sw.HistoryLog(path, tiers=TIERS)
+
+def values(rows, channel=TEMP):
+    return rows["values"][:, sw.HISTORY_CHANNELS.index(channel)].tolist()
+
+def test_raw_ring_wraps_oldest_first(path):
+    log = open_log(path)
+    for i in range(11):
+        log.record({TEMP: i}, T0 + i)
+    rows = log.records("raw")
+    assert rows["time"].tolist() == [T0 + i for i in range(3, 11)]
+    assert values(rows) == list(range(3, 11))
+    assert values(log.records("raw", since=T0 + 9)) == [9, 10]
+    log.close()
+
+def test_minute_average_is_written_when_the_minute_ends(path):
+    log = open_log(path)
+    log.record({TEMP: 10}, T0)
+    log.record({TEMP: 20, "outdoor pressure": 1000}, T0 + 30)
+    assert len(log.records("minute")) == 0
+    log.record({TEMP: 99}, T0 + 60)
+    rows = log.records("minute")
+    assert rows["time"].tolist() == [T0]
+    assert values(rows) == [15]
+    assert values(rows, "outdoor pressure") == [1000]
+    #No values at all for a channel is NaN
+    assert np.isnan(values(rows, "indoor humidity")[0])
+    log.close()
+
+def test_late_record_goes_in_the_current_minute(path):
+    log = open_log(path)
+    log.record({TEMP: 10}, T0 + 60)
+    log.record({TEMP: 20}, T0 + 30)
+    log.record({TEMP: 0}, T0 + 120)
+    rows = log.records("minute")
+    assert rows["time"].tolist() == [T0 + 60]
+    assert values(rows) == [15]
+    log.close()
+
+def test_minutes_cascade_into_hours(path):
+    log = open_log(path)
+    for minute in range(61):
+        log.record({TEMP: minute}, T0 + 60 * minute)
+    #Minute 60 is still going, so the hour hasn't ended yet
+    assert len(log.records("hour")) == 0
+    log.record({TEMP: 0}, T0 + 3660)
+    rows = log.records("hour")
+    assert rows["time"].tolist() == [T0]
+    assert values(rows) == [pytest.approx(29.5)]
+    #The minute ring only keeps the last 5
+    minutes = log.records("minute")
+    assert minutes["time"].tolist() == [T0 + 60 * m for m in range(56, 61)]
+    log.close()
+
+def test_hour_ring_wraps(path):
+    log = open_log(path)
+    for hour in range(7):
+        log.record({TEMP: hour}, T0 + 3600 * hour)
+        log.record({TEMP: hour}, T0 + 3600 * hour + 60)
+    #Ends the last minute of hour 6, hour 6 only ends with a minute
+    # of hour 7
+    log.record({TEMP: 0}, T0 + 3600 * 7 + 60)
+    rows = log.records("hour")
+    assert rows["time"].tolist() == [T0 + 3600 * h for h in range(2, 6)]
+    assert values(rows) == [2, 3, 4, 5]
+    log.close()
+
+def test_reopen_resumes_the_minute_and_hour_going(path):
+    log = open_log(path)
+    log.record({TEMP: 10}, T0)
+    log.record({TEMP: 20}, T0 + 60)
+    log.record({TEMP: 30}, T0 + 70)
+    log.close()
+
+    log = open_log(path)
+    assert values(log.records("raw")) == [10, 20, 30]
+    assert values(log.records("minute")) == [10]
+    #The minute from T0 + 60 carries on where it was
+    log.record({TEMP: 40}, T0 + 80)
+    log.record({TEMP: 0}, T0 + 120)
+    assert values(log.records("minute")) == [10, 30]
+    #...and so does the hour, from the minutes
+    log.record({TEMP: 0}, T0 + 3600)
+    log.record({TEMP: 0}, T0 + 3660)
+    hours = log.records("hour")
+    assert hours["time"].tolist() == [T0]
+    assert values(hours) == [pytest.approx((10 + 30 + 0) / 3)]
+    log.close()
+
+def test_reopen_keeps_wrapped_rings(path):
+    log = open_log(path)
+    for i in range(11):
+        log.record({TEMP: i}, T0 + i)
+    log.close()
+    log = open_log(path)
+    assert values(log.records("raw")) == list(range(3, 11))
+    log.close()
+
+def test_other_files_are_replaced(path):
+    with open(path, "wb") as f:
+        f.write(b"not a history file")
+    log = open_log(path)
+    assert len(log.records("raw")) == 0
+    log.close()
+
+def test_trend_buckets_by_span(path):
+    log = open_log(path)
+    for minute, temp in enumerate((10, 20, 30, 40)):
+        log.record({TEMP: temp}, T0 + 60 * minute)
+        log.record({TEMP: temp + 2}, T0 + 60 * minute + 30)
+    log.record({TEMP: 0}, T0 + 240)
+    #Columns of 2 minutes each, the last 4 columns up to T0 + 360
+    trend = log.trend(TEMP, "minute", 120, columns=4, now=T0 + 360)
+    assert np.isnan(trend[0])
+    assert trend[1:].tolist() == [16, 36, 0]
+    log.close()
+
+def test_trend_counts_the_minute_still_going(path):
+    log = open_log(path)
+    log.record({TEMP: 10}, T0)
+    log.record({TEMP: 20}, T0 + 10)
+    trend = log.trend(TEMP, "minute", 60, columns=2, now=T0 + 30)
+    assert np.isnan(trend[0])
+    assert trend[1] == 15
+    #No values for a channel leaves every span empty
+    assert np.isnan(log.trend("outdoor humidity", "minute", 60,
+                              columns=2, now=T0 + 30)).all()
+    log.close()
@@ -0,0 +1,95 @@
+"""ModeRegistry, with modes registered as they are and from specs"""
+
+import numpy as np
+import pytest
+
+import sWeather as sw
+
+PLUGIN = '''
+import numpy as np
+import sWeather as sw
+
+class Listed(sw.Mode):
+    name = "listed"
+    sprite = ["........"] + ["#......."] * 7
+
+class Masked(sw.Mode):
+    name = "masked"
+    sprite = np.eye(8, dtype=bool)
+
+class NoSprite(sw.Mode):
+    name = "no sprite"
+
+class WrongShape(sw.Mode):
+    name = "wrong shape"
+    sprite = np.ones((8, 7), dtype=bool)
+
+class WrongType(sw.Mode):
+    name = "wrong type"
+    sprite = np.ones((8, 8, 3), dtype=np.uint8) * 255
+
+class ShortList(sw.Mode):
+    name = "short list"
+    sprite = ["####"] * 8
+
+NotAMode = object()
+'''
+
+@pytest.fixture
+def plugin(tmp_path, monkeypatch):
+    (tmp_path / "sweather_test_plugin.py").write_text(PLUGIN)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    return "sweather_test_plugin:"
+
+def test_good_sprites_are_masks(plugin):
+    registry = sw.ModeRegistry()
+    for slot, attr in enumerate(("Listed", "Masked", "NoSprite")):
+        registry.register(slot, plugin + attr)
+    assert registry.get(0).sprite[1:, 0].all()
+    assert registry.get(0).sprite.sum() == 7
+    assert np.array_equal(registry.get(1).sprite, np.eye(8, dtype=bool))
+    assert registry.get(2).sprite is None
+    assert registry.sprite(2) is sw.MODE_SPRITE
+    #Before it is loaded, a spec shows MODE_SPRITE too
+    registry.register(3, plugin + "Listed")
+    assert registry.sprite(3) is sw.MODE_SPRITE
+
+@pytest.mark.parametrize("attr", ["WrongShape", "WrongType", "ShortList",
+                                  "NotAMode", "Missing"])
+def test_bad_modes_leave_the_slot_empty(plugin, attr, capsys):
+    registry = sw.ModeRegistry()
+    registry.register(5, plugin + attr)
+    assert 5 in registry
+    assert registry.get(5) is None
+    assert 5 not in registry
+    assert registry.sprite(5) is None
+    assert "Had some trouble loading " + plugin + attr + " for menu slot 5" \
+        in capsys.readouterr().out
+
+def test_registered_mode_sprite_is_checked_straight_away(capsys):
+    registry = sw.ModeRegistry()
+
+    class Listed(sw.Mode):
+        name = "listed"
+        sprite = ["#######."] * 8
+
+    class WrongShape(sw.Mode):
+        name = "wrong shape"
+        sprite = np.ones((4, 4), dtype=bool)
+
+    registry.register(0, Listed())
+    assert registry.sprite(0).shape == (8, 8)
+    registry.register(1, WrongShape())
+    assert registry.get(1) is None and registry.sprite(1) is None
+    assert "Had some trouble loading wrong shape for menu slot 1" in \
+        capsys.readouterr().out
+    #A good mode in its place clears the failure
+    registry.register(1, Listed())
+    assert registry.get(1) is not None
+
+def test_slots_are_0_to_7():
+    registry = sw.ModeRegistry()
+    with pytest.raises(ValueError):
+        registry.register(8, sw.Mode())
+    registry.register("7", sw.Mode())
+    assert not registry.register(7, sw.Mode(), replace=False)
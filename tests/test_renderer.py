@@ -0,0 +1,84 @@
+"""FrameRenderer on the headless Sense Hat: row diffing, counters and
+   the renderer task"""
+
+import asyncio
+
+import sense_headless
+import sWeather as sw
+
+def frame_with(x):
+    frame = sw.Frame()
+    frame.set_pixel(x, 0, sw.red)
+    return frame
+
+class RowsHat(sense_headless.HeadlessHat):
+    """Records the rows set_rows was sent"""
+
+    def set_rows(self, pixels, rows):
+        self._record("set_rows", list(rows))
+
+def test_unchanged_frame_is_not_written():
+    hat = sense_headless.HeadlessHat()
+    renderer = sw.FrameRenderer(hat)
+    assert renderer.show(frame_with(1), "test") == 64
+    assert renderer.show(frame_with(1), "test") == 0
+    assert hat.counts() == {"set_pixels": 1}
+    assert renderer.counters["test"] == {"frames_written": 1,
+                                         "frames_skipped": 1,
+                                         "pixels_written": 64}
+
+def test_only_changed_rows_are_sent_to_set_rows():
+    hat = RowsHat()
+    renderer = sw.FrameRenderer(hat)
+    frame = frame_with(1)
+    assert renderer.show(frame) == 64
+    frame.set_pixel(4, 2, sw.green)
+    frame.set_pixel(0, 6, sw.green)
+    assert renderer.show(frame) == 16
+    assert [call[2] for call in hat.calls] == [list(range(8)), [2, 6]]
+
+def test_forget_writes_the_next_frame_in_full():
+    hat = RowsHat()
+    renderer = sw.FrameRenderer(hat)
+    renderer.show(frame_with(1))
+    renderer.forget()
+    assert renderer.show(frame_with(1)) == 64
+
+def test_counters_are_exported(monkeypatch):
+    metrics = sw.Metrics()
+    metrics.enabled = True
+    monkeypatch.setattr(sw, "metrics", metrics)
+    renderer = sw.FrameRenderer(sense_headless.HeadlessHat())
+    renderer.show(frame_with(1), "test")
+    renderer.show(frame_with(1), "test")
+    text = metrics.prometheus_text()
+    assert 'sweather_frames_written_total{view="test"} 1' in text
+    assert 'sweather_frames_skipped_total{view="test"} 1' in text
+    assert 'sweather_pixels_written_total{view="test"} 64' in text
+
+def test_renderer_task_survives_a_failed_write():
+    hat = sense_headless.HeadlessHat()
+    set_pixels = hat.set_pixels
+    writes = []
+
+    def flaky(pixel_list):
+        writes.append(pixel_list)
+        if(len(writes) == 2):
+            raise OSError("led matrix gone")
+        set_pixels(pixel_list)
+
+    hat.set_pixels = flaky
+
+    async def present_frames():
+        renderer = sw.FrameRenderer(hat)
+        renderer.start()
+        for x in range(4):
+            renderer.present(frame_with(x), "test")
+            await asyncio.sleep(0.01)
+        renderer.task.cancel()
+        return renderer
+
+    renderer = asyncio.run(present_frames())
+    assert len(writes) == 4
+    assert hat.get_pixel(3, 0) == sw.red
+    assert renderer.counters["test"]["frames_written"] == 3
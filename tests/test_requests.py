@@ -0,0 +1,291 @@
+"""RequestBudget, RequestScheduler and ForecastCache, with a fake fetch
+   and a FakeClock (see conftest.py)"""
+
+import threading
+
+import pytest
+
+import sWeather as sw
+
+class Fetch(object):
+    """A fetch that counts its calls, and returns or raises what it
+       is told to. With block set, it waits for release first"""
+
+    def __init__(self, result="data"):
+        self.result = result
+        self.calls = 0
+        self.block = False
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        if(self.block):
+            self.started.set()
+            self.release.wait(5)
+        if(isinstance(self.result, Exception)):
+            raise self.result
+        return self.result
+
+def empty_budget(per_minute=60):
+    budget = sw.RequestBudget(per_minute, burst=1)
+    budget.tokens = 0.0
+    return budget
+
+#-------------------------- BUDGET --------------------------#
+
+def test_budget_burst_then_refill(clock):
+    budget = sw.RequestBudget(per_minute=30, burst=3)
+    assert [budget.take() for i in range(4)] == [True, True, True, False]
+    clock.advance(2) #One token every 2 s
+    assert budget.take()
+    assert not budget.take()
+
+def test_budget_refill_is_capped_at_burst(clock):
+    budget = sw.RequestBudget(per_minute=60, burst=2)
+    clock.advance(3600)
+    assert [budget.take() for i in range(3)] == [True, True, False]
+
+def test_budget_waits_within_patience(clock):
+    budget = empty_budget(per_minute=60)
+    start = clock.time()
+    assert budget.take(patience=5)
+    assert clock.time() - start == pytest.approx(1)
+
+def test_budget_gives_up_without_sleeping(clock):
+    budget = empty_budget(per_minute=6) #A token every 10 s
+    start = clock.time()
+    assert not budget.take(patience=5)
+    assert clock.time() == start
+
+#------------------------- SCHEDULER -------------------------#
+
+def test_request_sends_fetch(clock):
+    scheduler = sw.RequestScheduler(sw.RequestBudget())
+    fetch = Fetch()
+    assert scheduler.request(1, "3h", fetch) == "data"
+    assert fetch.calls == 1
+    assert scheduler.inflight == {}
+
+def test_request_over_budget_is_deferred(clock):
+    scheduler = sw.RequestScheduler(empty_budget(per_minute=6))
+    fetch = Fetch()
+    with pytest.raises(sw.RequestDeferred):
+        scheduler.request(1, "3h", fetch)
+    assert fetch.calls == 0
+    assert scheduler.inflight == {}
+
+def test_patience_waits_for_the_budget(clock):
+    scheduler = sw.RequestScheduler(empty_budget(per_minute=6))
+    scheduler.local.patience = 30
+    assert scheduler.request(1, "3h", Fetch()) == "data"
+
+def test_same_request_is_coalesced(clock):
+    scheduler = sw.RequestScheduler(sw.RequestBudget(burst=1))
+    fetch = Fetch()
+    fetch.block = True
+    results = []
+    sender = threading.Thread(
+        target=lambda: results.append(scheduler.request(1, "3h", fetch)))
+    sender.start()
+    assert fetch.started.wait(5)
+    #Waits on the one being sent, and doesn't need a token of its own
+    waiter = threading.Thread(
+        target=lambda: results.append(scheduler.request(1, "3h", fetch)))
+    waiter.start()
+    fetch.release.set()
+    sender.join(5)
+    waiter.join(5)
+    assert results == ["data", "data"]
+    assert fetch.calls == 1
+
+def test_coalesced_waiter_gets_the_failure(clock):
+    scheduler = sw.RequestScheduler(sw.RequestBudget())
+    fetch = Fetch(RuntimeError("down"))
+    fetch.block = True
+    problems = []
+
+    def send():
+        try:
+            scheduler.request(1, "3h", fetch)
+        except RuntimeError as problem:
+            problems.append(problem)
+
+    threads = [threading.Thread(target=send) for i in range(2)]
+    threads[0].start()
+    assert fetch.started.wait(5)
+    threads[1].start()
+    fetch.release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(problems) == 2
+    assert fetch.calls == 1
+
+def test_backoff_doubles_with_jitter(clock):
+    scheduler = sw.RequestScheduler(sw.RequestBudget(burst=100))
+    fetch = Fetch(RuntimeError("down"))
+    for failures in (1, 2, 3):
+        with pytest.raises(RuntimeError):
+            scheduler.request(1, "3h", fetch)
+        delay = scheduler.backing_off()[(1, "3h")]
+        full = sw.BACKOFF_BASE * 2 ** (failures - 1)
+        assert full / 2 <= delay <= full
+        #Left alone until then, other endpoints aren't
+        with pytest.raises(sw.RequestDeferred):
+            scheduler.request(1, "3h", fetch)
+        assert scheduler.request(1, "daily", Fetch()) == "data"
+        clock.advance(delay + 0.01)
+    assert fetch.calls == 3
+
+def test_backoff_is_capped(clock):
+    scheduler = sw.RequestScheduler(sw.RequestBudget(burst=100))
+    scheduler.backoff[(1, "3h")] = (20, 0)
+    with pytest.raises(RuntimeError):
+        scheduler.request(1, "3h", Fetch(RuntimeError("down")))
+    assert scheduler.backing_off()[(1, "3h")] <= sw.BACKOFF_MAX
+
+def test_success_clears_backoff(clock):
+    scheduler = sw.RequestScheduler(sw.RequestBudget(burst=100))
+    with pytest.raises(RuntimeError):
+        scheduler.request(1, "3h", Fetch(RuntimeError("down")))
+    clock.advance(sw.BACKOFF_BASE)
+    assert scheduler.request(1, "3h", Fetch()) == "data"
+    assert scheduler.backoff == {}
+    assert scheduler.backing_off() == {}
+
+#--------------------------- CACHE ---------------------------#
+
+def test_cache_hit_until_ttl(clock):
+    cache = sw.ForecastCache(ttl={"3h": 60})
+    fetch = Fetch()
+    assert cache.get(1, "3h", fetch) == "data"
+    clock.advance(59)
+    assert cache.get(1, "3h", fetch) == "data"
+    assert fetch.calls == 1
+    clock.advance(1)
+    fetch.result = "newer"
+    assert cache.get(1, "3h", fetch) == "newer"
+    assert fetch.calls == 2
+    assert cache.stats() == {"hits": 1, "misses": 2}
+
+def test_peek_reports_stale(clock):
+    cache = sw.ForecastCache(ttl={"3h": 60})
+    assert cache.peek(1, "3h") == (None, True)
+    cache.get(1, "3h", Fetch())
+    assert cache.peek(1, "3h") == ("data", False)
+    clock.advance(60)
+    assert cache.peek(1, "3h") == ("data", True)
+
+def test_invalidate(clock):
+    cache = sw.ForecastCache(ttl={"3h": 60, "daily": 60})
+    for city_id in (1, 2):
+        for endpoint in ("3h", "daily"):
+            cache.get(city_id, endpoint, Fetch())
+    cache.invalidate(city_id=1, endpoint="3h")
+    assert sorted(cache.entries) == [(1, "daily"), (2, "3h"), (2, "daily")]
+    cache.invalidate(endpoint="daily")
+    assert sorted(cache.entries) == [(2, "3h")]
+    cache.invalidate()
+    assert cache.entries == {}
+
+def test_deferred_falls_back_to_stale_data(clock):
+    scheduler = sw.RequestScheduler(sw.RequestBudget(per_minute=6, burst=1))
+    cache = sw.ForecastCache(ttl={"3h": 60}, requests=scheduler)
+    assert cache.get(1, "3h", Fetch("old")) == "old"
+    clock.advance(61) #Stale, and the budget is used up
+    scheduler.budget.tokens = 0.0
+    scheduler.budget.refilled = clock.time()
+    fetch = Fetch("new")
+    assert cache.get(1, "3h", fetch) == "old"
+    assert fetch.calls == 0
+    #Nothing to fall back on
+    with pytest.raises(sw.RequestDeferred):
+        cache.get(2, "3h", fetch)
+
+def test_failure_is_raised_not_cached(clock):
+    scheduler = sw.RequestScheduler(sw.RequestBudget())
+    cache = sw.ForecastCache(ttl={"3h": 60}, requests=scheduler)
+    with pytest.raises(RuntimeError):
+        cache.get(1, "3h", Fetch(RuntimeError("down")))
+    assert cache.peek(1, "3h") == (None, True)
+
+def test_waiting_for_the_budget_doesnt_hold_up_other_requests(clock):
+    scheduler = sw.RequestScheduler(empty_budget(per_minute=6))
+    waiting = threading.Event()
+    release = threading.Event()
+
+    def sleep(seconds):
+        #Only the patient request sleeps
+        waiting.set()
+        release.wait(5)
+
+    clock.on_sleep = sleep
+    results = []
+
+    def background():
+        scheduler.local.patience = sw.REFRESH_PATIENCE
+        results.append(scheduler.request(1, "daily", Fetch()))
+
+    patient = threading.Thread(target=background)
+    patient.start()
+    assert waiting.wait(5)
+    #A foreground request on another endpoint is deferred straight
+    # away, not after the patient one gets its token
+    deferred = []
+
+    def foreground():
+        try:
+            scheduler.request(1, "3h", Fetch())
+        except sw.RequestDeferred:
+            deferred.append(True)
+
+    other = threading.Thread(target=foreground)
+    other.start()
+    other.join(1)
+    stuck = other.is_alive()
+    release.set()
+    patient.join(5)
+    other.join(5)
+    assert not stuck
+    assert deferred == [True]
+    assert results == ["data"]
+
+def test_coalesced_waiter_waits_for_the_budget_too(clock, monkeypatch):
+    scheduler = sw.RequestScheduler(empty_budget(per_minute=6))
+    waiting = threading.Event()
+    release = threading.Event()
+
+    def sleep(seconds):
+        waiting.set()
+        release.wait(5)
+
+    clock.on_sleep = sleep
+    fetch = Fetch()
+    results = []
+
+    def send(patience):
+        scheduler.local.patience = patience
+        results.append(scheduler.request(1, "3h", fetch))
+
+    patient = threading.Thread(target=send, args=(30,))
+    patient.start()
+    assert waiting.wait(5)
+    #The same request while the first waits for its token
+    coalesced = threading.Event()
+    count = sw.metrics.count
+
+    def counted(name, *args, **labels):
+        if(name == "requests_coalesced"):
+            coalesced.set()
+        return count(name, *args, **labels)
+
+    monkeypatch.setattr(sw.metrics, "count", counted)
+    waiter = threading.Thread(target=send, args=(0,))
+    waiter.start()
+    assert coalesced.wait(5)
+    release.set()
+    patient.join(5)
+    waiter.join(5)
+    assert results == ["data", "data"]
+    assert fetch.calls == 1
+    assert scheduler.inflight == {}
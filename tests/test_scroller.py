@@ -0,0 +1,99 @@
+"""TextScroller strips against the frames SenseHat.show_message shows"""
+
+import numpy as np
+import pytest
+
+import sWeather as sw
+
+WHITE = [255, 255, 255]
+
+def font():
+    """A made-up font in the hat's layout: 5 columns of 8 pixels per
+       character, stored rotated, 40 [R,G,B] pixels each"""
+    lit = np.random.default_rng(1).random((4, 5, 8)) < 0.5
+    lit[0, 0] = False       #"a" has a blank column in front,
+    lit[1, 3:] = False      # "b" two behind,
+    lit[2, 2] = False       # "c" one in the middle
+    lit[3, :] = False       #and " " is blank
+    chars = {char: [WHITE if pixel else [0, 0, 0] for pixel in columns.flat]
+             for char, columns in zip("abc ", lit)}
+    chars["?"] = [WHITE] * 8 + [[0, 0, 0]] * 24 + [WHITE] * 8
+    return chars
+
+class FontHat(object):
+    """Has a font like a SenseHat does, nothing else"""
+
+    def __init__(self):
+        self.font = font()
+
+    def _get_char_pixels(self, s):
+        #The same as SenseHat._get_char_pixels
+        if len(s) == 1 and s in self.font:
+            return list(self.font[s])
+        return list(self.font['?'])
+
+#What SenseHat.show_message does, without the device and the sleeps
+
+def trim_whitespace(char):
+    psum = lambda x: sum(sum(x, []))
+    if psum(char) > 0:
+        is_empty = True
+        while is_empty:
+            row = char[0:8]
+            is_empty = psum(row) == 0
+            if is_empty:
+                del char[0:8]
+        is_empty = True
+        while is_empty:
+            row = char[-8:]
+            is_empty = psum(row) == 0
+            if is_empty:
+                del char[-8:]
+    return char
+
+def show_message_frames(hat, text_string, text_colour, back_colour):
+    """The 8x8x3 frames show_message writes, in order, with the hat's
+       rotation at 0 (show_message writes them at 270)"""
+    dummy_colour = [None, None, None]
+    string_padding = [dummy_colour] * 64
+    letter_padding = [dummy_colour] * 8
+    scroll_pixels = []
+    scroll_pixels.extend(string_padding)
+    for s in text_string:
+        scroll_pixels.extend(trim_whitespace(hat._get_char_pixels(s)))
+        scroll_pixels.extend(letter_padding)
+    scroll_pixels.extend(string_padding)
+    coloured_pixels = [text_colour if pixel == WHITE else back_colour
+                       for pixel in scroll_pixels]
+    #set_pixels puts pixel n at _pix_map[270][n // 8][n % 8]
+    pix_map = np.rot90(np.arange(64).reshape(8, 8), 3)
+    frames = []
+    scroll_length = len(coloured_pixels) // 8
+    for i in range(scroll_length - 8):
+        frame = np.zeros((64, 3), dtype=np.uint8)
+        for index, pix in enumerate(coloured_pixels[i * 8:i * 8 + 64]):
+            frame[pix_map[index // 8][index % 8]] = pix
+        frames.append(frame.reshape(8, 8, 3))
+    return frames
+
+@pytest.mark.parametrize("text", ["a", "abc", "a b", "  ", "cab?", "xyz"])
+def test_strip_shows_the_same_frames_as_show_message(text):
+    hat = FontHat()
+    color, back = [255, 120, 0], [0, 0, 40]
+    strip = sw.TextScroller(hat).strip(text, color, back)
+    frames = show_message_frames(hat, text, color, back)
+    #A Readout shows a frame for every start but the last
+    assert strip.shape[1] - 8 == len(frames)
+    for start, frame in enumerate(frames):
+        assert np.array_equal(strip[:, start:start + 8], frame), start
+
+def test_strips_are_kept_up_to_the_cache_size():
+    scroller = sw.TextScroller(FontHat())
+    first = scroller.strip("a", WHITE)
+    assert scroller.strip("a", WHITE) is first
+    #A different color is another strip
+    assert scroller.strip("a", [1, 2, 3]) is not first
+    for i in range(sw.STRIP_CACHE_SIZE):
+        scroller.strip("b" * (i + 1), WHITE)
+    assert len(scroller.strips) == sw.STRIP_CACHE_SIZE
+    assert scroller.strip("a", WHITE) is not first
@@ -0,0 +1,112 @@
+"""sense_fb's framebuffer writer against what SenseHat.set_pixels writes,
+   with a plain file standing in for the device"""
+
+import struct
+
+import numpy as np
+import pytest
+
+import sense_fb
+
+class RotatedHat(object):
+    """The one thing FramebufferHat asks the stock SenseHat for"""
+
+    def __init__(self, rotation=0):
+        self.rotation = rotation
+
+#What SenseHat.set_pixels does, into a bytearray instead of the device
+
+PIX_MAP = {0: np.arange(64).reshape(8, 8)}
+for rotation in (90, 180, 270):
+    PIX_MAP[rotation] = np.rot90(PIX_MAP[rotation - 90])
+
+def pack_bin(pix):
+    r = (pix[0] >> 3) & 0x1F
+    g = (pix[1] >> 2) & 0x3F
+    b = (pix[2] >> 3) & 0x1F
+    bits16 = (r << 11) + (g << 5) + b
+    return struct.pack('H', bits16)
+
+def set_pixels_bytes(pixel_list, rotation):
+    device = bytearray(sense_fb.SENSE_FB_SIZE)
+    map = PIX_MAP[rotation]
+    for index, pix in enumerate(pixel_list):
+        offset = map[index // 8][index % 8] * 2
+        device[offset:offset + 2] = pack_bin(pix)
+    return bytes(device)
+
+@pytest.fixture
+def device(tmp_path):
+    path = tmp_path / "fb1"
+    path.write_bytes(b"\0" * sense_fb.SENSE_FB_SIZE)
+    return path
+
+def pixel_list(seed):
+    rand = np.random.default_rng(seed)
+    pixels = rand.integers(0, 256, (64, 3)).tolist()
+    #The ends of each channel's range
+    pixels[:4] = [[0, 0, 0], [255, 255, 255], [7, 3, 7], [8, 4, 8]]
+    return pixels
+
+@pytest.mark.parametrize("rotation", [0, 90, 180, 270])
+def test_set_pixels_writes_what_sense_hat_would(device, rotation):
+    hat = sense_fb.FramebufferHat(RotatedHat(rotation), str(device))
+    for seed in range(3):
+        pixels = pixel_list(seed)
+        hat.set_pixels(pixels)
+        assert device.read_bytes() == set_pixels_bytes(pixels, rotation)
+    hat.framebuffer.close()
+
+def test_pack_is_rgb565(device):
+    framebuffer = sense_fb.Framebuffer(str(device))
+    pixels = np.array(pixel_list(4), dtype=np.uint8).reshape(8, 8, 3)
+    packed = framebuffer.pack(pixels)
+    assert packed.tobytes() == b"".join(pack_bin(pix.tolist())
+                                        for pix in pixels.reshape(64, 3))
+    framebuffer.close()
+
+def test_only_the_given_rows_are_written(device):
+    hat = sense_fb.FramebufferHat(RotatedHat(), str(device))
+    old = np.array(pixel_list(5), dtype=np.uint8).reshape(8, 8, 3)
+    new = np.array(pixel_list(6), dtype=np.uint8).reshape(8, 8, 3)
+    hat.set_rows(old, None)
+    hat.set_rows(new, [2, 5])
+    expected = old.copy()
+    expected[[2, 5]] = new[[2, 5]]
+    assert device.read_bytes() == set_pixels_bytes(
+        expected.reshape(64, 3).tolist(), 0)
+    hat.framebuffer.close()
+
+def test_turned_frames_are_written_whole(device):
+    hat = sense_fb.FramebufferHat(RotatedHat(90), str(device))
+    frame = np.array(pixel_list(7), dtype=np.uint8).reshape(8, 8, 3)
+    hat.set_rows(frame, [0])
+    assert device.read_bytes() == set_pixels_bytes(
+        frame.reshape(64, 3).tolist(), 90)
+    hat.framebuffer.close()
+
+@pytest.mark.parametrize("pixels", [
+    [[0, 0, 0]] * 63,       #One short
+    [[0, 0]] * 64,          #No blue
+    [[0, 0, 256]] * 64,     #Out of range
+    [[-1, 0, 0]] * 64,
+])
+def test_bad_pixel_lists_are_refused(device, pixels):
+    hat = sense_fb.FramebufferHat(RotatedHat(), str(device))
+    with pytest.raises(ValueError):
+        hat.set_pixels(pixels)
+    assert device.read_bytes() == b"\0" * sense_fb.SENSE_FB_SIZE
+    hat.framebuffer.close()
+
+def test_find_framebuffer(tmp_path):
+    sysfs, dev = tmp_path / "sys", tmp_path / "dev"
+    for fb, name in (("fb0", "simple"), ("fb1", sense_fb.SENSE_FB_NAME),
+                     ("fb2", sense_fb.SENSE_FB_NAME)):
+        (sysfs / fb).mkdir(parents=True)
+        (sysfs / fb / "name").write_text(name + "\n")
+    dev.mkdir()
+    assert sense_fb.find_framebuffer(str(sysfs), str(dev)) is None
+    (dev / "fb2").touch()
+    assert sense_fb.find_framebuffer(str(sysfs), str(dev)) == str(dev / "fb2")
+    (dev / "fb1").touch()
+    assert sense_fb.find_framebuffer(str(sysfs), str(dev)) == str(dev / "fb1")
@@ -0,0 +1,46 @@
+"""MENU_SPRITES against the per-pixel images they replaced"""
+
+import numpy as np
+import pytest
+
+import sWeather as sw
+
+#The "H" in the bottom right corner of the first three images
+H = [(4, 4), (6, 4), (4, 5), (6, 5), (4, 6), (5, 6), (6, 6), (4, 7), (6, 7)]
+
+#(x, y) of every hat.set_pixel call of the old show_*_image functions
+OLD_IMAGES = {
+    #show_outdoor_hud_image: "O" and "H"
+    0: [(0, 1), (1, 1), (2, 1), (0, 2), (2, 2), (0, 3), (2, 3), (0, 4),
+        (1, 4), (2, 4)] + H,
+    #show_indoor_hud_image: "I" and "H"
+    1: [(0, 1), (1, 1), (2, 1), (1, 2), (1, 3), (0, 4), (1, 4), (2, 4)] + H,
+    #show_3h_readout_image: "3" and "H"
+    2: [(0, 1), (1, 1), (2, 1), (2, 2), (0, 3), (1, 3), (2, 3), (2, 4),
+        (0, 5), (1, 5), (2, 5)] + H,
+    #show_8d_readout_image: "8" and "D"
+    3: [(0, 1), (1, 1), (2, 1), (0, 2), (2, 2), (0, 3), (1, 3), (2, 3),
+        (0, 4), (2, 4), (0, 5), (1, 5), (2, 5),
+        (4, 4), (5, 4), (4, 5), (6, 5), (4, 6), (5, 7), (6, 6), (4, 7)],
+}
+
+def old_mask(pixels):
+    mask = np.zeros((8, 8), dtype=bool)
+    for x, y in pixels:
+        mask[y, x] = True
+    return mask
+
+@pytest.mark.parametrize("slot", sorted(OLD_IMAGES))
+def test_sprite_matches_old_image(slot):
+    assert np.array_equal(sw.MENU_SPRITES[slot], old_mask(OLD_IMAGES[slot]))
+
+def test_sprites_leave_the_menu_bar_clear():
+    for sprite in sw.MENU_SPRITES.values():
+        assert sprite.shape == (8, 8) and sprite.dtype == bool
+        assert not sprite[0].any()
+
+def test_compile_sprite():
+    mask = sw.compile_sprite(["#......."] + ["........"] * 6 + [".......#"])
+    assert np.flatnonzero(mask).tolist() == [0, 63]
+    with pytest.raises(ValueError):
+        sw.compile_sprite(["#"] * 8)